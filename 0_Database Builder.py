@@ -1,43 +1,14 @@
 #Database Builder
-import configparser
 import psycopg2
 import logging
+import argparse
+import profiling
+from database import connect_db
 
 # Initialize logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 
-# Load settings from the ini file
-config = configparser.ConfigParser()
-config.read('settings.ini')
-
-# Access database settings from settings.ini
-db_host = config['database']['host']
-db_name = config['database']['database']
-db_user = config['database']['user']
-db_password = config['database']['password']
-db_port = config['database']['port']
-
-# Connect to PostgreSQL database
-def connect_db():
-    try:
-        conn = psycopg2.connect(
-            host=db_host,
-            database=db_name,
-            user=db_user,
-            password=db_password,
-            port=db_port
-        )
-        logging.info("[INFO] Connected to the database.")
-        print("[INFO] Database connection successful.")
-        return conn
-    except psycopg2.Error as e:
-        print(f"[ERROR] Could not connect to the database: {e}")
-        logging.error(f"[ERROR] Could not connect to the database: {e}")
-        return None
-
-
-
 # Step 2: Create necessary tables for the project
 def create_tables(cursor):
     commands = [
@@ -147,8 +118,9 @@ def run_schema_creation():
     
     cursor = conn.cursor()
 
-    # Create all tables
-    create_tables(cursor)
+    # Create all tables (one batch for --profile)
+    with profiling.batch():
+        create_tables(cursor)
 
     # Commit the changes and close the connection
     conn.commit()
@@ -158,4 +130,9 @@ def run_schema_creation():
 
 # Main execution
 if __name__ == "__main__":
-    run_schema_creation()
+    parser = argparse.ArgumentParser(description="Create the database tables.")
+    profiling.add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    with profiling.session("schema", args.profile, args.profile_batches):
+        run_schema_creation()
@@ -1,25 +1,17 @@
 import psycopg2
 import geopy
 from geopy.geocoders import Nominatim
-import configparser
 import logging
 import time
 import re  # For cleaning non-text characters
+import argparse
+import metrics
+import profiling
+from database import connect_db, iter_keyset
 
 # Initialize logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Load settings from the ini file
-config = configparser.ConfigParser()
-config.read('settings.ini')
-
-# Access database settings from settings.ini
-db_host = config['database']['host']
-db_name = config['database']['database']
-db_user = config['database']['user']
-db_password = config['database']['password']
-db_port = config['database']['port']
-
 # Dictionary of common multi-word place names
 known_place_names = {
     "san francisco": "San Francisco",
@@ -47,28 +39,12 @@ def clean_place_name(entity_value):
 
     return entity_value.title()  # Convert back to title case for geocoding
 
-# Connect to PostgreSQL database
-def connect_db():
-    try:
-        conn = psycopg2.connect(
-            host=db_host,
-            database=db_name,
-            user=db_user,
-            password=db_password,
-            port=db_port
-        )
-        logging.info("Database connection successful.")
-        return conn
-    except psycopg2.Error as e:
-        logging.error(f"Could not connect to the database: {e}")
-        return None
-
-# Step 2: Fetch entities for geocoding
-def fetch_entities(cursor, batch_size=100, offset=0):
-    cursor.execute("SELECT entity_id, entity_value FROM entities WHERE entity_type = 'LOC' LIMIT %s OFFSET %s;", (batch_size, offset))
-    entities = cursor.fetchall()
-    logging.info(f"Fetched {len(entities)} entities for geocoding.")
-    return entities
+# Step 2: Fetch entities for geocoding, batch by batch in entity_id order
+def fetch_entities(cursor, batch_size=100):
+    for entities in iter_keyset(cursor, "SELECT entity_id, entity_value FROM entities", "entity_id",
+                                where="entity_type = 'LOC'", batch_size=batch_size):
+        logging.info(f"Fetched {len(entities)} entities for geocoding.")
+        yield entities
 
 # Step 3: Geocode entity locations with caching
 def geocode_entity(entity_value, geocode_cache, geolocator):
@@ -83,8 +59,10 @@ def geocode_entity(entity_value, geocode_cache, geolocator):
     # Perform geocoding if not already cached
     logging.info(f"Geocoding {cleaned_entity}")
     try:
-        location = geolocator.geocode(cleaned_entity, timeout=10)
+        with metrics.timer("model_batch_seconds"):
+            location = geolocator.geocode(cleaned_entity, timeout=10)
     except Exception as e:
+        metrics.count("errors")
         logging.error(f"Error during geocoding {cleaned_entity}: {e}")
         return None, None, None
 
@@ -107,33 +85,33 @@ def store_geocoded_location(cursor, entity_id, latitude, longitude, source):
             VALUES (%s, %s, %s, %s)
             ON CONFLICT (entity_id) DO NOTHING;  -- Avoid inserting duplicates
         """, (entity_id, latitude, longitude, source))
+        metrics.count("rows_written", cursor.rowcount)
     except Exception as e:
+        metrics.count("errors")
         logging.error(f"Error inserting geocoded location for entity_id {entity_id}: {e}")
 
-# Step 5: Main function to run geocoding and store results with batching and error handling
+# Step 5: Main function to run geocoding and store results with batching and error handling;
+# returns True if it completed (see pipeline.py)
+@metrics.instrumented("geocode")
 def run_geo_pipeline(batch_size=100):
     logging.info("Starting geocoding process...")
     
     conn = connect_db()
     if conn is None:
         logging.error("Failed to connect to the database. Exiting.")
-        return
+        return False
     cursor = conn.cursor()
 
     # Initialize geolocator with a longer timeout
     geolocator = Nominatim(user_agent="geo_coder", timeout=10)
     geocode_cache = {}
 
-    offset = 0
-    while True:
-        # Fetch entities in batches
-        entities = fetch_entities(cursor, batch_size=batch_size, offset=offset)
-        if not entities:
-            break
-
+    # Fetch entities in batches
+    for entities in profiling.sample(fetch_entities(cursor, batch_size=batch_size)):
         for entity_id, entity_value in entities:
             logging.info(f"Processing entity ID {entity_id} with value '{entity_value}'")
             latitude, longitude, source = geocode_entity(entity_value, geocode_cache, geolocator)
+            metrics.count("articles")
             
             if latitude and longitude:
                 store_geocoded_location(cursor, entity_id, latitude, longitude, source)
@@ -146,11 +124,16 @@ def run_geo_pipeline(batch_size=100):
 
         # Commit after each batch
         conn.commit()
-        offset += batch_size
 
     cursor.close()
     conn.close()
     logging.info("Geocoding pipeline completed.")
+    return True
 
 if __name__ == "__main__":
-    run_geo_pipeline(batch_size=100)
+    parser = argparse.ArgumentParser(description="Geocode the location entities.")
+    profiling.add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    with profiling.session("geocode", args.profile, args.profile_batches):
+        run_geo_pipeline(batch_size=100)
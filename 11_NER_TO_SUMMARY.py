@@ -1,10 +1,17 @@
 #NER TO DATABASE SUMMARIES
 import psycopg2
-from transformers import pipeline
+from models import NER_MODEL, get_ner_pipeline
 import logging
-import configparser
 from tqdm import tqdm  # For tracking progress
 import torch
+import argparse
+import functools
+import metrics
+import profiling
+import tuning
+from checkpoints import run_checkpointed, with_dead_letters, resume_filter
+from database import connect_db, iter_keyset
+from job_queue import run_worker, run_workers
 
 import os
 os.environ["CUDA_VISIBLE_DEVICES"] = "0"  # Make sure GPU-1 is visible
@@ -18,52 +25,27 @@ else:
     device = torch.device("cpu")
     print("Using CPU")
 
-# Load NER model with the specified device
-ner_model = pipeline("ner", model="dbmdz/bert-large-cased-finetuned-conll03-english", device=device)
-
-
+# This host's tuned torch threads and batch size (see tuning.py), set before the model loads
+tuning.apply_threads("summary_ner")
+BATCH_SIZE = tuning.batch_size("summary_ner")
 
 # Initialize logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Load a pretrained NER pipeline from Hugging Face and specify the device
-nlp = pipeline("ner", model="dbmdz/bert-large-cased-finetuned-conll03-english", device=device)
-
-# Load NER model (using a larger model may require GPU resources)
+# Load NER model (using a larger model may require GPU resources); shared with 6_ (see models.py)
 def load_ner_model():
-    return pipeline("ner", model="dbmdz/bert-large-cased-finetuned-conll03-english", grouped_entities=True)
-
-# Load settings from the ini file
-config = configparser.ConfigParser()
-config.read('settings.ini')
+    return get_ner_pipeline()
 
-# Database credentials
-db_host = config['database']['host']
-db_name = config['database']['database']
-db_user = config['database']['user']
-db_password = config['database']['password']
-db_port = config['database']['port']
+# Load the model when the stage is imported, as before (pipeline.py --warm); later calls reuse it
+load_ner_model()
 
-# Connect to PostgreSQL database
-def connect_db():
-    try:
-        conn = psycopg2.connect(
-            host=db_host,
-            database=db_name,
-            user=db_user,
-            password=db_password,
-            port=db_port
-        )
-        logging.info("[INFO] Connected to the database.")
-        return conn
-    except psycopg2.Error as e:
-        logging.error(f"[ERROR] Could not connect to the database: {e}")
-        return None
-
-# Fetch summaries from the database
-def fetch_summaries(cursor, batch_size=100, offset=0):
-    cursor.execute("SELECT article_id, summary FROM articles WHERE summary IS NOT NULL LIMIT %s OFFSET %s", (batch_size, offset))
-    return cursor.fetchall()
+# Fetch summaries from the database, batch by batch in article_id order. A resumed run (after
+# the checkpoint's article) also takes the summaries below it that have no entities yet, since
+# summaries are written by another stage (see checkpoints.resume_filter)
+def fetch_summaries(cursor, batch_size=100, after=None):
+    where, params = resume_filter("summary_ner", "summary IS NOT NULL", "summary_ner_entities IS NULL", after)
+    return iter_keyset(cursor, "SELECT article_id, summary FROM articles", "article_id",
+                       where=where, params=params, batch_size=batch_size)
 
 # Update the summaries column with NER entities
 import json  # Import json module
@@ -77,55 +59,77 @@ def update_summary_ner_entities(cursor, article_id, ner_entities):
     """
     # Convert ner_entities (list of dicts) to a JSON string
     cursor.execute(query, (json.dumps(ner_entities), article_id))
+    metrics.count("rows_written", cursor.rowcount)
 
 
-# Batch NER processing for summaries
-def process_ner_summaries_in_batches(cursor, ner_model, batch_size=100):
-    offset = 0
-    total_summaries = 0
-
-    while True:
-        summaries = fetch_summaries(cursor, batch_size, offset)
-        if not summaries:
-            break  # Stop when no more summaries are fetched
+# Run NER over a batch of (article_id, summary) rows and store the results
+def tag_summaries(cursor, ner_model, summaries):
+    metrics.count_tokens([summary for _, summary in summaries], ner_model.tokenizer)
+    with metrics.timer("model_batch_seconds"):
+        results = [(article_id, ner_model(summary)) for article_id, summary in summaries]
+    metrics.count("articles", len(summaries))
 
-        # Process each summary in the batch
-        for article_id, summary in summaries:
-            entities = ner_model(summary)
+    for article_id, entities in results:
+        # Group entities in a structured way for storing
+        grouped_entities = [{"entity_type": entity['entity_group'], "entity_value": entity['word']} for entity in entities]
 
-            # Group entities in a structured way for storing
-            grouped_entities = [{"entity_type": entity['entity_group'], "entity_value": entity['word']} for entity in entities]
+        # Update the article's summary with NER results
+        update_summary_ner_entities(cursor, article_id, grouped_entities)
 
-            # Update the article's summary with NER results
-            update_summary_ner_entities(cursor, article_id, grouped_entities)
+# Batch NER processing for summaries. Every batch is committed with the stage's checkpoint, so a
+# run that stops resumes after its last batch (see checkpoints.py)
+def process_ner_summaries_in_batches(conn, ner_model, batch_size=100, restart=False):
+    total_summaries, dead = run_checkpointed(
+        conn, "summary_ner", NER_MODEL,
+        lambda cursor, after: profiling.sample(fetch_summaries(cursor, batch_size, after)),
+        lambda cursor, summaries: tag_summaries(cursor, ner_model, summaries), restart)
 
-            total_summaries += 1
+    logging.info(f"[INFO] NER processing on summaries completed: {total_summaries} summaries, {dead} dead-lettered.")
 
-        logging.info(f"[INFO] Processed {total_summaries} summaries.")
-        offset += batch_size
-
-    logging.info("[INFO] NER processing on summaries completed.")
-
-# Main NER pipeline for summaries
-def run_ner_summaries_pipeline(batch_size=100):
+# Main NER pipeline for summaries; returns True if it completed (see pipeline.py)
+@metrics.instrumented("summary_ner")
+def run_ner_summaries_pipeline(batch_size=BATCH_SIZE, restart=False):
     logging.info("[INFO] Starting the NER summaries pipeline...")
 
     conn = connect_db()
     if conn is None:
-        return
+        return False
 
-    cursor = conn.cursor()
     ner_model = load_ner_model()
 
-    process_ner_summaries_in_batches(cursor, ner_model, batch_size=batch_size)
-
-    # Commit all changes and close the connection
-    conn.commit()
-    cursor.close()
-    conn.close()
+    try:
+        process_ner_summaries_in_batches(conn, ner_model, batch_size=batch_size, restart=restart)
+    except psycopg2.Error as e:
+        metrics.count("errors")
+        logging.error(f"[ERROR] Database error occurred: {e}. The batches committed so far are kept; rerun to resume.")
+        conn.rollback()
+        return False
+    finally:
+        conn.close()
     logging.info("[INFO] NER summaries pipeline completed successfully.")
+    return True
+
+# Run summary NER as a job-queue worker (see job_queue.py); any number of workers can run at once
+@metrics.instrumented("summary_ner", per_process=True)
+def run_queue_worker(batch_size=BATCH_SIZE):
+    ner_model = load_ner_model()
+    run_worker("summary_ner", "SELECT article_id, summary FROM articles WHERE article_id = ANY(%s)",
+               with_dead_letters("summary_ner", NER_MODEL, lambda cursor, summaries: tag_summaries(cursor, ner_model, summaries)),
+               batch_size, where="summary IS NOT NULL")
 
 # Execute the NER summaries pipeline
 if __name__ == "__main__":
-    run_ner_summaries_pipeline(batch_size=100)
+    parser = argparse.ArgumentParser(description="Extract named entities from article summaries.")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="Summaries per batch (default: this host's tuned size, or 100)")
+    parser.add_argument("--queue", action="store_true", help="Claim batches from the article_jobs queue, so several workers can share the stage")
+    parser.add_argument("--workers", type=int, default=1, help="Queue worker processes to start on this machine (with --queue)")
+    parser.add_argument("--restart", action="store_true", help="Ignore the stage's checkpoint and start from the first summary")
+    profiling.add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    with profiling.session("summary_ner", args.profile, args.profile_batches):
+        if args.queue:
+            run_workers(functools.partial(run_queue_worker, args.batch_size), args.workers)
+        else:
+            run_ner_summaries_pipeline(batch_size=args.batch_size, restart=args.restart)
 
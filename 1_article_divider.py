@@ -1,8 +1,13 @@
 import os
 import re
+import argparse
+import functools
+import profiling
 import configparser
-import chardet
 import torch
+from encoding_detector import detect_encoding as detect_file_encoding
+from text_cleaner import clean_text
+from segmenter import divide_articles, run_stage, default_manifest_path, default_state_path, add_run_arguments
 
 # Check if CUDA is available and set device
 device = 0 if torch.cuda.is_available() else -1  # 0 for GPU, -1 for CPU
@@ -19,38 +24,8 @@ input_directory = config['directories']['input_directory']
 if not os.path.exists(output_directory):
     os.makedirs(output_directory)  # Create the directory if it doesn't exist
 
-# Function to detect encoding of a file
-def detect_file_encoding(file_path):
-    with open(file_path, 'rb') as file:
-        raw_data = file.read()
-        result = chardet.detect(raw_data)
-        return result['encoding']
-
-# Cleaning function to remove unwanted characters but keep newlines intact
-def clean_text_with_newlines(text):
-    """
-    Clean the text by removing unwanted characters but keep newlines intact.
-    """
-    # Remove non-alphabetic characters except common punctuation (retain: . , ! ? ' ", newlines)
-    text = re.sub(r'[^\w.,!?\'"\s\n-]', '', text)
-    
-    # Handle hyphenated words (join lines ending with '-')
-    text = re.sub(r'(\w+)-\n(\w+)', r'\1\2', text)
-
-    # Replace multiple spaces/tabs with a single space, but keep newlines intact
-    text = re.sub(r'[ \t]+', ' ', text)
-    
-    # Strip leading/trailing whitespace from lines
-    text = '\n'.join(line.strip() for line in text.splitlines())
-
-    return text
-
-# Function to process a single file: takes a raw text file and segments it into articles
-import re
-
-# Adjusted function to process the file and handle poetry sections.
 # Function to process the file and handle articles, poetry, and advertisements
-def process_file(file_path, output_path):
+def process_file(file_path, output_path, clean=True):
     # Detect the file encoding
     encoding = detect_file_encoding(file_path)
     print(f"[INFO] Detected encoding for {file_path}: {encoding}")
@@ -59,84 +34,42 @@ def process_file(file_path, output_path):
     with open(file_path, 'r', encoding=encoding, errors='replace') as file:
         newspaper_text = file.read()  # Read the entire file as a single string
 
-    # Define a regular expression pattern to identify standard articles
-    
-    # Define a regular expression pattern to identify article titles and their corresponding bodies
-# The title should be 3 or more characters, and avoid titles that are just punctuation.
-        article_pattern = re.compile(r'(?<=\n\n)([^\n]{1,80})\n+([^\n]+\n(.+\n)*)')
-        poetry_pattern = re.compile(r'(Selected Poetry|BY [A-Z\s]+)\n+([^\n]+\n(.+\n)*)')
-
-
-    # Define a pattern for identifying advertisement sections (adjust this to match your ad structure)
-    ad_pattern = re.compile(r'([A-Z\s]+(?:CO|CO\.|INC|LTD|ADVERTISEMENT|SALE|NOTICE|WHOLESALE))\n+([^\n]+\n(.+\n)*)')  # Pattern for ads (company names)
-
-    # Find all matches in the text for articles, poetry, and ads
-    article_matches = list(article_pattern.finditer(newspaper_text))
-    poetry_matches = list(poetry_pattern.finditer(newspaper_text))
-    ad_matches = list(ad_pattern.finditer(newspaper_text))
+    # Remove OCR junk and rejoin hyphenated words before tagging (see text_cleaner.py)
+    counts = {}
+    if clean:
+        newspaper_text = clean_text(newspaper_text, counts)
 
-    # Open the output file to write the segmented articles
+    # Tag articles, poetry and advertisements using the shared segmentation engine
     with open(output_path, 'w', encoding='utf-8') as output_file:
-        last_pos = 0  # This variable tracks the position of the last processed article
-
-        # Process articles
-        for match in article_matches:
-            title = match.group(1)
-            body = match.group(2)
-
-            output_file.write(newspaper_text[last_pos:match.start()])  # Write uncategorized text before the article
-            output_file.write(f"====================================\n")
-            output_file.write(f"Title: {title}\n")
-            output_file.write(f"Body:\n{body}\n")
-            output_file.write(f"====================================\n\n")
-            last_pos = match.end()
-
-        # Process poetry
-        for poetry_match in poetry_matches:
-            poetry_title = poetry_match.group(1)
-            poetry_body = poetry_match.group(2)
-
-            output_file.write(f"====================================\n")
-            output_file.write(f"Poetry Title: {poetry_title}\n")
-            output_file.write(f"Body:\n{poetry_body}\n")
-            output_file.write(f"====================================\n\n")
-            last_pos = poetry_match.end()
-
-        # Process advertisements
-        for ad_match in ad_matches:
-    # Check if the match has enough groups before accessing them
-            if ad_match and len(ad_match.groups()) >= 2:
-                ad_title = ad_match.group(1)
-                ad_body = ad_match.group(2)
-
-                output_file.write(f"====================================\n")
-                output_file.write(f"Advertisement Title: {ad_title}\n")
-                output_file.write(f"Body:\n{ad_body}\n")
-                output_file.write(f"====================================\n\n")
-                last_pos = ad_match.end()
-        #else:
-       #     print(f"[WARNING] Advertisement match does not contain enough groups: {ad_match}")
-
-        # Write any remaining uncategorized text
-        output_file.write(newspaper_text[last_pos:])
+        output_file.write(divide_articles(newspaper_text))
 
     # Log that the file has been successfully processed and saved
     print(f"Processed articles, poetry, and advertisements saved to {output_path}")
+    return {"cleaning": counts}
 
 
 
 # Iterate over all files in the input directory
-def process_all_files():
+def process_all_files(workers=1, manifest_path=None, force=False, clean=True):
+    tasks = []
     for filename in os.listdir(input_directory):
         # Only process files that end with ".txt"
         if filename.lower().endswith(".txt"):
             # Construct full paths for both the input and output files
             input_file_path = os.path.join(input_directory, filename)  # Full path to the input file
             output_file_path = os.path.join(output_directory, filename.replace(".txt", "_seg1.txt"))  # Output file with "_seg1" suffix
-            
-            # Process the file and save the output
-            process_file(input_file_path, output_file_path)  # Call the process_file function on each .txt file
+            tasks.append((input_file_path, output_file_path))
+
+    # Process new or changed files serially or across a process pool and record the run manifest
+    run_stage(functools.partial(process_file, clean=clean), tasks, workers, manifest_path or default_manifest_path(output_directory, "seg1"),
+              default_state_path(output_directory, "seg1"), force)
 
 # Main function
 if __name__ == "__main__":
-    process_all_files()
+    parser = argparse.ArgumentParser(description="Stage 1: tag articles, poetry and advertisements in raw issues.")
+    parser.add_argument("--no-clean", action="store_true", help="Tag the raw text without the OCR cleaning rules of text_cleaner.py")
+    add_run_arguments(parser)
+    args = parser.parse_args()
+
+    with profiling.session("seg1", args.profile, args.profile_batches):
+        process_all_files(args.workers, args.manifest, args.force, not args.no_clean)
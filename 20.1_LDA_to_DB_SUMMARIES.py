@@ -5,8 +5,11 @@ from nltk.stem import WordNetLemmatizer
 from gensim import corpora
 from gensim.models import Phrases
 from gensim.models.ldamodel import LdaModel
-import configparser
 import logging
+import argparse
+import metrics
+import profiling
+from database import connect_db, iter_keyset
 
 # Initialize logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -20,36 +23,10 @@ nltk.download('omw-1.4')
 stop_words = set(stopwords.words('english'))
 lemmatizer = WordNetLemmatizer()
 
-# Load settings from the ini file
-config = configparser.ConfigParser()
-config.read('settings.ini')
-
-db_host = config['database']['host']
-db_name = config['database']['database']
-db_user = config['database']['user']
-db_password = config['database']['password']
-db_port = config['database']['port']
-
-# Connect to PostgreSQL database
-def connect_db():
-    try:
-        conn = psycopg2.connect(
-            host=db_host,
-            database=db_name,
-            user=db_user,
-            password=db_password,
-            port=db_port
-        )
-        logging.info("[INFO] Connected to the database.")
-        return conn
-    except psycopg2.Error as e:
-        logging.error(f"[ERROR] Could not connect to the database: {e}")
-        return None
-
-# Fetch summaries from the database
-def fetch_summaries(cursor, batch_size=100, offset=0):
-    cursor.execute("SELECT article_id, summary FROM articles WHERE summary IS NOT NULL LIMIT %s OFFSET %s", (batch_size, offset))
-    return cursor.fetchall()
+# Fetch summaries from the database, batch by batch in article_id order
+def fetch_summaries(cursor, batch_size=100):
+    return iter_keyset(cursor, "SELECT article_id, summary FROM articles", "article_id",
+                       where="summary IS NOT NULL", batch_size=batch_size)
 
 # Preprocess text: tokenize, remove stop words, and lemmatize
 def preprocess_text(text):
@@ -58,21 +35,17 @@ def preprocess_text(text):
 
 # Preprocess all summaries for LDA
 def preprocess_summaries(cursor):
-    offset = 0
     batch_size = 100  # Batch size for fetching summaries
     processed_texts = []
 
-    while True:
-        summaries = fetch_summaries(cursor, batch_size, offset)
-        if not summaries:
-            break  # Stop when no more summaries are fetched
-
+    for summaries in profiling.sample(fetch_summaries(cursor, batch_size)):
         for article_id, summary in summaries:
             tokens = preprocess_text(summary)
             processed_texts.append((article_id, tokens))
+            metrics.count("tokens", len(tokens))
+        metrics.count("articles", len(summaries))
 
-        offset += batch_size
-        logging.info(f"[INFO] Preprocessed {offset} summaries.")
+        logging.info(f"[INFO] Preprocessed {len(processed_texts)} summaries.")
 
     return processed_texts
 
@@ -108,11 +81,12 @@ def create_dictionary_and_corpus(processed_texts):
 # Train LDA Model
 def train_lda_model(corpus, dictionary, num_topics=20, passes=15):
     logging.info(f"[INFO] Training LDA model with {num_topics} topics...")
-    lda_model = LdaModel(corpus, num_topics=num_topics, id2word=dictionary, passes=passes)
+    with metrics.timer("model_batch_seconds"):
+        lda_model = LdaModel(corpus, num_topics=num_topics, id2word=dictionary, passes=passes)
     logging.info("[INFO] LDA model training complete.")
     return lda_model
 
-# Store LDA topics into the summary_topics column in the articles table
+# Store LDA topics into the summary_topics column in the articles table; returns False if they were rolled back
 def store_summary_lda_topics(conn, cursor, lda_model, corpus, processed_texts):
     try:
         logging.info("[INFO] Storing summary topics in the database...")
@@ -132,24 +106,29 @@ def store_summary_lda_topics(conn, cursor, lda_model, corpus, processed_texts):
                 SET summary_topics = %s
                 WHERE article_id = %s;
             """, (summary_topics_str, article_id))
+            metrics.count("rows_written", cursor.rowcount)
 
         conn.commit()  # Commit the changes after all updates are successful
         logging.info("[INFO] Summary topics stored successfully in the summary_topics column.")
 
     except psycopg2.Error as e:
+        metrics.count("errors")
         logging.error(f"[ERROR] Failed to store summary topics for article {article_id}: {e}")
         conn.rollback()  # Rollback if any critical error occurs
+        return False
+    return True
 
 
 
 
-# Main function to run the LDA pipeline for summaries
+# Main function to run the LDA pipeline for summaries; returns True if it completed (see pipeline.py)
+@metrics.instrumented("summary_lda")
 def run_lda_pipeline_on_summaries(num_topics=10, batch_size=100):
     logging.info("[INFO] Starting the LDA pipeline on summaries...")
 
     conn = connect_db()
     if conn is None:
-        return
+        return False
 
     cursor = conn.cursor()
 
@@ -166,13 +145,21 @@ def run_lda_pipeline_on_summaries(num_topics=10, batch_size=100):
     lda_model = train_lda_model(corpus, dictionary, num_topics=num_topics)
 
     # Store topics and article-topic relationships in the database
-    store_summary_lda_topics(conn, cursor, lda_model, corpus, processed_texts)
+    stored = store_summary_lda_topics(conn, cursor, lda_model, corpus, processed_texts)
 
     # Close the connection
     cursor.close()
     conn.close()
+    if not stored:
+        return False
     logging.info("[INFO] LDA pipeline on summaries completed successfully.")
+    return True
 
 # Execute the LDA pipeline on summaries
 if __name__ == "__main__":
-    run_lda_pipeline_on_summaries(num_topics=10)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Fit an LDA topic model on the article summaries and store their topics.")
+    profiling.add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    with profiling.session("summary_lda", args.profile, args.profile_batches):
+        run_lda_pipeline_on_summaries(num_topics=10)
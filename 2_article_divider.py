@@ -1,7 +1,10 @@
 import os
 import re
-import chardet  # Used for detecting encoding
+import argparse
+import profiling
 import torch
+from encoding_detector import detect_encoding  # Sampled, cached encoding detection
+from segmenter import refine_articles, run_stage, default_manifest_path, default_state_path, add_run_arguments
 
 # Check if CUDA is available and set device
 device = 0 if torch.cuda.is_available() else -1  # 0 for GPU, -1 for CPU
@@ -14,14 +17,6 @@ output_directory = r"C:\Users\SeanOffice\Documents\Trinity Journal Segmented 2"
 if not os.path.exists(output_directory):
     os.makedirs(output_directory)  # Create output directory if it doesn't exist
 
-# Function to detect file encoding
-def detect_encoding(file_path):
-    with open(file_path, 'rb') as file:
-        raw_data = file.read()  # Read binary data to detect encoding
-        result = chardet.detect(raw_data)
-        encoding = result['encoding']
-        return encoding
-
 # Function to process a single file: reads the file, processes the text, and writes the result to a new file
 def process_file(file_path, output_path):
     # Detect encoding of the file before reading it
@@ -31,40 +26,33 @@ def process_file(file_path, output_path):
     with open(file_path, 'r', encoding=encoding) as file:
         newspaper_text = file.read()  # Read the entire file as a single string
 
-    # Capture the first line separately before applying the regex pattern
-    first_line = newspaper_text.split('\n', 1)[0]  # Get the first line
-
-    # Define a regular expression pattern to identify titles and their corresponding bodies
-    title_body_pattern = re.compile(r'([A-Z\s,\'\.]+)(?:\n|\n\n)(.+?)(?=\n[A-Z\s,\'\.]+\n|\n\n|\Z)', re.DOTALL)
-
-    # Open the output file to write the processed data
+    # Split into all-caps titles and bodies using the shared segmentation engine
     with open(output_path, 'w', encoding='utf-8') as output_file:
-
-        # First, write the first line of the file (preserved from the original file)
-        output_file.write(f"First Line: {first_line}\n\n")  # Save the first line as is
-
-        # Loop through all matches found in the input file based on the regular expression pattern
-        for match in title_body_pattern.finditer(newspaper_text):
-            # Capture the title and body from the matched text
-            title = match.group(1)  # Group 1: the title (in all caps)
-            body = match.group(2)   # Group 2: the body of the article
-
-            # Write the formatted article into the output file
-            output_file.write(f"====================================\n")  # Add a separator before each article
-            output_file.write(f"Title: {title}\n")  # Write the title
-            output_file.write(f"Body:\n{body}\n")   # Write the body
-            output_file.write(f"====================================\n\n")  # Add a separator after each article
+        output_file.write(refine_articles(newspaper_text))
 
     # Print a message to indicate that the file has been successfully processed and saved
     print(f"Preprocessing complete. Output saved to {output_path}")
 
 # Iterate over all files in the input directory
-for filename in os.listdir(input_directory):  # Loop through all the files in the input directory
-    # Only process files that end with ".txt"
-    if filename.lower().endswith(".txt"):
-        # Construct full file paths for the input and output files
-        input_file_path = os.path.join(input_directory, filename)  # Full path of the input file
-        output_file_path = os.path.join(output_directory, filename.replace("seg1", "seg2"))  # Full path of the output file with "seg1" replaced by "seg2"
-        
-        # Process the file and save the output
-        process_file(input_file_path, output_file_path)  # Call the process_file function for each file
+def process_all_files(workers=1, manifest_path=None, force=False):
+    tasks = []
+    for filename in os.listdir(input_directory):  # Loop through all the files in the input directory
+        # Only process files that end with ".txt"
+        if filename.lower().endswith(".txt"):
+            # Construct full file paths for the input and output files
+            input_file_path = os.path.join(input_directory, filename)  # Full path of the input file
+            output_file_path = os.path.join(output_directory, filename.replace("seg1", "seg2"))  # Full path of the output file with "seg1" replaced by "seg2"
+            tasks.append((input_file_path, output_file_path))
+
+    # Process new or changed files serially or across a process pool and record the run manifest
+    run_stage(process_file, tasks, workers, manifest_path or default_manifest_path(output_directory, "seg2"),
+              default_state_path(output_directory, "seg2"), force)
+
+# Main function
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stage 2: split stage 1 output into all-caps titles and bodies.")
+    add_run_arguments(parser)
+    args = parser.parse_args()
+
+    with profiling.session("seg2", args.profile, args.profile_batches):
+        process_all_files(args.workers, args.manifest, args.force)
@@ -1,41 +1,51 @@
 import os
+import io
 import re
+import json
+import time
+import argparse
 import psycopg2
-import configparser
 import logging
+import metrics
+import profiling
+import database
+from database import connect_db, copy_row, copy_buffer
 
 # Initialize logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Load settings from the ini file
-config = configparser.ConfigParser()
-config.read('settings.ini')
-
-# Database credentials
-db_host = config['database']['host']
-db_name = config['database']['database']
-db_user = config['database']['user']
-db_password = config['database']['password']
-db_port = config['database']['port']
-
 # Input directory for segmented articles
 input_directory = r"C:\Users\SeanOffice\Documents\Trinity Journal Segmented 3"
 
-# Function to connect to the PostgreSQL database
-def connect_db():
-    try:
-        conn = psycopg2.connect(
-            host=db_host,
-            database=db_name,
-            user=db_user,
-            password=db_password,
-            port=db_port
+# Number of files staged with COPY before each set-based merge into Articles (bulk mode)
+bulk_batch_files = 50
+
+# The merge of the staged rows into Articles on each storage backend (SQLite has no DISTINCT ON,
+# so it ranks the titles of an issue with a window function instead)
+MERGE_STAGED = {
+    "postgres": """
+        INSERT INTO Articles (newspaper_id, title, content, created_at)
+        SELECT DISTINCT ON (s.newspaper_id, LEFT(s.title, 255)) s.newspaper_id, LEFT(s.title, 255), s.content, NOW()
+        FROM article_staging s
+        WHERE NOT EXISTS (
+            SELECT 1 FROM Articles a WHERE a.newspaper_id = s.newspaper_id AND a.title = LEFT(s.title, 255)
         )
-        logging.info("[INFO] Connected to the database.")
-        return conn
-    except psycopg2.Error as e:
-        logging.error(f"[ERROR] Could not connect to the database: {e}")
-        return None
+        ORDER BY s.newspaper_id, LEFT(s.title, 255), s.ordinal;
+    """,
+    "sqlite": """
+        INSERT INTO Articles (newspaper_id, title, content, created_at)
+        SELECT s.newspaper_id, s.title, s.content, CURRENT_TIMESTAMP
+        FROM (
+            SELECT newspaper_id, substr(title, 1, 255) AS title, content,
+                ROW_NUMBER() OVER (PARTITION BY newspaper_id, substr(title, 1, 255) ORDER BY ordinal) AS rank
+            FROM article_staging
+        ) s
+        WHERE s.rank = 1 AND NOT EXISTS (
+            SELECT 1 FROM Articles a WHERE a.newspaper_id = s.newspaper_id AND a.title = s.title
+        )
+        ORDER BY s.newspaper_id, s.title;
+    """,
+}
 
 # Function to extract the publication date from the file name (or set a default if not found)
 def extract_publication_date(file_name):
@@ -48,51 +58,133 @@ def extract_publication_date(file_name):
         logging.warning(f"[WARNING] Could not parse date from file {file_name}. Defaulting to 'Unknown Date'.")
         return "Unknown Date"
 
-# Function to process a single file and insert articles into the database
-def process_file(file_path, conn, newspaper_id):
+# Function to read the issue record (date, TOC and hyperlink) that opens a .jsonl file from segmenter.py
+def read_issue_record(file_path):
+    with open(file_path, 'r', encoding='utf-8') as file:
+        for line in file:
+            if line.strip():
+                record = json.loads(line)
+                return record if record.get("type") == "issue" else None
+    return None
+
+# Function to stream (title, body) pairs from a .jsonl file written by segmenter.py, one record per line
+def iter_records(file_path):
+    with open(file_path, 'r', encoding='utf-8') as file:
+        for line in file:
+            if line.strip():
+                record = json.loads(line)
+                if record.get("type", "article") == "article":
+                    yield record["title"], record["body"]
+
+# Function to read (title, body) pairs from a Title:/Body: file written by 3_article_divider.py
+def iter_legacy_articles(file_path):
     with open(file_path, 'r', encoding='utf-8') as file:
         file_contents = file.read()
-    
-    cursor = conn.cursor()
 
     # Regex pattern to identify articles with title and body
     article_pattern = re.compile(r'Title:\s*(.*?)\s*Body:\s*(.*?)(?=\nTitle:|\Z)', re.DOTALL)
+    for match in article_pattern.finditer(file_contents):
+        yield match.group(1), match.group(2)
 
-    # Find all articles in the file
-    matches = article_pattern.findall(file_contents)
-    
-    # Check if there are valid articles in the file
-    if not matches:
-        logging.warning(f"[WARNING] No valid articles found in {file_path}. Skipping file.")
-        return
+# Function to stream the (title, body) pairs of a segmented file, ready to insert
+def iter_articles(file_path):
+    # JSON lines files are read as a stream; legacy text files still need the regex parse
+    if file_path.lower().endswith(".jsonl"):
+        matches = iter_records(file_path)
+    else:
+        matches = iter_legacy_articles(file_path)
 
-    # Process each article and insert into the database
+    found = False
     for match in matches:
+        found = True
         title = match[0].strip() if match[0].strip() != "" else "Untitled"
         body = match[1].strip()
 
         # Log missing or untitled articles
         if title == "Untitled":
             logging.warning(f"[WARNING] Missing title in file {file_path}. Defaulting to 'Untitled'.")
+        yield title, body
 
+    # Check if there were valid articles in the file
+    if not found:
+        logging.warning(f"[WARNING] No valid articles found in {file_path}. Skipping file.")
+
+# Function to process a single file and insert articles into the database, one row at a time
+def process_file(file_path, conn, newspaper_id):
+    cursor = conn.cursor()
+    inserted = 0
+
+    # Process each article and insert into the database
+    for title, body in iter_articles(file_path):
+        metrics.count("articles")
         # Insert article into the database, using ON CONFLICT to avoid duplicates
         try:
-            cursor.execute("""
-                INSERT INTO Articles (newspaper_id, title, content, created_at)
-                VALUES (%s, %s, %s, NOW())
-                ON CONFLICT (newspaper_id, title) DO NOTHING;
-            """, (newspaper_id, title, body))
-            conn.commit()
+            with metrics.timer("db_write_seconds"):
+                cursor.execute("""
+                    INSERT INTO Articles (newspaper_id, title, content, created_at)
+                    VALUES (%s, %s, %s, NOW())
+                    ON CONFLICT (newspaper_id, title) DO NOTHING;
+                """, (newspaper_id, title, body))
+                conn.commit()
+            inserted += cursor.rowcount
+            metrics.count("rows_written", cursor.rowcount)
             logging.info(f"[INFO] Article inserted with title: {title}")
 
         except psycopg2.Error as e:
+            metrics.count("errors")
             logging.error(f"[ERROR] Failed to insert article with title {title}: {e}")
             conn.rollback()
 
     cursor.close()
+    return inserted
+
+# Function to create the session's staging table for bulk loads (the merge probes the unique
+# index on Articles (newspaper_id, title) that DB_CREATOR2.py creates)
+def prepare_bulk_load(conn):
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            CREATE TEMP TABLE IF NOT EXISTS article_staging (
+                newspaper_id INTEGER,
+                ordinal INTEGER,
+                title TEXT,
+                content TEXT
+            );
+        """)
+    conn.commit()
+
+# Function to add one file's articles to the COPY buffer as tab-separated rows; returns the row count
+def stage_file(buffer, file_path, newspaper_id):
+    rows = 0
+    for ordinal, (title, body) in enumerate(iter_articles(file_path)):
+        buffer.write(copy_row((newspaper_id, ordinal, title, body)))
+        rows += 1
+    metrics.count("articles", rows)
+    return rows
 
-# Function to get the newspaper ID from the database, or create a new entry if it doesn't exist
-def get_newspaper_id(conn, file_name, publication_date):
+# Function to COPY the buffered rows into the staging table and merge them into Articles with one
+# set-based insert. The first article with a given title in an issue wins, and titles already in
+# Articles are left alone (the same result as the row-by-row ON CONFLICT DO NOTHING). Returns
+# the number of new articles, or None if the batch failed and was rolled back.
+def merge_staged(conn, buffer):
+    try:
+        with conn.cursor() as cursor:
+            copy_buffer(cursor, "article_staging", ("newspaper_id", "ordinal", "title", "content"), buffer)
+            with metrics.timer("db_write_seconds"):
+                cursor.execute(MERGE_STAGED[database.backend])
+            inserted = cursor.rowcount
+            cursor.execute("TRUNCATE article_staging;")
+        conn.commit()
+        metrics.count("rows_written", inserted)
+        return inserted
+    except psycopg2.Error as e:
+        metrics.count("errors")
+        logging.error(f"[ERROR] Bulk merge failed: {e}")
+        conn.rollback()
+        return None
+
+# Function to get the newspaper ID from the database, or create a new entry if it doesn't exist.
+# The TOC and hyperlink come from the same read of the issue as its articles (see segmenter.py).
+def get_newspaper_id(conn, file_name, publication_date, toc=None, hyperlink=None):
     cursor = conn.cursor()
 
     try:
@@ -105,12 +197,20 @@ def get_newspaper_id(conn, file_name, publication_date):
         if result:
             newspaper_id = result[0]
             logging.info(f"[INFO] Found existing newspaper entry with ID {newspaper_id}.")
+
+            # Fill in the TOC and hyperlink of entries loaded before they were extracted
+            if toc or hyperlink:
+                cursor.execute("""
+                    UPDATE Newspapers SET toc = COALESCE(%s, toc), hyperlink = COALESCE(%s, hyperlink), updated_at = NOW()
+                    WHERE newspaper_id = %s;
+                """, (toc, hyperlink, newspaper_id))
+                conn.commit()
         else:
             # Insert a new newspaper record
             cursor.execute("""
-                INSERT INTO Newspapers (title, publication_date, created_at)
-                VALUES (%s, %s, NOW()) RETURNING newspaper_id;
-            """, (file_name, publication_date))
+                INSERT INTO Newspapers (title, publication_date, toc, hyperlink, created_at)
+                VALUES (%s, %s, %s, %s, NOW()) RETURNING newspaper_id;
+            """, (file_name, publication_date, toc, hyperlink))
             newspaper_id = cursor.fetchone()[0]
             conn.commit()
             logging.info(f"[INFO] Inserted new newspaper entry with ID {newspaper_id}.")
@@ -123,35 +223,104 @@ def get_newspaper_id(conn, file_name, publication_date):
     cursor.close()
     return newspaper_id
 
-# Main function to iterate over files and process them
-def process_all_files():
+# Main function to iterate over files and process them. In bulk mode the articles of
+# batch_files files are staged with COPY and merged in one statement and one commit;
+# otherwise every article is inserted and committed on its own. Returns True if every file was
+# loaded (see pipeline.py).
+@metrics.instrumented("load")
+def process_all_files(bulk=True, batch_files=bulk_batch_files):
     # Connect to the database
     conn = connect_db()
     if conn is None:
         logging.error("[ERROR] Could not establish a database connection. Exiting.")
-        return
+        return False
+    if bulk:
+        prepare_bulk_load(conn)
 
-    # Loop through all text files in the input directory
-    for file_name in os.listdir(input_directory):
-        if file_name.lower().endswith(".txt"):
-            file_path = os.path.join(input_directory, file_name)
-            
-            logging.info(f"[INFO] Processing file: {file_name}")
+    start = time.time()
+    rows = 0
+    inserted = 0
+    buffer = io.StringIO()
+    batch = []
+    skipped = 0
 
-            # Extract publication date from file name (or set a default)
+    # Function to merge the staged batch; a failed batch is retried row by row so that one
+    # bad article only loses itself, as in the row-by-row mode
+    def flush_batch():
+        nonlocal buffer, batch, inserted
+        merged = merge_staged(conn, buffer)
+        if merged is None:
+            logging.warning(f"[WARNING] Loading the {len(batch)} files of the failed batch row by row.")
+            merged = sum(process_file(file_path, conn, newspaper_id) for file_path, newspaper_id in batch)
+        inserted += merged
+        buffer = io.StringIO()
+        batch = []
+
+    # Loop through all segmented files in the input directory; a .jsonl file replaces a
+    # legacy .txt file of the same issue
+    file_names = [name for name in os.listdir(input_directory) if name.lower().endswith((".txt", ".jsonl"))]
+    jsonl_issues = {os.path.splitext(name)[0] for name in file_names if name.lower().endswith(".jsonl")}
+    for file_name in profiling.sample(file_names):
+        if file_name.lower().endswith(".txt") and os.path.splitext(file_name)[0] in jsonl_issues:
+            continue
+        file_path = os.path.join(input_directory, file_name)
+
+        logging.info(f"[INFO] Processing file: {file_name}")
+
+        # The issue record of a .jsonl file carries the parsed date, TOC and hyperlink;
+        # otherwise extract the publication date from the file name (or set a default)
+        issue_record = read_issue_record(file_path) if file_name.lower().endswith(".jsonl") else None
+        if issue_record and issue_record.get("date"):
+            publication_date = issue_record["date"]
+        else:
             publication_date = extract_publication_date(file_name)
+        toc = issue_record.get("toc") if issue_record else None
+        hyperlink = issue_record.get("hyperlink") if issue_record else None
+
+        # Get or create the newspaper entry and retrieve its ID; issues are registered under
+        # their .txt name whatever the format, so reloading an issue finds its existing entry
+        newspaper_title = os.path.splitext(file_name)[0] + ".txt"
+        newspaper_id = get_newspaper_id(conn, newspaper_title, publication_date, toc, hyperlink)
 
-            # Get or create the newspaper entry and retrieve its ID
-            newspaper_id = get_newspaper_id(conn, file_name, publication_date)
+        if not newspaper_id:
+            skipped += 1
+            continue
 
-            if newspaper_id:
-                # Process the file and insert its articles into the database
-                process_file(file_path, conn, newspaper_id)
+        if bulk:
+            # Stage the file's articles and merge once enough files are buffered
+            rows += stage_file(buffer, file_path, newspaper_id)
+            batch.append((file_path, newspaper_id))
+            if len(batch) >= batch_files:
+                flush_batch()
+        else:
+            # Process the file and insert its articles into the database
+            inserted += process_file(file_path, conn, newspaper_id)
+
+    # Merge the last partial batch
+    if bulk and batch:
+        flush_batch()
+
+    elapsed = max(time.time() - start, 1e-9)
+    if bulk:
+        logging.info(f"[INFO] Staged {rows} articles in {elapsed:.1f} s ({rows / elapsed:.0f} rows/s), {inserted} new.")
+    else:
+        logging.info(f"[INFO] Inserted {inserted} articles in {elapsed:.1f} s ({inserted / elapsed:.0f} rows/s).")
 
     # Close the database connection after processing all files
     conn.close()
+    if skipped:
+        logging.error(f"[ERROR] {skipped} files were not loaded: their newspaper entry could not be created.")
+        return False
     logging.info("[INFO] All files processed and database connection closed.")
+    return True
 
 # Run the script
 if __name__ == "__main__":
-    process_all_files()
+    parser = argparse.ArgumentParser(description="Load segmented articles into the Articles and Newspapers tables.")
+    parser.add_argument("--row-by-row", action="store_true", help="Insert and commit every article on its own instead of bulk COPY")
+    parser.add_argument("--batch-files", type=int, default=bulk_batch_files, help="Files staged per set-based merge in bulk mode")
+    profiling.add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    with profiling.session("load", args.profile, args.profile_batches):
+        process_all_files(not args.row_by_row, args.batch_files)
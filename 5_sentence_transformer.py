@@ -1,10 +1,21 @@
-from sentence_transformers import SentenceTransformer
+from models import get_sentence_transformer
 import psycopg2
 import numpy as np
-import configparser
 import logging
 import torch
 import os
+import argparse
+import functools
+import metrics
+import profiling
+import tuning
+import passages
+import embedding_cache
+import vectors
+import encoder_pool
+from checkpoints import run_checkpointed, with_dead_letters
+from database import connect_db, write_values, iter_keyset, run_transaction
+from job_queue import run_worker, run_workers
 
 os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE"
 
@@ -14,91 +25,297 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 # Check if CUDA is available and set device
 device = 0 if torch.cuda.is_available() else -1  # 0 for GPU, -1 for CPU
 
-# Load settings from the ini file
-config = configparser.ConfigParser()
-config.read('settings.ini')
+# This host's tuned torch threads and batch size (see tuning.py), set before the model loads
+tuning.apply_threads("embeddings")
+BATCH_SIZE = tuning.batch_size("embeddings")
 
-# Access database settings from settings.ini
-db_host = config['database']['host']
-db_name = config['database']['database']
-db_user = config['database']['user']
-db_password = config['database']['password']
-db_port = config['database']['port']
+# Initialize the sentence transformer model (its name is the model version of the checkpoints)
+MODEL_NAME = 'sentence-transformers/gtr-t5-large'
+model = get_sentence_transformer(MODEL_NAME)
 
-# Connect to PostgreSQL database
-def connect_db():
-    try:
-        conn = psycopg2.connect(
-            host=db_host,
-            database=db_name,
-            user=db_user,
-            password=db_password,
-            port=db_port
-        )
-        logging.info("[INFO] Connected to the database.")
-        return conn
-    except psycopg2.Error as e:
-        logging.error(f"[ERROR] Could not connect to the database: {e}")
-        return None
-
-# Initialize the sentence transformer model
-model = SentenceTransformer('sentence-transformers/gtr-t5-large')
-
-# Generator function to yield batches of articles
-def article_batch_generator(cursor, batch_size=100):
-    offset = 0
-    while True:
-        cursor.execute("""
-            SELECT article_id, content FROM articles 
-            WHERE embedding_vector IS NULL 
-            ORDER BY article_id 
-            LIMIT %s OFFSET %s
-        """, (batch_size, offset))
-        results = cursor.fetchall()
-        if not results:
-            break
-        yield results
-        offset += batch_size
-
-# Embedding articles in batches and storing in two formats
-def process_articles_in_batches(batch_size=100):
-    conn = connect_db()
-    if not conn:
-        return
+# Padded tokens per forward pass: the articles of a batch are sorted by token length and run in
+# sub-batches of similar length that fit this budget, so a long article no longer pads out a
+# whole batch of short ones. The batch size is the number of articles fetched and committed.
+TOKEN_BUDGET = 8192
 
-    cursor = conn.cursor()
+# Articles to embed: those without an embedding (passage mode also takes those without passages
+# of its model version, see passage_articles)
+WHOLE_ARTICLES = "embedding_vector IS NULL"
 
+# Generator function to yield batches of articles that have no embedding yet (keyset-paginated,
+# so articles embedded by earlier batches cannot shift later batches past unembedded ones)
+def article_batch_generator(cursor, batch_size=100, after=None, where=WHOLE_ARTICLES):
+    yield from iter_keyset(cursor, "SELECT article_id, content FROM articles", "article_id",
+                           where=where, batch_size=batch_size, after=after)
+
+# Function to count the special tokens the tokenizer adds to every text
+def special_tokens():
+    try:
+        return model.tokenizer.num_special_tokens_to_add()
+    except Exception:
+        return 0
+
+# Function to count the model input tokens of each text (special tokens included, truncated to
+# what the model reads). The untruncated counts also go to the metrics, since this stage tokenizes
+# for its batching anyway (no second pass as in metrics.count_tokens).
+def token_lengths(texts):
     try:
-        for batch in article_batch_generator(cursor, batch_size):
-            articles = [article[1] for article in batch]
-            article_ids = [article[0] for article in batch]
+        lengths = [len(ids) for ids in model.tokenizer(texts, add_special_tokens=False)["input_ids"]]
+        special = special_tokens()
+    except Exception:
+        lengths = [len(text.split()) for text in texts]
+        special = 0
+    metrics.count("tokens", sum(lengths))
+    return [min(length + special, model.max_seq_length) for length in lengths]
+
+# Function to split texts into sub-batches of similar length under a token budget: the texts are
+# sorted by length, and a sub-batch grows while its size times its longest text (what it costs
+# once padded) fits the budget. Returns lists of indexes into texts.
+def plan_token_batches(lengths, token_budget=TOKEN_BUDGET):
+    batches = []
+    current = []
+    for index in sorted(range(len(lengths)), key=lambda index: lengths[index]):
+        # Sorted ascending, so the new text is the longest of the sub-batch
+        if current and (len(current) + 1) * max(lengths[index], 1) > token_budget:
+            batches.append(current)
+            current = []
+        current.append(index)
+    if current:
+        batches.append(current)
+    return batches
+
+# Function to embed texts in token-budgeted sub-batches; returns the embeddings in input order.
+# Pass the token lengths when they are already known (the caller then counts the tokens).
+def encode_by_token_budget(texts, token_budget=TOKEN_BUDGET, lengths=None):
+    if lengths is None:
+        lengths = token_lengths(texts)
+    embeddings = None
+    for indexes in plan_token_batches(lengths, token_budget):
+        longest = max(lengths[index] for index in indexes)
+        metrics.count("padding_tokens", sum(longest - lengths[index] for index in indexes))
+        with metrics.timer("model_batch_seconds"):
+            encoded = model.encode([texts[index] for index in indexes], batch_size=len(indexes), convert_to_numpy=True)
+        if embeddings is None:
+            embeddings = np.empty((len(texts), encoded.shape[1]), dtype=encoded.dtype)
+        # Back to the order of the input
+        embeddings[indexes] = encoded
+    return embeddings
+
+# Function to embed texts through the embedding cache (see embedding_cache.py): only the texts
+# not cached for this model go to the model, in token-budgeted sub-batches
+def encode_texts(texts, token_budget=TOKEN_BUDGET, lengths=None):
+    if lengths is None:
+        lengths = token_lengths(texts)
+    return embedding_cache.encode_cached(
+        MODEL_NAME, texts,
+        lambda indexes: encode_by_token_budget([texts[index] for index in indexes], token_budget, [lengths[index] for index in indexes]))
+
+# Update the embeddings of a batch of articles with one statement, in the compact vector column
+# (see vectors.py; the NUMERIC[] copy of older runs is cleared)
+def write_article_embeddings(cursor, article_ids, embeddings):
+    rows = [(article_id,) + packed for article_id, packed in zip(article_ids, vectors.pack_vectors(embeddings))]
+    write_values(cursor, """
+        UPDATE articles
+        SET embedding_vector = batch.embedding_vector, embedding_dtype = batch.embedding_dtype, embedding_vector_array = NULL
+        FROM (VALUES %s) AS batch (article_id, embedding_vector, embedding_dtype)
+        WHERE articles.article_id = batch.article_id;
+    """, rows, template="(%s::integer, %s::bytea, %s)")
+
+# Function to embed a batch of (article_id, content) rows; returns {article_id: vector}
+def encode_articles(batch, token_budget=TOKEN_BUDGET):
+    articles = [article[1] or '' for article in batch]
+
+    # Embed the batch (the articles not cached), in sub-batches of similar length
+    embeddings = encode_texts(articles, token_budget)
+    return {article[0]: embedding for article, embedding in zip(batch, embeddings)}
+
+# Function to store the embeddings of a batch of rows (see encode_articles)
+def store_articles(cursor, batch, encoded):
+    article_ids = [article[0] for article in batch]
+    metrics.count("articles", len(batch))
+    write_article_embeddings(cursor, article_ids, [encoded[article_id] for article_id in article_ids])
+
+# Embed a batch of (article_id, content) rows and store the embeddings
+def embed_batch(cursor, batch, token_budget=TOKEN_BUDGET):
+    store_articles(cursor, batch, encode_articles(batch, token_budget))
+
+# Function to name the model version of passage mode, so a change of passage size or overlap
+# starts the stage over (see checkpoints.py)
+def passage_model_version(passage_tokens, passage_overlap):
+    return f"{MODEL_NAME}:passages-{passage_tokens}-{passage_overlap}"
 
-            # Embed the batch
-            embeddings = model.encode(articles, convert_to_numpy=True)
+# Function to build the filter of the articles passage mode still has to embed (a literal, since
+# the job queue takes the filter as plain SQL)
+def passage_articles(model_version):
+    version = model_version.replace("'", "''")
+    return ("embedding_vector IS NULL OR NOT EXISTS (SELECT 1 FROM passages p "
+            f"WHERE p.article_id = articles.article_id AND p.model_version = '{version}')")
 
-            # Insert/update embeddings into the database
-            for article_id, embedding_vector in zip(article_ids, embeddings):
-                embedding_binary = embedding_vector.tobytes()
-                embedding_array = embedding_vector.tolist()
+# Function to embed a batch of (article_id, content) rows passage by passage; returns
+# {article_id: (passage rows, passage vectors, article vector pooled from them)}
+def encode_passages(batch, token_budget=TOKEN_BUDGET, passage_tokens=None, passage_overlap=None):
+    passage_tokens = passages.passage_tokens if passage_tokens is None else passage_tokens
+    passage_overlap = passages.passage_overlap if passage_overlap is None else passage_overlap
+    special = special_tokens()
+    # A passage must fit the model, or its end would be truncated away
+    size = min(passage_tokens, model.max_seq_length - special)
+    model_version = passage_model_version(passage_tokens, passage_overlap)
 
-                cursor.execute("""
-                    UPDATE articles 
-                    SET embedding_vector = %s, embedding_vector_array = %s 
-                    WHERE article_id = %s;
-                """, (psycopg2.Binary(embedding_binary), embedding_array, article_id))
+    texts = []
+    lengths = []
+    spans = []
+    rows = []
+    for article_id, content in batch:
+        content = content or ''
+        first = len(rows)
+        for index, (start, end, tokens) in enumerate(passages.split_passages(content, model.tokenizer, size, passage_overlap)):
+            texts.append(content[start:end])
+            lengths.append(tokens + special)
+            rows.append((article_id, index, start, end, tokens, model_version))
+        spans.append((article_id, first, len(rows)))
+    metrics.count("tokens", sum(row[4] for row in rows))
 
-            conn.commit()
-            logging.info(f"[INFO] Processed and updated {len(batch)} articles.")
+    # Every passage of the batch not cached goes through the same length-sorted sub-batches
+    embeddings = encode_texts(texts, token_budget, lengths)
+
+    token_counts = np.array([row[4] for row in rows])
+    return {article_id: (rows[first:last], embeddings[first:last],
+                         passages.pool_passages(embeddings[first:last], token_counts[first:last]))
+            for article_id, first, last in spans}
+
+# Function to store the passages and pooled vectors of a batch of rows (see encode_passages)
+def store_passages(cursor, batch, encoded):
+    article_ids = [article[0] for article in batch]
+    metrics.count("articles", len(batch))
+    rows = [row for article_id in article_ids for row in encoded[article_id][0]]
+    embeddings = np.concatenate([encoded[article_id][1] for article_id in article_ids])
+    passages.write_passages(cursor, article_ids, [row + packed for row, packed in zip(rows, vectors.pack_vectors(embeddings))])
+    write_article_embeddings(cursor, article_ids, [encoded[article_id][2] for article_id in article_ids])
+
+# Embed a batch of (article_id, content) rows passage by passage: store every passage with its
+# vector, and each article's vector pooled from its passages
+def embed_passages(cursor, batch, token_budget=TOKEN_BUDGET, passage_tokens=None, passage_overlap=None):
+    store_passages(cursor, batch, encode_passages(batch, token_budget, passage_tokens, passage_overlap))
+
+# Function to pick the stage name, model version, article filter, and encode(rows) and
+# store(cursor, rows, encoded) functions of a mode (passage mode has its own checkpoint and
+# queue, so it revisits articles embedded whole)
+def embedding_mode(token_budget, passage_tokens=None, passage_overlap=None):
+    if passage_tokens is None:
+        run_transaction(vectors.ensure_vector_columns)
+        return "embeddings", MODEL_NAME, WHOLE_ARTICLES, functools.partial(encode_articles, token_budget=token_budget), store_articles
+    if not 0 <= passage_overlap < passage_tokens:
+        raise ValueError(f"passage overlap {passage_overlap} must be at least 0 and less than the passage size {passage_tokens}")
+    run_transaction(passages.ensure_passages_table)
+    run_transaction(vectors.ensure_vector_columns)
+    model_version = passage_model_version(passage_tokens, passage_overlap)
+    return ("passages", model_version, passage_articles(model_version),
+            functools.partial(encode_passages, token_budget=token_budget, passage_tokens=passage_tokens, passage_overlap=passage_overlap),
+            store_passages)
+
+# Function to encode and store a batch in this process
+def encode_and_store(encode, store, cursor, batch):
+    store(cursor, batch, encode(batch))
+
+# Function to run a mode's encoding in a pool of encoder processes (see encoder_pool.py). Returns
+# the batches(cursor, after) and process(cursor, rows) of run_checkpointed: the batches are
+# read and encoded ahead, and each is written here when its turn comes. Articles the encoders
+# could not embed fail with their error, so they are dead-lettered as without the pool.
+def pooled_embedding(encode, store, batch_size, where, encoders, encoder_threads=None):
+    encoded = {}
+    errors = {}
+
+    def batches(cursor, after):
+        for rows, batch_encoded, batch_errors in encoder_pool.run_pool(
+                "embeddings", encode, article_batch_generator(cursor, batch_size, after, where), encoders, encoder_threads):
+            # Only the results of the batch being written are kept
+            encoded.clear()
+            encoded.update(batch_encoded)
+            errors.clear()
+            errors.update(batch_errors)
+            yield rows
+
+    def store_encoded(cursor, rows):
+        for article_id, _ in rows:
+            if article_id in errors:
+                raise encoder_pool.EncodeError(errors[article_id])
+        store(cursor, rows, encoded)
+    return batches, store_encoded
+
+# Embedding articles in batches and storing them. Every batch is committed with the
+# stage's checkpoint, so a run that stops resumes after its last batch (see checkpoints.py).
+# Set passage_tokens to embed passages and pool them (see passages.py), and encoders above 1 to
+# encode in that many processes while this one writes (see encoder_pool.py). Returns True if the
+# run completed (see pipeline.py).
+@metrics.instrumented("embeddings")
+def process_articles_in_batches(batch_size=BATCH_SIZE, restart=False, token_budget=TOKEN_BUDGET,
+                                passage_tokens=None, passage_overlap=passages.passage_overlap,
+                                encoders=1, encoder_threads=None):
+    conn = connect_db()
+    if not conn:
+        return False
+
+    try:
+        stage, model_version, where, encode, store = embedding_mode(token_budget, passage_tokens, passage_overlap)
+        if encoders > 1:
+            batches, process = pooled_embedding(encode, store, batch_size, where, encoders, encoder_threads)
+        else:
+            batches = lambda cursor, after: article_batch_generator(cursor, batch_size, after, where)
+            process = functools.partial(encode_and_store, encode, store)
+        done, dead = run_checkpointed(
+            conn, stage, model_version,
+            lambda cursor, after: profiling.sample(batches(cursor, after)),
+            process, restart)
+        logging.info(f"[INFO] Embedded {done} articles, {dead} dead-lettered.")
+        return True
 
     except psycopg2.Error as e:
-        logging.error(f"[ERROR] Database error occurred: {e}")
+        metrics.count("errors")
+        logging.error(f"[ERROR] Database error occurred: {e}. The batches committed so far are kept; rerun to resume.")
         conn.rollback()  # Roll back on error
+        return False
 
     finally:
-        cursor.close()
         conn.close()
         logging.info("[INFO] Database connection closed.")
 
+# Embed articles as a job-queue worker (see job_queue.py); any number of workers can run at once
+@metrics.instrumented("embeddings", per_process=True)
+def run_queue_worker(batch_size=BATCH_SIZE, token_budget=TOKEN_BUDGET, passage_tokens=None, passage_overlap=passages.passage_overlap):
+    stage, model_version, where, encode, store = embedding_mode(token_budget, passage_tokens, passage_overlap)
+    run_worker(stage, "SELECT article_id, content FROM articles WHERE article_id = ANY(%s)",
+               with_dead_letters(stage, model_version, functools.partial(encode_and_store, encode, store)), batch_size, where=where)
+
 # Call the function with the desired batch size
 if __name__ == "__main__":
-    process_articles_in_batches(batch_size=100)
+    parser = argparse.ArgumentParser(description="Embed articles with a sentence transformer.")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="Articles fetched and committed per batch (default: this host's tuned size, or 100)")
+    parser.add_argument("--token-budget", type=int, default=TOKEN_BUDGET, help="Padded tokens per forward pass; each batch runs in length-sorted sub-batches under it")
+    parser.add_argument("--passages", action="store_true", help="Embed overlapping passages into the passages table and pool them into the article vectors")
+    parser.add_argument("--passage-tokens", type=int, default=passages.passage_tokens, help="Tokens per passage (with --passages)")
+    parser.add_argument("--passage-overlap", type=int, default=passages.passage_overlap, help="Tokens shared by consecutive passages (with --passages)")
+    parser.add_argument("--queue", action="store_true", help="Claim batches from the article_jobs queue, so several workers can share the stage")
+    parser.add_argument("--workers", type=int, default=1, help="Queue worker processes to start on this machine (with --queue)")
+    parser.add_argument("--encoders", type=int, default=1, help="Encoder processes, each loading the model on its own share of the cores; this process reads and writes the batches (not with --queue)")
+    parser.add_argument("--encoder-threads", type=int, default=None, help="Torch threads (and pinned cores) per encoder process (default: the cores divided among the encoders)")
+    parser.add_argument("--restart", action="store_true", help="Ignore the stage's checkpoint and start from the first article")
+    parser.add_argument("--no-cache", action="store_true", help="Encode every text, without reading or filling the embedding cache")
+    profiling.add_profile_arguments(parser)
+    args = parser.parse_args()
+    if args.no_cache:
+        embedding_cache.enabled = False
+    if args.passages and not 0 <= args.passage_overlap < args.passage_tokens:
+        parser.error("--passage-overlap must be at least 0 and less than --passage-tokens")
+    if args.encoders < 1 or (args.encoder_threads is not None and args.encoder_threads < 1):
+        parser.error("--encoders and --encoder-threads must be at least 1")
+    if args.queue and args.encoders > 1:
+        parser.error("--encoders runs with the stage's checkpoint; use --workers with --queue")
+    passage_tokens = args.passage_tokens if args.passages else None
+
+    with profiling.session("embeddings", args.profile, args.profile_batches):
+        if args.queue:
+            run_workers(functools.partial(run_queue_worker, args.batch_size, args.token_budget, passage_tokens, args.passage_overlap), args.workers)
+        else:
+            process_articles_in_batches(batch_size=args.batch_size, restart=args.restart, token_budget=args.token_budget,
+                                        passage_tokens=passage_tokens, passage_overlap=args.passage_overlap,
+                                        encoders=args.encoders, encoder_threads=args.encoder_threads)
@@ -1,78 +1,52 @@
 import psycopg2
-from transformers import pipeline
+from models import NER_MODEL, get_ner_pipeline
 import logging
-import configparser
 from tqdm import tqdm  # For tracking progress
 import torch
+import argparse
+import functools
+import metrics
+import profiling
+import tuning
+from checkpoints import run_checkpointed, with_dead_letters
+from database import connect_db, write_values, iter_keyset
+from job_queue import run_worker, run_workers
 
 # Check if CUDA is available and set device
 device = 0 if torch.cuda.is_available() else -1  # 0 for GPU, -1 for CPU
+
+# This host's tuned torch threads and batch size (see tuning.py), set before the model loads
+tuning.apply_threads("ner")
+BATCH_SIZE = tuning.batch_size("ner")
 print(f"Using device: {'GPU' if device == 0 else 'CPU'}")
 # Initialize logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Load a pretrained NER pipeline from Hugging Face and specify the device
-nlp = pipeline("ner", model="dbmdz/bert-large-cased-finetuned-conll03-english", device=device)
-
-
-# Load NER model (using a larger model may require GPU resources)
+# Load NER model (using a larger model may require GPU resources); shared with 11_ (see models.py)
 def load_ner_model():
-    return pipeline("ner", model="dbmdz/bert-large-cased-finetuned-conll03-english", grouped_entities=True)
-
-# Load settings from the ini file
-config = configparser.ConfigParser()
-config.read('settings.ini')
-
-# Database credentials
-db_host = config['database']['host']
-db_name = config['database']['database']
-db_user = config['database']['user']
-db_password = config['database']['password']
-db_port = config['database']['port']
+    return get_ner_pipeline()
 
-# Connect to PostgreSQL database
-def connect_db():
-    try:
-        conn = psycopg2.connect(
-            host=db_host,
-            database=db_name,
-            user=db_user,
-            password=db_password,
-            port=db_port
-        )
-        logging.info("[INFO] Connected to the database.")
-        return conn
-    except psycopg2.Error as e:
-        logging.error(f"[ERROR] Could not connect to the database: {e}")
-        return None
+# Load the model when the stage is imported, as before (pipeline.py --warm); later calls reuse it
+load_ner_model()
 
-# Fetch articles from the database
-def fetch_articles(cursor, batch_size=100, offset=0):
-    cursor.execute("SELECT article_id, content FROM articles LIMIT %s OFFSET %s", (batch_size, offset))
-    return cursor.fetchall()
+# Fetch articles from the database, batch by batch in article_id order (after resumes after an article)
+def fetch_articles(cursor, batch_size=100, after=None):
+    return iter_keyset(cursor, "SELECT article_id, content FROM articles", "article_id", batch_size=batch_size, after=after)
 
-# Insert entities into the database in bulk
+# Insert entities into the database in bulk (multi-row INSERT statements)
 def insert_entities(cursor, entity_data):
     query = """
         INSERT INTO entities (article_id, entity_type, entity_value, start_pos, end_pos)
-        VALUES (%s, %s, %s, %s, %s)
+        VALUES %s
         ON CONFLICT (article_id, entity_type, entity_value, start_pos, end_pos) DO NOTHING;
-
         """
-    cursor.executemany(query, entity_data)
+    write_values(cursor, query, entity_data)
 
-# Batch NER processing
-def process_ner_in_batches(cursor, ner_model, batch_size=100):
-    offset = 0
-    total_articles = 0
+# Run NER over a batch of (article_id, content) rows; returns the entity rows to insert
+def extract_entities(ner_model, articles):
     entity_data = []
-    
-    while True:
-        articles = fetch_articles(cursor, batch_size, offset)
-        if not articles:
-            break  # Stop when no more articles are fetched
-
-        # Process each article in the batch
+    metrics.count_tokens([content for _, content in articles], ner_model.tokenizer)
+    with metrics.timer("model_batch_seconds"):
         for article_id, content in articles:
             entities = ner_model(content)
             for entity in entities:
@@ -81,40 +55,65 @@ def process_ner_in_batches(cursor, ner_model, batch_size=100):
                 start_pos = entity['start']
                 end_pos = entity['end']
                 entity_data.append((article_id, entity_type, entity_value, start_pos, end_pos))
-
-            total_articles += 1
-            if len(entity_data) >= batch_size:
-                insert_entities(cursor, entity_data)
-                entity_data = []  # Reset after inserting
-
-        logging.info(f"[INFO] Processed {total_articles} articles.")
-        offset += batch_size
-
-    # Insert any remaining entity data
-    if entity_data:
-        insert_entities(cursor, entity_data)
-
-    logging.info("[INFO] NER processing completed.")
-
-# Main NER pipeline
-def run_ner_pipeline(batch_size=100):
+    metrics.count("articles", len(articles))
+    return entity_data
+
+# Run NER over a batch of articles and insert their entities
+def tag_articles(cursor, ner_model, articles):
+    insert_entities(cursor, extract_entities(ner_model, articles))
+
+# Batch NER processing. Every batch's entities are committed with the stage's checkpoint, so a
+# run that stops resumes after its last batch (see checkpoints.py)
+def process_ner_in_batches(conn, ner_model, batch_size=100, restart=False):
+    total_articles, dead = run_checkpointed(
+        conn, "ner", NER_MODEL,
+        lambda cursor, after: profiling.sample(fetch_articles(cursor, batch_size, after)),
+        lambda cursor, articles: tag_articles(cursor, ner_model, articles), restart)
+
+    logging.info(f"[INFO] NER processing completed: {total_articles} articles, {dead} dead-lettered.")
+
+# Main NER pipeline; returns True if it completed (see pipeline.py)
+@metrics.instrumented("ner")
+def run_ner_pipeline(batch_size=BATCH_SIZE, restart=False):
     logging.info("[INFO] Starting the NER pipeline...")
 
     conn = connect_db()
     if conn is None:
-        return
+        return False
 
-    cursor = conn.cursor()
     ner_model = load_ner_model()
 
-    process_ner_in_batches(cursor, ner_model, batch_size=batch_size)
-
-    # Commit all changes and close the connection
-    conn.commit()
-    cursor.close()
-    conn.close()
+    try:
+        process_ner_in_batches(conn, ner_model, batch_size=batch_size, restart=restart)
+    except psycopg2.Error as e:
+        metrics.count("errors")
+        logging.error(f"[ERROR] Database error occurred: {e}. The batches committed so far are kept; rerun to resume.")
+        conn.rollback()
+        return False
+    finally:
+        conn.close()
     logging.info("[INFO] NER pipeline completed successfully.")
+    return True
+
+# Run NER as a job-queue worker (see job_queue.py); any number of workers can run at once
+@metrics.instrumented("ner", per_process=True)
+def run_queue_worker(batch_size=BATCH_SIZE):
+    ner_model = load_ner_model()
+    run_worker("ner", "SELECT article_id, content FROM articles WHERE article_id = ANY(%s)",
+               with_dead_letters("ner", NER_MODEL, lambda cursor, articles: tag_articles(cursor, ner_model, articles)), batch_size)
 
 # Execute the NER pipeline
 if __name__ == "__main__":
-    run_ner_pipeline(batch_size=100)
+    parser = argparse.ArgumentParser(description="Extract named entities from articles into the entities table.")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="Articles per batch (default: this host's tuned size, or 100)")
+    parser.add_argument("--queue", action="store_true", help="Claim batches from the article_jobs queue, so several workers can share the stage")
+    parser.add_argument("--workers", type=int, default=1, help="Queue worker processes to start on this machine (with --queue)")
+    parser.add_argument("--restart", action="store_true", help="Ignore the stage's checkpoint and start from the first article")
+    profiling.add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    with profiling.session("ner", args.profile, args.profile_batches):
+        if args.queue:
+            run_workers(functools.partial(run_queue_worker, args.batch_size), args.workers)
+        else:
+            run_ner_pipeline(batch_size=args.batch_size, restart=args.restart)
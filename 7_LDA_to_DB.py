@@ -5,8 +5,11 @@ from nltk.stem import WordNetLemmatizer
 from gensim import corpora
 from gensim.models import Phrases
 from gensim.models.ldamodel import LdaModel
-import configparser
 import logging
+import argparse
+import metrics
+import profiling
+from database import connect_db, iter_keyset
 
 # Initialize logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -20,36 +23,9 @@ nltk.download('omw-1.4')
 stop_words = set(stopwords.words('english'))
 lemmatizer = WordNetLemmatizer()
 
-# Load settings from the ini file
-config = configparser.ConfigParser()
-config.read('settings.ini')
-
-db_host = config['database']['host']
-db_name = config['database']['database']
-db_user = config['database']['user']
-db_password = config['database']['password']
-db_port = config['database']['port']
-
-# Connect to PostgreSQL database
-def connect_db():
-    try:
-        conn = psycopg2.connect(
-            host=db_host,
-            database=db_name,
-            user=db_user,
-            password=db_password,
-            port=db_port
-        )
-        logging.info("[INFO] Connected to the database.")
-        return conn
-    except psycopg2.Error as e:
-        logging.error(f"[ERROR] Could not connect to the database: {e}")
-        return None
-
-# Fetch articles from the database
-def fetch_articles(cursor, batch_size=100, offset=0):
-    cursor.execute("SELECT article_id, content FROM articles LIMIT %s OFFSET %s", (batch_size, offset))
-    return cursor.fetchall()
+# Fetch articles from the database, batch by batch in article_id order
+def fetch_articles(cursor, batch_size=100):
+    return iter_keyset(cursor, "SELECT article_id, content FROM articles", "article_id", batch_size=batch_size)
 
 # Preprocess text: tokenize, remove stop words, and lemmatize
 def preprocess_text(text):
@@ -58,21 +34,17 @@ def preprocess_text(text):
 
 # Preprocess all articles for LDA
 def preprocess_articles(cursor):
-    offset = 0
     batch_size = 100  # Batch size for fetching articles
     processed_texts = []
 
-    while True:
-        articles = fetch_articles(cursor, batch_size, offset)
-        if not articles:
-            break  # Stop when no more articles are fetched
-
+    for articles in profiling.sample(fetch_articles(cursor, batch_size)):
         for article_id, content in articles:
             tokens = preprocess_text(content)
             processed_texts.append((article_id, tokens))
+            metrics.count("tokens", len(tokens))
+        metrics.count("articles", len(articles))
 
-        offset += batch_size
-        logging.info(f"[INFO] Preprocessed {offset} articles.")
+        logging.info(f"[INFO] Preprocessed {len(processed_texts)} articles.")
 
     return processed_texts
 
@@ -108,11 +80,12 @@ def create_dictionary_and_corpus(processed_texts):
 # Train LDA Model
 def train_lda_model(corpus, dictionary, num_topics=20, passes=15):
     logging.info(f"[INFO] Training LDA model with {num_topics} topics...")
-    lda_model = LdaModel(corpus, num_topics=num_topics, id2word=dictionary, passes=passes)
+    with metrics.timer("model_batch_seconds"):
+        lda_model = LdaModel(corpus, num_topics=num_topics, id2word=dictionary, passes=passes)
     logging.info("[INFO] LDA model training complete.")
     return lda_model
 
-# Store LDA topics and article-topic relationships in the database
+# Store LDA topics and article-topic relationships in the database; returns False if they were rolled back
 def store_lda_topics(conn, cursor, lda_model, corpus, processed_texts):
     try:
         logging.info("[INFO] Storing topics in the database...")
@@ -146,25 +119,31 @@ def store_lda_topics(conn, cursor, lda_model, corpus, processed_texts):
                         VALUES (%s, %s, %s)
                         ON CONFLICT (article_id, topic_id) DO NOTHING;  -- Prevent duplicates
                     """, (article_id, topic_id, score_float))
+                    metrics.count("rows_written", cursor.rowcount)
                 except Exception as e:
+                    metrics.count("errors")
                     logging.error(f"[ERROR] Failed to insert article-topic relationship for article_id {article_id}, topic_id {topic_id}: {e}")
 
         conn.commit()  # Commit the changes after all inserts are successful
         logging.info("[INFO] Article-topic relationships stored successfully.")
 
     except psycopg2.Error as e:
+        metrics.count("errors")
         logging.error(f"[ERROR] Failed to store topics or article relationships: {e}")
         conn.rollback()  # Rollback if any critical error occurs
+        return False
+    return True
 
 
 
-# Main function to run the LDA pipeline
+# Main function to run the LDA pipeline; returns True if it completed (see pipeline.py)
+@metrics.instrumented("lda")
 def run_lda_pipeline(num_topics=10, batch_size=100):
     logging.info("[INFO] Starting the LDA pipeline...")
 
     conn = connect_db()
     if conn is None:
-        return
+        return False
 
     cursor = conn.cursor()
 
@@ -181,13 +160,21 @@ def run_lda_pipeline(num_topics=10, batch_size=100):
     lda_model = train_lda_model(corpus, dictionary, num_topics=num_topics)
 
     # Store topics and article-topic relationships in the database
-    store_lda_topics(conn, cursor, lda_model, corpus, processed_texts)
+    stored = store_lda_topics(conn, cursor, lda_model, corpus, processed_texts)
 
     # Close the connection
     cursor.close()
     conn.close()
+    if not stored:
+        return False
     logging.info("[INFO] LDA pipeline completed successfully.")
+    return True
 
 # Execute the LDA pipeline
 if __name__ == "__main__":
-    run_lda_pipeline(num_topics=10)
+    parser = argparse.ArgumentParser(description="Fit an LDA topic model on the articles and store the topics.")
+    profiling.add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    with profiling.session("lda", args.profile, args.profile_batches):
+        run_lda_pipeline(num_topics=10)
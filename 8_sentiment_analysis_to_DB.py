@@ -1,122 +1,141 @@
 import logging
 import psycopg2
-from transformers import pipeline
-import configparser
+from models import get_pipeline
 import torch
+import argparse
+import functools
+import metrics
+import profiling
+import tuning
+from checkpoints import run_checkpointed, with_dead_letters, resume_filter
+from database import connect_db, write_values, iter_keyset
+from job_queue import run_worker, run_workers
 
 # Check if CUDA is available and set device
 device = 0 if torch.cuda.is_available() else -1  # 0 for GPU, -1 for CPU
 
-# Load the sentiment analysis pipeline from Hugging Face
-sentiment_model = pipeline("sentiment-analysis", device=device)
+# This host's tuned torch threads and batch size (see tuning.py), set before the model loads
+tuning.apply_threads("sentiment")
+BATCH_SIZE = tuning.batch_size("sentiment")
+
+# Load the sentiment analysis pipeline from Hugging Face. The model is the pipeline's default,
+# named here because the name is the model version of the checkpoints
+SENTIMENT_MODEL = "distilbert-base-uncased-finetuned-sst-2-english"
+sentiment_model = get_pipeline("sentiment-analysis", model=SENTIMENT_MODEL, device=device)
 
 # Logging setup
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 print(f"Using device: {'GPU' if device == 0 else 'CPU'}")
 
-# Load settings from the ini file
-config = configparser.ConfigParser()
-config.read('settings.ini')
-db_host = config['database']['host']
-db_name = config['database']['database']
-db_user = config['database']['user']
-db_password = config['database']['password']
-db_port = config['database']['port']
-
-# Database connection
-def connect_db():
-    try:
-        conn = psycopg2.connect(
-            host=db_host,
-            database=db_name,
-            user=db_user,
-            password=db_password,
-            port=db_port
-        )
-        logging.info("Database connection successful.")
-        return conn
-    except psycopg2.Error as e:
-        logging.error(f"Could not connect to the database: {e}")
-        return None
-
-# Fetch articles from the database
-def fetch_articles(cursor, batch_size=100):
+# Fetch the articles that have a summary from the database. A resumed run (after the
+# checkpoint's article) also takes the articles below it that have no sentiment yet, since
+# summaries are written by another stage (see checkpoints.resume_filter)
+def fetch_articles(cursor, batch_size=100, after=None):
     logging.info("Fetching articles from the 'articles' table in batches...")
-    cursor.execute("SELECT COUNT(*) FROM articles")
+    cursor.execute("SELECT COUNT(*) FROM articles WHERE summary IS NOT NULL")
     total_articles = cursor.fetchone()[0]
     logging.info(f"Total articles found: {total_articles}")
 
-    offset = 0
-    while offset < total_articles:
-        cursor.execute("SELECT article_id, summary FROM articles LIMIT %s OFFSET %s", (batch_size, offset))
-        articles = cursor.fetchall()
+    where, params = resume_filter(
+        "sentiment", "summary IS NOT NULL",
+        "NOT EXISTS (SELECT 1 FROM entity_sentiments WHERE entity_sentiments.entity_id = articles.article_id)", after)
+    for articles in iter_keyset(cursor, "SELECT article_id, summary FROM articles", "article_id",
+                                where=where, params=params, batch_size=batch_size):
         logging.info(f"Fetched {len(articles)} articles in batch.")
         yield articles
-        offset += batch_size
 
-# Batch process sentiment analysis
-def process_sentiment_analysis(cursor, conn, batch_size=100):
-    for articles_batch in fetch_articles(cursor, batch_size):
-        entity_data = []
+# Analyze the sentiment of a batch of (article_id, summary) rows; returns the rows to insert
+def analyze_sentiments(articles_batch):
+    entity_data = []
+    metrics.count_tokens([(content or '')[:512] for _, content in articles_batch], sentiment_model.tokenizer)
+    with metrics.timer("model_batch_seconds"):
         for article_id, content in articles_batch:
-            try:
-                logging.info(f"Processing sentiment for article ID {article_id}...")
-
-                # Apply sentiment analysis to the article content
-                sentiments = sentiment_model(content[:512])  # Limiting the content length for processing efficiency
-                logging.info(f"Sentiment results: {sentiments}")
-
-                for sentiment in sentiments:
-                    sentiment_score = sentiment['score']
-                    sentiment_label = sentiment['label']
-                    if sentiment_label == 'POSITIVE':
-                        sentiment_pos, sentiment_neg, sentiment_neu = sentiment_score, 0.0, 0.0
-                    elif sentiment_label == 'NEGATIVE':
-                        sentiment_pos, sentiment_neg, sentiment_neu = 0.0, sentiment_score, 0.0
-                    else:
-                        sentiment_pos, sentiment_neg, sentiment_neu = 0.0, 0.0, sentiment_score
-                    
-                    entity_data.append((article_id, sentiment_pos, sentiment_neg, sentiment_neu, sentiment_score))
-
-            except Exception as e:
-                logging.error(f"Error processing sentiment for article ID {article_id}: {e}")
-
-        # Insert sentiment results in batch to improve performance
-        insert_sentiments(cursor, entity_data)
-        conn.commit()
+            logging.info(f"Processing sentiment for article ID {article_id}...")
+
+            # Apply sentiment analysis to the article content
+            sentiments = sentiment_model(content[:512])  # Limiting the content length for processing efficiency
+            logging.info(f"Sentiment results: {sentiments}")
+
+            for sentiment in sentiments:
+                sentiment_score = sentiment['score']
+                sentiment_label = sentiment['label']
+                if sentiment_label == 'POSITIVE':
+                    sentiment_pos, sentiment_neg, sentiment_neu = sentiment_score, 0.0, 0.0
+                elif sentiment_label == 'NEGATIVE':
+                    sentiment_pos, sentiment_neg, sentiment_neu = 0.0, sentiment_score, 0.0
+                else:
+                    sentiment_pos, sentiment_neg, sentiment_neu = 0.0, 0.0, sentiment_score
+
+                entity_data.append((article_id, sentiment_pos, sentiment_neg, sentiment_neu, sentiment_score))
+    metrics.count("articles", len(articles_batch))
+    return entity_data
+
+# Analyze a batch of articles and insert the results in one statement
+def score_articles(cursor, articles_batch):
+    insert_sentiments(cursor, analyze_sentiments(articles_batch))
+
+# Batch process sentiment analysis. Every batch is committed with the stage's checkpoint, and an
+# article that fails goes to the dead letters (see checkpoints.py)
+def process_sentiment_analysis(conn, batch_size=100, restart=False):
+    done, dead = run_checkpointed(
+        conn, "sentiment", SENTIMENT_MODEL,
+        lambda cursor, after: profiling.sample(fetch_articles(cursor, batch_size, after)),
+        score_articles, restart)
+    logging.info(f"Sentiment analysis done for {done} articles, {dead} dead-lettered.")
 
 # Insert sentiments into the database
 def insert_sentiments(cursor, entity_data):
     logging.info(f"Inserting sentiment results for {len(entity_data)} articles...")
     query = """
         INSERT INTO entity_sentiments (entity_id, sentiment_pos, sentiment_neg, sentiment_neu, sentiment_compound)
-        VALUES (%s, %s, %s, %s, %s)
+        VALUES %s
         ON CONFLICT (entity_id) DO NOTHING;
     """
-    try:
-        cursor.executemany(query, entity_data)
-        logging.info("Sentiment results inserted successfully.")
-    except psycopg2.Error as e:
-        logging.error(f"Error inserting sentiment results: {e}")
+    write_values(cursor, query, entity_data)
+    logging.info("Sentiment results inserted successfully.")
 
-# Main function to run the sentiment analysis pipeline
-def run_sentiment_analysis_pipeline(batch_size=100):
+# Main function to run the sentiment analysis pipeline; returns True if it completed (see pipeline.py)
+@metrics.instrumented("sentiment")
+def run_sentiment_analysis_pipeline(batch_size=BATCH_SIZE, restart=False):
     logging.info("Starting sentiment analysis pipeline...")
 
     conn = connect_db()
     if conn is None:
-        return
-
-    cursor = conn.cursor()
+        return False
 
     # Process articles in batches and store sentiment results
-    process_sentiment_analysis(cursor, conn, batch_size=batch_size)
-
-    # Close the connection after everything is done
-    cursor.close()
-    conn.close()
+    try:
+        process_sentiment_analysis(conn, batch_size=batch_size, restart=restart)
+    except psycopg2.Error as e:
+        metrics.count("errors")
+        logging.error(f"Database error occurred: {e}. The batches committed so far are kept; rerun to resume.")
+        conn.rollback()
+        return False
+    finally:
+        # Close the connection after everything is done
+        conn.close()
     logging.info("Sentiment analysis pipeline completed successfully.")
+    return True
+
+# Analyze sentiment as a job-queue worker (see job_queue.py); any number of workers can run at once
+@metrics.instrumented("sentiment", per_process=True)
+def run_queue_worker(batch_size=BATCH_SIZE):
+    run_worker("sentiment", "SELECT article_id, summary FROM articles WHERE article_id = ANY(%s)",
+               with_dead_letters("sentiment", SENTIMENT_MODEL, score_articles),
+               batch_size, where="summary IS NOT NULL")
 
 # Execute the sentiment analysis pipeline
 if __name__ == "__main__":
-    run_sentiment_analysis_pipeline(batch_size=100)
+    parser = argparse.ArgumentParser(description="Analyze the sentiment of article summaries.")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="Articles per batch (default: this host's tuned size, or 100)")
+    parser.add_argument("--queue", action="store_true", help="Claim batches from the article_jobs queue, so several workers can share the stage")
+    parser.add_argument("--workers", type=int, default=1, help="Queue worker processes to start on this machine (with --queue)")
+    parser.add_argument("--restart", action="store_true", help="Ignore the stage's checkpoint and start from the first article")
+    profiling.add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    with profiling.session("sentiment", args.profile, args.profile_batches):
+        if args.queue:
+            run_workers(functools.partial(run_queue_worker, args.batch_size), args.workers)
+        else:
+            run_sentiment_analysis_pipeline(batch_size=args.batch_size, restart=args.restart)
@@ -2,114 +2,93 @@ import numpy as np
 import faiss
 import psycopg2
 import logging
-import configparser
 from tqdm import tqdm
+import argparse
+import metrics
+import profiling
+from database import connect_db, write_values, iter_keyset, run_transaction
+from vectors import decode_vector, ensure_vector_columns
 
 # Initialize logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Database connection using psycopg2
-# Load settings from the ini file
-config = configparser.ConfigParser()
-config.read('settings.ini')
-
-# Access database settings from settings.ini
-db_host = config['database']['host']
-db_name = config['database']['database']
-db_user = config['database']['user']
-db_password = config['database']['password']
-db_port = config['database']['port']
-
-# Connect to PostgreSQL database
-def connect_db():
-    try:
-        conn = psycopg2.connect(
-            host=db_host,
-            database=db_name,
-            user=db_user,
-            password=db_password,
-            port=db_port
-        )
-        logging.info("[INFO] Connected to the database.")
-        return conn
-    except psycopg2.Error as e:
-        logging.error(f"[ERROR] Could not connect to the database: {e}")
-        return None
-
-# Function to fetch articles with embeddings
+# Function to fetch articles with embeddings (vector bytes and their type, see vectors.py), batch
+# by batch in article_id order
 def fetch_articles_with_embeddings(cursor, batch_size=100):
-    offset = 0
-    while True:
-        cursor.execute("SELECT article_id, embedding_vector_array FROM articles WHERE embedding_vector_array IS NOT NULL LIMIT %s OFFSET %s", (batch_size, offset))
-        articles = cursor.fetchall()
-        if not articles:
-            break
-        yield articles
-        offset += batch_size
-
-# Function to build and store FAISS index
+    yield from iter_keyset(cursor, "SELECT article_id, embedding_vector, embedding_dtype FROM articles", "article_id",
+                           where="embedding_vector IS NOT NULL", batch_size=batch_size)
+
+# Function to build and store FAISS index; returns False if it failed or a batch was not stored
 def build_faiss_index(cursor, conn, index, batch_size=100):
-    offset = 0
-    embeddings = []
     ids = []
+    stored = True
 
     try:
+        # The vectors are decoded straight into one preallocated array; articles embedded after
+        # the count wait for the next run
+        cursor.execute("SELECT COUNT(*) FROM articles WHERE embedding_vector IS NOT NULL")
+        capacity = cursor.fetchone()[0]
+        embeddings_np = np.empty((capacity, index.d), dtype=np.float32)
+
         # Fetch articles in batches
-        for articles in fetch_articles_with_embeddings(cursor, batch_size):
-            for article_id, embedding_array in articles:
+        for articles in profiling.sample(fetch_articles_with_embeddings(cursor, batch_size)):
+            for article_id, embedding_vector, embedding_dtype in articles[:capacity - len(ids)]:
                 try:
-                    # Convert PostgreSQL array to NumPy array
-                    embedding = np.array(embedding_array, dtype=np.float32)
-                    embeddings.append(embedding)
+                    embeddings_np[len(ids)] = decode_vector(embedding_vector, embedding_dtype)
                     ids.append(article_id)
                 except Exception as e:
+                    metrics.count("errors")
                     logging.error(f"[ERROR] Error processing embedding for article_id {article_id}: {e}")
                     continue
-
-        # Convert to numpy array
-        embeddings_np = np.array(embeddings).astype('float32')
+        embeddings_np = embeddings_np[:len(ids)]
 
         if embeddings_np.shape[0] > 0:
             logging.info(f"Embedding shape: {embeddings_np.shape}")
-            assert embeddings_np.shape[1] == index.d, f"Expected {index.d} dimensions, got {embeddings_np.shape[1]}"
 
             # Add the embeddings to FAISS index
-            index.add(embeddings_np)
+            with metrics.timer("model_batch_seconds"):
+                index.add(embeddings_np)
+            metrics.count("articles", len(embeddings_np))
             logging.info(f"FAISS index built with {len(embeddings_np)} embeddings.")
 
             # Optionally, store the index on disk
             faiss.write_index(index, "faiss_index.index")
             logging.info("FAISS index saved to disk.")
 
-            # Store the embeddings in the faiss_index table as BYTEA and update articles table
-            for article_id, embedding in zip(ids, embeddings):
+            # Store the embeddings in the faiss_index table as BYTEA, batch by batch
+            for start in range(0, len(ids), batch_size):
+                rows = [(article_id, psycopg2.Binary(embedding.tobytes()))
+                        for article_id, embedding in zip(ids[start:start + batch_size], embeddings_np[start:start + batch_size])]
                 try:
-                    # Convert embedding to byte array
-                    embedding_bytes = np.array(embedding, dtype=np.float32).tobytes()
-
-                    # Insert into faiss_index table
-                    cursor.execute("""
+                    write_values(cursor, """
                         INSERT INTO faiss_index (article_id, faiss_vector)
-                        VALUES (%s, %s)
+                        VALUES %s
                         ON CONFLICT (article_id) DO NOTHING;  -- Prevent duplicates
-                    """, (article_id, psycopg2.Binary(embedding_bytes)))
-
+                    """, rows)
                 except Exception as e:
-                    logging.error(f"[ERROR] Error inserting into faiss_index for article_id {article_id}: {e}")
+                    metrics.count("errors")
+                    logging.error(f"[ERROR] Error inserting into faiss_index for article_ids {rows[0][0]} to {rows[-1][0]}: {e}")
                     conn.rollback()  # Rollback in case of error
+                    stored = False
                 else:
-                    conn.commit()  # Commit after successful update
+                    conn.commit()  # Commit after each successful batch
         else:
             logging.error("No valid embeddings processed.")
     except Exception as e:
+        metrics.count("errors")
         logging.error(f"[ERROR] Error building FAISS index: {e}")
+        return False
+    return stored
 
-# Main function to run the FAISS pipeline
+# Main function to run the FAISS pipeline; returns True if it completed (see pipeline.py)
+@metrics.instrumented("faiss")
 def run_faiss_pipeline():
     conn = connect_db()
     if conn is None:
-        return
+        return False
 
+    # Type of the compact embedding vectors (see vectors.py), on databases 5_ has not run on yet
+    run_transaction(ensure_vector_columns)
     cursor = conn.cursor()
 
     # Initialize FAISS index (dimension = 768 in your case)
@@ -117,11 +96,17 @@ def run_faiss_pipeline():
     index = faiss.IndexFlatL2(d)
 
     # Build the FAISS index
-    build_faiss_index(cursor, conn, index)
+    built = build_faiss_index(cursor, conn, index)
 
     # Close the connection
     cursor.close()
     conn.close()
+    return built
 
 if __name__ == "__main__":
-    run_faiss_pipeline()
+    parser = argparse.ArgumentParser(description="Build the FAISS index from the article embeddings.")
+    profiling.add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    with profiling.session("faiss", args.profile, args.profile_batches):
+        run_faiss_pipeline()
@@ -1,33 +1,10 @@
-import configparser
 import psycopg2
-
-# Load settings from the ini file
-config = configparser.ConfigParser()
-config.read('settings.ini')
-
-# Access database settings from settings.ini
-db_host = config['database']['host']
-db_name = config['database']['database']
-db_user = config['database']['user']
-db_password = config['database']['password']
-db_port = config['database']['port']
-
-# Connect to PostgreSQL database
-def connect_db():
-    try:
-        conn = psycopg2.connect(
-            host=db_host,
-            database=db_name,
-            user=db_user,
-            password=db_password,
-            port=db_port
-        )
-        print("[INFO] Database connection successful.")
-        return conn
-    except psycopg2.Error as e:
-        print(f"[ERROR] Could not connect to the database: {e}")
-        return None
-
+import database
+from database import connect_db
+from job_queue import ensure_job_table
+from checkpoints import ensure_checkpoint_tables
+from passages import ensure_passages_table
+from vectors import ensure_vector_columns
 
 # Step 2: Create necessary tables for the project
 def create_tables(cursor):
@@ -115,6 +92,22 @@ def create_tables(cursor):
     for command in commands:
         cursor.execute(command)
 
+    # One article per title in an issue: the target of the loader's ON CONFLICT, and the index its
+    # bulk merge probes for titles already loaded (unique on the SQLite backend too, see sqlite_backend.py)
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_articles_newspaper_title ON Articles (newspaper_id, title);")
+
+    # Work queue for the multi-worker stages (see job_queue.py)
+    ensure_job_table(cursor)
+
+    # Checkpoints and dead letters of the model stages (see checkpoints.py)
+    ensure_checkpoint_tables(cursor)
+
+    # Passages of the passage-level embeddings (see passages.py)
+    ensure_passages_table(cursor)
+
+    # Type of the compact embedding vectors (see vectors.py)
+    ensure_vector_columns(cursor)
+
     print("[INFO] All tables created or confirmed to exist.")
 
 
@@ -127,7 +120,16 @@ def run_schema_creation():
     if conn is None:
         print("[ERROR] Could not establish a database connection. Exiting.")
         return
-    
+
+    # The local SQLite database creates its schema when it is first opened (see sqlite_backend.py)
+    if database.backend == "sqlite":
+        with conn.cursor() as cursor:
+            ensure_checkpoint_tables(cursor)
+        conn.commit()
+        conn.close()
+        print("[INFO] Database schema creation complete.")
+        return
+
     cursor = conn.cursor()
 
     # Enable the cube extension (if not already installed)
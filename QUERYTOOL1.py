@@ -4,9 +4,13 @@ import numpy as np
 import openai
 import configparser
 import json
-from sentence_transformers import SentenceTransformer
-from transformers import pipeline
+import argparse
+import profiling
+from models import get_pipeline, get_sentence_transformer
 import re
+from database import connect_db
+import embedding_cache
+from vectors import decode_vectors
 
 # Load settings from the settings.ini file
 config = configparser.ConfigParser()
@@ -15,42 +19,42 @@ config.read('settings.ini')
 # Load OpenAI API Key from settings.ini
 openai.api_key = config['openai']['api_key']
 
-# Database credentials from settings.ini
-db_host = config['database']['host']
-db_name = config['database']['database']
-db_user = config['database']['user']
-db_password = config['database']['password']
-db_port = config['database']['port']
+# Statement timeout for the interactive queries in milliseconds, so a bad query cannot hang the tool
+query_statement_timeout_ms = config.getint('database', 'query_statement_timeout_ms', fallback=30000)
 
-# Step 1: Connect to PostgreSQL database
-def connect_db():
-    try:
-        conn = psycopg2.connect(
-            host=db_host,
-            database=db_name,
-            user=db_user,
-            password=db_password,
-            port=db_port
-        )
-        print("[INFO] Connected to the database.")
-        return conn
-    except psycopg2.Error as e:
-        print(f"[ERROR] Could not connect to the database: {e}")
-        return None
+# Sentence transformer model of the article embeddings (also the embedding cache's key)
+EMBEDDING_MODEL = 'sentence-transformers/gtr-t5-large'
+
+# FAISS indexes of this session, built on the first question and reused for the next ones:
+# name -> (index, ids). Vectors stored after they were built are picked up by the next session.
+_indexes = {}
+
+# Function to get a session's FAISS index and the ids of its rows, building it with
+# load(cursor) -> (ids, vectors) the first time; returns (None, ids) when there are no vectors
+def get_index(name, cursor, load):
+    if name not in _indexes:
+        ids, vectors = load(cursor)
+        index = None
+        if len(vectors):
+            index = faiss.IndexFlatL2(vectors.shape[1])
+            index.add(vectors)
+        _indexes[name] = (index, ids)
+    return _indexes[name]
 
 # Load a sentence transformer model
 def load_embedding_model():
-    model = SentenceTransformer('sentence-transformers/gtr-t5-large')
+    model = get_sentence_transformer(EMBEDDING_MODEL)
     return model
 
-# Generate an embedding for the user's input
+# Generate an embedding for the user's input (repeated questions come from the embedding cache)
 def generate_user_embedding(user_input):
-    model = load_embedding_model()
-    return model.encode(user_input)
+    return embedding_cache.encode_cached(
+        EMBEDDING_MODEL, [user_input],
+        lambda indexes: load_embedding_model().encode([user_input], convert_to_numpy=True))[0]
 
 # Load a pretrained NER model
 def load_ner_model():
-    return pipeline("ner", model="dbmdz/bert-large-cased-finetuned-conll03-english")
+    return get_pipeline("ner", model="dbmdz/bert-large-cased-finetuned-conll03-english")
 
 # Extract entities using NER
 def extract_entity(user_input):
@@ -65,32 +69,51 @@ def get_faiss_vectors_from_db(cursor):
     cursor.execute("SELECT article_id, faiss_vector FROM faiss_index")
     rows = cursor.fetchall()
 
-    article_ids = []
-    vectors = []
-    for row in rows:
-        article_id = row[0]
-        vector_str = row[1]
-        vector = np.fromstring(vector_str.strip('[]'), sep=',')
-        article_ids.append(article_id)
-        vectors.append(vector)
-    
-    return np.array(article_ids), np.array(vectors).astype('float32')
+    # The FAISS vectors are float32 bytes (see 9_FAISS_to_DB.py)
+    article_ids = np.array([row[0] for row in rows])
+    vectors = decode_vectors((row[1], 'float32') for row in rows)
+    return article_ids, vectors
 
-# Build and search FAISS index
+# Build (once per session) and search FAISS index
 def search_faiss_index(user_embedding, cursor):
-    article_ids, vectors = get_faiss_vectors_from_db(cursor)
+    index, article_ids = get_index("articles", cursor, get_faiss_vectors_from_db)
     
-    if len(vectors) == 0:
+    if index is None:
         print("[ERROR] No FAISS vectors retrieved from the database.")
         return []
     
-    dimension = vectors.shape[1]
-    index = faiss.IndexFlatL2(dimension)
-    index.add(vectors)
-    
     D, I = index.search(np.array([user_embedding]).astype('float32'), 5)
     return [article_ids[idx] for idx in I[0]]
 
+# Fetch the passage vectors from the database (see passages.py); nothing before 5_ has run with --passages
+def get_passage_vectors_from_db(cursor):
+    try:
+        cursor.execute("SELECT passage_id, embedding_vector, embedding_dtype FROM passages WHERE embedding_vector IS NOT NULL")
+        rows = cursor.fetchall()
+    except psycopg2.Error:
+        # No passages table yet
+        cursor.connection.rollback()
+        rows = []
+    return [row[0] for row in rows], decode_vectors((row[1], row[2]) for row in rows)
+
+# Search the passages closest to the user's embedding in the session's passage index; returns
+# (article_id, passage text) pairs, best first
+def search_passages(user_embedding, cursor, k=5):
+    index, passage_ids = get_index("passages", cursor, get_passage_vectors_from_db)
+    if index is None:
+        return []
+
+    D, I = index.search(np.array([user_embedding]).astype('float32'), min(k, len(passage_ids)))
+    best = [passage_ids[idx] for idx in I[0]]
+
+    cursor.execute("""
+    SELECT p.passage_id, p.article_id, substr(a.content, p.start_pos + 1, p.end_pos - p.start_pos)
+    FROM passages p JOIN articles a ON a.article_id = p.article_id
+    WHERE p.passage_id = ANY(%s);
+    """, (best,))
+    found = {passage_id: (article_id, text) for passage_id, article_id, text in cursor.fetchall()}
+    return [found[passage_id] for passage_id in best if passage_id in found]
+
 # Search entities from the database
 def search_by_entity(cursor, entity_value, entity_type):
     query = """
@@ -153,6 +176,7 @@ def query_all_indices(cursor, user_input):
     # Generate user embedding
     user_embedding = generate_user_embedding(user_input)
     faiss_results = search_faiss_index(user_embedding, cursor)
+    passage_results = search_passages(user_embedding, cursor)
 
     # Extract entities and perform NER search
     entity_value, entity_type = extract_entity(user_input)
@@ -175,6 +199,7 @@ def query_all_indices(cursor, user_input):
     # Return all results in a structured format
     return {
         "faiss_results": faiss_results,
+        "passage_results": passage_results,
         "ner_results": ner_results,
         "geospatial_results": geospatial_results,
         "sentence_results": sentence_results,
@@ -243,23 +268,34 @@ def generate_openai_response(user_input, standardized_results):
     )
     return response['choices'][0]['message']['content']
 
-# Main conversation loop
+# Main conversation loop; questions are asked until an empty one, and all of them are searched
+# in the FAISS indexes built for the first
 def run_conversation():
-    conn = connect_db()
+    conn = connect_db(statement_timeout=query_statement_timeout_ms)
     if conn is None:
         return
     
     cursor = conn.cursor()
-    user_input = input("Ask your question: ")
+    while True:
+        user_input = input("Ask your question (empty to quit): ")
+        if not user_input.strip():
+            break
 
-    results = query_all_indices(cursor, user_input)
-    standardized_results = create_standardized_output(results)
-    
-    response = generate_openai_response(user_input, standardized_results)
-    print(response)
+        # The search is the batch for --profile (not the wait for input or the OpenAI call)
+        with profiling.batch():
+            results = query_all_indices(cursor, user_input)
+            standardized_results = create_standardized_output(results)
+
+        response = generate_openai_response(user_input, standardized_results)
+        print(response)
 
     cursor.close()
     conn.close()
 
 if __name__ == "__main__":
-    run_conversation()
+    parser = argparse.ArgumentParser(description="Answer a question from the article database.")
+    profiling.add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    with profiling.session("query", args.profile, args.profile_batches):
+        run_conversation()
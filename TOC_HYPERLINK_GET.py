@@ -2,35 +2,9 @@ import re
 import os
 import psycopg2
 from datetime import datetime
-import configparser
-
-# Database connection using psycopg2
-# Load settings from the ini file
-config = configparser.ConfigParser()
-config.read('settings.ini')
-
-# Access database settings from settings.ini
-db_host = config['database']['host']
-db_name = config['database']['database']
-db_user = config['database']['user']
-db_password = config['database']['password']
-db_port = config['database']['port']
-
-# Database connection using psycopg2
-def connect_db():
-    try:
-        conn = psycopg2.connect(
-            host=db_host,
-            database=db_name,
-            user=db_user,
-            password=db_password,
-            port=db_port
-        )
-        print("[INFO] Database connection successful.")
-        return conn
-    except psycopg2.Error as e:
-        print(f"[ERROR] Could not connect to the database: {e}")
-        return None
+import argparse
+from segmenter import load_state, save_state, file_fingerprint, is_unchanged, extract_toc_and_hyperlink
+from database import connect_db
 
 # Insert newspaper data with TOC and hyperlink
 def insert_newspaper(conn, title, publication_date, toc, hyperlink):
@@ -48,33 +22,27 @@ def insert_newspaper(conn, title, publication_date, toc, hyperlink):
             return newspaper_id
     except psycopg2.Error as e:
         print(f"Error inserting newspaper: {e}")
+        conn.rollback()
         return None
 
-# Extract Table of Contents and Hyperlink from the text
-def extract_toc_and_hyperlink(text):
-    # Use regex to capture the content between "Masthead" and the "Persistent Link" section
-    toc_match = re.search(r'Masthead(.*?)Persistent Link', text, re.DOTALL)
-    hyperlink_match = re.search(r'(https?://\S+)', text)
-
-    # Extract TOC and Hyperlink
-    toc = toc_match.group(1).strip() if toc_match else None
-    hyperlink = hyperlink_match.group(0).strip() if hyperlink_match else None
-
-    # Replace multiple spaces/newlines for better formatting
-    if toc:
-        toc = re.sub(r'\s+', ' ', toc)  # Replace newlines or extra spaces
-
-    return toc, hyperlink
-
-# Process each file in the directory
-def process_files(input_directory):
+# Process each file in the directory; files whose content is unchanged since the last run are skipped
+def process_files(input_directory, state_path=None, force=False):
     conn = connect_db()
     if conn is None:
         return  # Exit if the database connection fails
 
+    state = load_state(state_path)
+    skipped = 0
+
     for filename in os.listdir(input_directory):
         if filename.lower().endswith(".txt"):
             input_file_path = os.path.join(input_directory, filename)
+
+            # Skip issues already loaded with the same content hash
+            fingerprint = file_fingerprint(input_file_path, state.get(os.path.abspath(input_file_path)))
+            if not force and is_unchanged(state, input_file_path, fingerprint):
+                skipped += 1
+                continue
             
             # Extract date from the filename
             date_match = re.search(r'(\d{1,2})\s+([A-Za-z]+)\s+(\d{4})', filename)
@@ -99,15 +67,32 @@ def process_files(input_directory):
 
                 if toc and hyperlink:
                     # Insert newspaper with TOC and hyperlink
-                    insert_newspaper(conn, "Trinity Journal", publication_date, toc, hyperlink)
+                    if insert_newspaper(conn, "Trinity Journal", publication_date, toc, hyperlink) is None:
+                        continue
+                    conn.commit()
+
+                # Remember the file so unchanged issues are not inserted again on the next run
+                state[os.path.abspath(input_file_path)] = fingerprint
 
             except Exception as e:
                 print(f"Error processing file {filename}: {e}")
 
     conn.close()
 
+    if state_path:
+        save_state(state_path, state)
+    print(f"[INFO] Skipped {skipped} unchanged files.")
+
 # Define the input directory containing the files
 input_directory = r"C:\\Users\\SeanOffice\\Documents\\Trinity Journal Text"
 
+# Persistent record of the issues already processed (content hash per input path)
+state_path = "toc_hyperlink_state.json"
+
 # Process the files and populate the database with TOC and hyperlink data
-process_files(input_directory)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load each issue's table of contents and persistent link into Newspapers.")
+    parser.add_argument("--force", action="store_true", help="Reprocess every file, even if unchanged since the last run")
+    args = parser.parse_args()
+
+    process_files(input_directory, state_path, args.force)
@@ -0,0 +1,224 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import functools
+import tempfile
+import importlib
+import traceback
+import multiprocessing
+
+# Benchmark of the preprocessing stages on a synthetic OCR corpus (see ocr_corpus.py).
+# Each stage runs in a fresh process so its peak RSS is its own, and reports files/s, MB/s
+# and peak RSS. Module import time (torch, models) is measured separately from the run.
+# Run from the repository root:  python benchmarks/bench_pipeline.py --issues 500
+# Save results with --json and compare a later run with --baseline to catch regressions.
+# --backends postgres,sqlite runs the load stage on both storage backends (the sqlite result is
+# reported as load-sqlite), so their throughput can be compared on one machine.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import ocr_corpus
+
+# Stages in pipeline order: (module, output file renaming as the stage's own script does it, input stage)
+STAGES = {
+    "seg1": ("1_article_divider", (".txt", "_seg1.txt"), "corpus"),
+    "seg2": ("2_article_divider", ("seg1", "seg2"), "seg1"),
+    "seg3": ("3_article_divider", ("seg2", "seg3"), "seg2"),
+    "segmenter": ("segmenter", (".txt", "_seg3.jsonl"), "corpus"),
+    "load": ("4_segmented_to_db", None, "segmenter"),
+}
+
+# Function to read this process's peak RSS in MB (including finished worker processes)
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        # Windows has no resource module; psutil reports the peak working set instead
+        try:
+            import psutil
+        except ImportError:
+            return None
+        return psutil.Process().memory_info().peak_wset / (1024 * 1024)
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # ru_maxrss is in bytes on macOS and in KB elsewhere
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+# Function to process one file with the benchmark's own encoding cache (worker processes start
+# with the default cache path, and the benchmark must not touch the real cache)
+def process_with_cache(process, cache_path, input_path, output_path):
+    import encoding_detector
+    encoding_detector.cache_path = cache_path
+    return process(input_path, output_path)
+
+# Function to run one stage over a directory, in its own process, and report the result to a queue
+def run_stage_process(stage, input_dir, output_dir, workers, cache_path, database, backend, queue):
+    os.chdir(ROOT)
+    result = {"stage": stage}
+
+    # Silence the per-file progress output at the descriptor level, so worker processes are quiet too
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.dup2(devnull, 2)
+    try:
+        start = time.perf_counter()
+        module = importlib.import_module(STAGES[stage][0])
+        result["import_seconds"] = time.perf_counter() - start
+        result["import_rss_mb"] = peak_rss_mb()
+
+        file_names = sorted(name for name in os.listdir(input_dir) if name.lower().endswith((".txt", ".jsonl")))
+        result["files"] = len(file_names)
+        result["mb"] = sum(os.path.getsize(os.path.join(input_dir, name)) for name in file_names) / (1024 * 1024)
+
+        start = time.perf_counter()
+        if stage == "load":
+            # 4_segmented_to_db.py reads its directory from module settings, and the shared
+            # database module its backend and connection settings
+            import database as database_module
+            import sqlite_backend
+            module.input_directory = input_dir
+            database_module.backend = backend
+            database_module.DB_SETTINGS["database"] = database
+            os.makedirs(output_dir, exist_ok=True)
+            sqlite_backend.database_path = os.path.join(output_dir, "bench.sqlite3")
+            module.process_all_files()
+            failed = 0
+        else:
+            import segmenter
+            os.makedirs(output_dir, exist_ok=True)
+            tasks = [(os.path.join(input_dir, name), os.path.join(output_dir, name.replace(*STAGES[stage][1])))
+                     for name in file_names]
+            entries = segmenter.run_stage(functools.partial(process_with_cache, module.process_file, cache_path), tasks, workers)
+            failed = sum(1 for entry in entries if entry["status"] != "ok")
+        result["seconds"] = time.perf_counter() - start
+        result["failed"] = failed
+        result["peak_rss_mb"] = peak_rss_mb()
+    except Exception:
+        result["error"] = traceback.format_exc()
+    queue.put(result)
+
+# Function to run a stage in a fresh process and collect its result
+def measure_stage(stage, input_dir, output_dir, workers, cache_path, database, backend="postgres"):
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=run_stage_process, args=(stage, input_dir, output_dir, workers, cache_path, database, backend, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    if backend != "postgres":
+        result["stage"] = f"{stage}-{backend}"
+
+    if "error" not in result:
+        seconds = max(result["seconds"], 1e-9)
+        result["files_per_second"] = result["files"] / seconds
+        result["mb_per_second"] = result["mb"] / seconds
+    return result
+
+# Function to format an optional number for the results table
+def format_number(value, pattern):
+    return format(value, pattern) if value is not None else "n/a".rjust(len(format(0.0, pattern)))
+
+# Function to print the results table
+def print_results(results):
+    print(f"{'stage':<12} {'files':>7} {'MB':>8} {'seconds':>9} {'files/s':>9} {'MB/s':>8} {'peak RSS MB':>12} {'import s':>9} {'import RSS MB':>14}")
+    for result in results:
+        if "error" in result:
+            print(f"{result['stage']:<12} failed: {result['error'].strip().splitlines()[-1]}")
+            continue
+        print(f"{result['stage']:<12} {result['files']:>7} {result['mb']:>8.1f} {result['seconds']:>9.2f} "
+              f"{result['files_per_second']:>9.1f} {result['mb_per_second']:>8.2f} {format_number(result['peak_rss_mb'], '12.1f')} "
+              f"{result['import_seconds']:>9.2f} {format_number(result['import_rss_mb'], '14.1f')}")
+        if result["failed"]:
+            print(f"{'':<12} [WARNING] {result['failed']} files failed")
+
+# Function to compare results with a saved baseline; returns the list of regressions
+def compare_with_baseline(results, baseline_path, tolerance):
+    with open(baseline_path, 'r', encoding='utf-8') as baseline_file:
+        baseline = {result["stage"]: result for result in json.load(baseline_file)["results"] if "error" not in result}
+
+    regressions = []
+    for result in results:
+        before = baseline.get(result["stage"])
+        if before is None or "error" in result:
+            continue
+        if result["mb_per_second"] < before["mb_per_second"] * (1 - tolerance):
+            regressions.append(f"{result['stage']}: {result['mb_per_second']:.2f} MB/s, baseline {before['mb_per_second']:.2f} MB/s")
+        if result["peak_rss_mb"] and before.get("peak_rss_mb") and result["peak_rss_mb"] > before["peak_rss_mb"] * (1 + tolerance):
+            regressions.append(f"{result['stage']}: peak RSS {result['peak_rss_mb']:.1f} MB, baseline {before['peak_rss_mb']:.1f} MB")
+    return regressions
+
+# Main function
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the segmentation and loading stages on a synthetic OCR corpus.")
+    parser.add_argument("--issues", type=int, default=200, help="Number of synthetic issues (1 to 100000)")
+    parser.add_argument("--size-kb", type=int, default=64, help="Approximate size of each issue in KB")
+    parser.add_argument("--seed", type=int, default=1855, help="Random seed for the corpus")
+    parser.add_argument("--corpus", default=None, help="Use (or create once) the corpus in this directory instead of a temporary one")
+    parser.add_argument("--stages", default="seg1,seg2,seg3,segmenter", help=f"Comma-separated stages to run, from: {', '.join(STAGES)}")
+    parser.add_argument("--workers", type=int, default=1, help="Worker processes for the segmentation stages")
+    parser.add_argument("--database", default=None, help="Scratch database (with the schema loaded) for the load stage; never the live archive")
+    parser.add_argument("--backends", default="postgres", help="Comma-separated storage backends for the load stage: postgres, sqlite (a scratch file)")
+    parser.add_argument("--json", default=None, help="Save the results to this JSON file")
+    parser.add_argument("--baseline", default=None, help="Compare with results saved earlier with --json")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="Allowed slowdown or RSS growth vs the baseline (0.15 = 15%%)")
+    args = parser.parse_args()
+
+    stages = [stage.strip() for stage in args.stages.split(',') if stage.strip()]
+    for stage in stages:
+        if stage not in STAGES:
+            parser.error(f"unknown stage {stage!r}")
+    backends = [backend.strip() for backend in args.backends.split(',') if backend.strip()]
+    for backend in backends:
+        if backend not in ("postgres", "sqlite"):
+            parser.error(f"unknown backend {backend!r}")
+    if "load" in stages and "postgres" in backends and not args.database:
+        parser.error("the load stage writes to a database; pass --database with a scratch database (or use --backends sqlite)")
+
+    work_dir = tempfile.mkdtemp(prefix="trinity_bench_")
+    try:
+        corpus_dir = args.corpus or os.path.join(work_dir, "corpus")
+        if not (os.path.isdir(corpus_dir) and os.listdir(corpus_dir)):
+            start = time.perf_counter()
+            ocr_corpus.write_corpus(corpus_dir, args.issues, args.size_kb, args.seed)
+            print(f"[INFO] Generated {args.issues} issues in {time.perf_counter() - start:.1f} s")
+
+        # Stages a requested stage depends on also run, so every stage reads real upstream output
+        needed = set()
+        for stage in stages:
+            while stage != "corpus":
+                needed.add(stage)
+                stage = STAGES[stage][2]
+
+        directories = {"corpus": corpus_dir}
+        cache_path = os.path.join(work_dir, "encoding_cache.db")
+        results = []
+        for stage in STAGES:
+            if stage not in needed:
+                continue
+            directories[stage] = os.path.join(work_dir, stage)
+            for backend in (backends if stage == "load" else ["postgres"]):
+                result = measure_stage(stage, directories[STAGES[stage][2]], directories[stage], args.workers, cache_path, args.database, backend)
+                if stage in stages:
+                    results.append(result)
+
+        print_results(results)
+
+        if args.json:
+            corpus = {"issues": args.issues, "size_kb": args.size_kb, "seed": args.seed, "directory": args.corpus}
+            with open(args.json, 'w', encoding='utf-8') as json_file:
+                json.dump({"corpus": corpus, "workers": args.workers, "results": results}, json_file, indent=2)
+            print(f"[INFO] Results saved to {args.json}")
+
+        if args.baseline:
+            regressions = compare_with_baseline(results, args.baseline, args.tolerance)
+            for regression in regressions:
+                print(f"[REGRESSION] {regression}")
+            if regressions:
+                sys.exit(1)
+            print(f"[INFO] No regressions against {args.baseline}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
@@ -0,0 +1,155 @@
+import os
+import random
+import argparse
+import datetime
+
+# Seeded generator of synthetic OCR newspaper issues for the benchmarks.
+# Issues look like the Trinity Journal scans: a masthead, titled articles, all-caps section
+# headers, poetry blocks, advertisements, hyphenated line breaks and OCR noise.
+# Every issue is generated from (seed, issue number), so a corpus of any size is reproducible.
+# Write a corpus from the repository root:  python benchmarks/ocr_corpus.py CORPUS_DIR --issues 1000
+
+WORDS = ("the of and to in that was for with his on by at from this had not but have were which "
+         "their been when would there who said mining county river gold ranch court sheriff "
+         "steamer election trinity weaverville shasta lumber cattle mail stage creek ditch miners "
+         "claim water road bridge hotel store express company supervisors district justice "
+         "packers mules freight winter season snow flour bacon butter saloon democrat union").split()
+LONG_WORDS = ("particularly", "correspondent", "administration", "Weaverville", "transportation",
+              "establishment", "superintendent", "hydraulic", "legislature", "population")
+HEADERS = ("LOCAL MATTERS", "TELEGRAPHIC NEWS", "MINING INTELLIGENCE", "LATEST FROM THE EAST",
+           "COURT PROCEEDINGS", "BIRTHS", "MARRIED", "DIED", "SHIPPING NEWS", "STATE ITEMS")
+AD_HEADERS = ("HOOPER & CO.", "WELLS, FARGO & CO.", "BROWN BROTHERS WHOLESALE", "GREAT CLEARANCE SALE",
+              "LEGAL NOTICE", "SHERIFF'S SALE", "PACIFIC MAIL STEAMSHIP CO", "MILLER & LOCKHART INC")
+AD_LINES = ("Dealers in Groceries, Provisions, Hardware and Mining Tools.", "Main Street, Weaverville.",
+            "Goods delivered to all parts of the county.", "Terms cash. Orders from the mines promptly filled.",
+            "Notice is hereby given that the undersigned will sell at public auction")
+POETS = ("JOHN G. WHITTIER", "MARY HOWITT", "H. W. LONGFELLOW", "ELIZA COOK")
+MONTHS = ("January", "February", "March", "April", "May", "June", "July", "August",
+          "September", "October", "November", "December")
+
+# Common OCR misreadings of single characters
+OCR_SUBSTITUTIONS = {'m': 'rn', 'l': '1', 'e': 'c', 'o': '0', 'h': 'li', 'i': 'l', 'S': '8', 'B': '13'}
+OCR_DEBRIS = ("~", "|", "^", "'", ",", ".", "_")
+
+# Typographic characters that appear now and then in the scans (and tell encodings apart)
+NON_ASCII = ("’", "“", "”", "—", "£", "½", "é")
+
+# First issue date; later issues follow weekly
+FIRST_ISSUE = datetime.date(1856, 1, 5)
+
+# Function to add OCR noise to a line: misread characters and stray debris
+def add_ocr_noise(rng, line, noise):
+    if noise <= 0:
+        return line
+    characters = []
+    for character in line:
+        if rng.random() < noise:
+            characters.append(OCR_SUBSTITUTIONS.get(character, rng.choice(OCR_DEBRIS)))
+        else:
+            characters.append(character)
+    return ''.join(characters)
+
+# Function to wrap words into column lines, splitting some long words with a hyphen at the line end
+def wrap_column(rng, words, width, hyphen_rate):
+    lines = []
+    line = ''
+    for word in words:
+        if line and len(line) + 1 + len(word) > width:
+            if len(word) > 6 and rng.random() < hyphen_rate:
+                split = rng.randint(3, len(word) - 3)
+                lines.append(f"{line} {word[:split]}-")
+                line = word[split:]
+            else:
+                lines.append(line)
+                line = word
+        else:
+            line = f"{line} {word}" if line else word
+    if line:
+        lines.append(line)
+    return lines
+
+# Function to build the words of a paragraph of sentences
+def paragraph_words(rng, sentences, non_ascii_rate):
+    words = []
+    for _ in range(sentences):
+        sentence = [rng.choice(LONG_WORDS) if rng.random() < 0.08 else rng.choice(WORDS) for _ in range(rng.randint(6, 22))]
+        sentence[0] = sentence[0].capitalize()
+        sentence[-1] += '.'
+        if rng.random() < non_ascii_rate:
+            sentence[rng.randrange(len(sentence))] += rng.choice(NON_ASCII)
+        words.extend(sentence)
+    return words
+
+# Function to build one section of an issue: an article, a header, a poem or an advertisement
+def build_section(rng, width, hyphen_rate, non_ascii_rate):
+    kind = rng.random()
+    if kind < 0.6:
+        title = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(2, 7))).title()
+        lines = [title, '']
+        for _ in range(rng.randint(1, 4)):
+            lines.extend(wrap_column(rng, paragraph_words(rng, rng.randint(2, 8), non_ascii_rate), width, hyphen_rate))
+        return lines
+    if kind < 0.72:
+        return [rng.choice(HEADERS)]
+    if kind < 0.82:
+        header = "Selected Poetry" if rng.random() < 0.5 else f"BY {rng.choice(POETS)}"
+        verses = [' '.join(rng.choice(WORDS) for _ in range(rng.randint(4, 8))).capitalize() + ','
+                  for _ in range(rng.randint(4, 16))]
+        return [header, ''] + verses
+    return [rng.choice(AD_HEADERS)] + [rng.choice(AD_LINES) for _ in range(rng.randint(1, 5))]
+
+# Function to build the date of an issue (weekly from FIRST_ISSUE, cycling after 1900)
+def issue_date(number):
+    weeks = (datetime.date(1900, 12, 31) - FIRST_ISSUE).days // 7
+    return FIRST_ISSUE + datetime.timedelta(weeks=number % weeks)
+
+# Function to build the file name of an issue (the date is what 4_segmented_to_db.py reads back)
+def issue_file_name(number):
+    date = issue_date(number)
+    return f"Trinity Journal {date.day} {MONTHS[date.month - 1]} {date.year} No {number:06d}.txt"
+
+# Function to build one OCR-like issue of roughly size_bytes characters
+def build_issue(rng, size_bytes, number=0, noise=0.004, hyphen_rate=0.3, non_ascii_rate=0.01, width=60):
+    date = issue_date(number)
+    lines = ["THE TRINITY JOURNAL.",
+             f"WEAVERVILLE, TRINITY COUNTY, CAL., SATURDAY, {MONTHS[date.month - 1].upper()} {date.day}, {date.year}.",
+             '']
+    total = sum(len(line) + 1 for line in lines)
+    while total < size_bytes:
+        section = [add_ocr_noise(rng, line, noise) for line in build_section(rng, width, hyphen_rate, non_ascii_rate)]
+        section.append('')
+        # Scans sometimes lose the blank line between sections, or double it
+        if rng.random() < 0.1:
+            section.pop()
+        elif rng.random() < 0.1:
+            section.append('')
+        lines.extend(section)
+        total += sum(len(line) + 1 for line in section)
+    return '\n'.join(lines) + '\n'
+
+# Function to write a corpus of issue files, cycling through the given encodings
+def write_corpus(directory, issues, size_kb=64, seed=1855, encodings=('utf-8',), **options):
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for number in range(issues):
+        rng = random.Random(seed * 1000003 + number)
+        path = os.path.join(directory, issue_file_name(number))
+        with open(path, 'w', encoding=encodings[number % len(encodings)], errors='replace') as file:
+            file.write(build_issue(rng, size_kb * 1024, number, **options))
+        paths.append(path)
+    return paths
+
+# Main function
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a seeded corpus of synthetic OCR newspaper issues.")
+    parser.add_argument("output_dir", help="Directory to write the issue .txt files to")
+    parser.add_argument("--issues", type=int, default=100, help="Number of issues (1 to 100000 or more)")
+    parser.add_argument("--size-kb", type=int, default=64, help="Approximate size of each issue in KB")
+    parser.add_argument("--seed", type=int, default=1855, help="Random seed for the corpus")
+    parser.add_argument("--noise", type=float, default=0.004, help="Per-character probability of an OCR error")
+    parser.add_argument("--encodings", default="utf-8", help="Comma-separated encodings to cycle through, e.g. windows-1252,utf-8")
+    args = parser.parse_args()
+
+    paths = write_corpus(args.output_dir, args.issues, args.size_kb, args.seed, tuple(args.encodings.split(',')), noise=args.noise)
+    total_mb = sum(os.path.getsize(path) for path in paths) / (1024 * 1024)
+    print(f"[INFO] Wrote {len(paths)} issues ({total_mb:.1f} MB) to {args.output_dir}")
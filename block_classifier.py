@@ -0,0 +1,210 @@
+import re
+import bisect
+
+# Linear-time classifier for stage 1 of the segmentation (articles, poetry and advertisements).
+#
+# It finds exactly the blocks that these three regular expressions found with finditer():
+#
+#   article:       (?<=\n\n)([^\n]{1,80})\n+([^\n]+\n(.+\n)*)
+#   poetry:        (Selected Poetry|BY [A-Z\s]+)\n+([^\n]+\n(.+\n)*)
+#   advertisement: ([A-Z\s]+(?:CO|CO\.|INC|LTD|ADVERTISEMENT|SALE|NOTICE|WHOLESALE))\n+([^\n]+\n(.+\n)*)
+#
+# The poetry and advertisement headers use [A-Z\s]+, which also matches newlines, so on long
+# all-caps OCR pages the regex engine retried every start position across whole pages.
+# Here every header candidate is checked by walking lines and runs of [A-Z\s] characters,
+# and each run is scanned at most twice, so the work per file is O(n) in its length.
+# Bump segmenter.SEGMENTER_VERSION when a change here alters the blocks found.
+
+# Runs of characters in the header class [A-Z\s] (the same class the old patterns used)
+HEADER_RUN_PATTERN = re.compile(r'[A-Z\s]+')
+
+# Advertisement keywords, shortest first (the shortest keyword ending at a newline leaves the longest header)
+AD_KEYWORDS = ("CO", "INC", "LTD", "SALE", "NOTICE", "WHOLESALE", "ADVERTISEMENT")
+
+# Maximum length of an article title line
+MAX_TITLE_LENGTH = 80
+
+
+# Function to find the first position at or after pos that is not a newline
+def skip_newlines(text, pos):
+    while pos < len(text) and text[pos] == '\n':
+        pos += 1
+    return pos
+
+
+# Function to check that a complete, non-empty line starts at pos (the first line of a body)
+def starts_body(text, pos):
+    return pos < len(text) and text[pos] != '\n' and text.find('\n', pos) != -1
+
+
+# Function to find the end of a body: consecutive non-empty lines that end with a newline
+def body_end(text, pos):
+    while True:
+        newline = text.find('\n', pos)
+        if newline == -1 or newline == pos:
+            return pos
+        pos = newline + 1
+
+
+# Function to find article blocks: a title line of 1-80 characters after a blank line,
+# followed (after any blank lines) by a paragraph of body lines
+def find_articles(text):
+    articles = []
+    search = 0
+    while True:
+        blank = text.find('\n\n', search)
+        if blank == -1:
+            break
+        title_start = blank + 2
+        search = blank + 1
+
+        title_end = text.find('\n', title_start, title_start + MAX_TITLE_LENGTH + 1)
+        if title_end == -1 or title_end == title_start:
+            continue
+
+        start = skip_newlines(text, title_end)
+        if not starts_body(text, start):
+            continue
+
+        end = body_end(text, start)
+        articles.append((title_start, end, text[title_start:title_end], text[start:end]))
+        # The next title must start after this body (the blank line may end right at it)
+        search = end - 2
+    return articles
+
+
+# Function to split the text into runs of header characters, returned as (starts, ends)
+def header_runs(text):
+    starts = []
+    ends = []
+    for match in HEADER_RUN_PATTERN.finditer(text):
+        starts.append(match.start())
+        ends.append(match.end())
+    return starts, ends
+
+
+# Function to find the last newline in text[low:high] that is followed (after any blank lines)
+# by a body, scanning right to left one block of newlines at a time
+def last_header_break(text, low, high, accept=None):
+    newline = text.rfind('\n', low, high)
+    while newline != -1:
+        # All newlines in one block lead to the same body, so test the block once
+        block_start = newline
+        while block_start > low and text[block_start - 1] == '\n':
+            block_start -= 1
+        if accept is None:
+            if starts_body(text, skip_newlines(text, newline)):
+                return newline
+        else:
+            # Advertisement headers must end with a keyword right before the newline block
+            if accept(block_start) and starts_body(text, skip_newlines(text, block_start)):
+                return block_start
+        newline = text.rfind('\n', low, block_start)
+    return -1
+
+
+# Function to find poetry blocks: "Selected Poetry" or "BY <CAPITALS>" headers followed by a body
+def find_poetry(text):
+    poetry = []
+    run_starts, run_ends = header_runs(text)
+    run_breaks = {}  # Last usable header newline per run, computed once per run
+    pos = 0
+    selected = text.find("Selected Poetry")
+    byline = text.find("BY ")
+    while True:
+        # Advance each header search only when it falls behind, so every find() scans forward once
+        if selected != -1 and selected < pos:
+            selected = text.find("Selected Poetry", pos)
+        if byline != -1 and byline < pos:
+            byline = text.find("BY ", pos)
+        candidates = [candidate for candidate in (selected, byline) if candidate != -1]
+        if not candidates:
+            break
+        start = min(candidates)
+
+        if start == selected:
+            header_end = start + len("Selected Poetry")
+            if header_end < len(text) and text[header_end] == '\n':
+                body_start = skip_newlines(text, header_end)
+                if starts_body(text, body_start):
+                    end = body_end(text, body_start)
+                    poetry.append((start, end, text[start:header_end], text[body_start:end]))
+                    pos = end
+                    continue
+            pos = start + 1
+            continue
+
+        # "BY " followed by at least one [A-Z\s] character; the header runs to the last
+        # newline in that run of capitals which is followed by a body
+        names_start = start + 3
+        run = bisect.bisect_right(run_starts, start) - 1
+        if names_start < run_ends[run]:
+            if run not in run_breaks:
+                run_breaks[run] = last_header_break(text, run_starts[run], run_ends[run])
+            header_end = run_breaks[run]
+            if header_end > names_start:
+                body_start = skip_newlines(text, header_end)
+                end = body_end(text, body_start)
+                poetry.append((start, end, text[start:header_end], text[body_start:end]))
+                pos = end
+                continue
+        pos = start + 1
+    return poetry
+
+
+# Function to find the shortest advertisement keyword ending right before position end
+def ad_keyword_length(text, end):
+    if text.endswith("CO.", 0, end):
+        return 3
+    for keyword in AD_KEYWORDS:
+        if text.endswith(keyword, 0, end):
+            return len(keyword)
+    return 0
+
+
+# Function to find advertisement blocks: a run of capitals ending in a company or sale keyword,
+# followed by a body
+def find_advertisements(text):
+    ads = []
+    run_starts, run_ends = header_runs(text)
+    pos = 0
+    run = 0
+    while run < len(run_starts):
+        if run_ends[run] <= pos:
+            run += 1
+            continue
+        start = max(run_starts[run], pos)
+        run_end = run_ends[run]
+
+        # The header needs at least one capital before the keyword
+        def accept(header_end):
+            length = ad_keyword_length(text, header_end)
+            return length > 0 and header_end - length >= start + 1
+
+        # "CO." ends just outside the run, because '.' is not a header character
+        header_end = -1
+        if text.startswith(".\n", run_end) and accept(run_end + 1) and starts_body(text, skip_newlines(text, run_end + 1)):
+            header_end = run_end + 1
+        else:
+            header_end = last_header_break(text, start + 1, run_end, accept)
+
+        if header_end == -1:
+            run += 1
+            pos = run_end
+            continue
+
+        body_start = skip_newlines(text, header_end)
+        end = body_end(text, body_start)
+        ads.append((start, end, text[start:header_end], text[body_start:end]))
+        pos = end
+    return ads
+
+
+# Function to tag the blocks of an issue, returning the article, poetry and advertisement blocks
+# as lists of (start, end, title, body); text outside the article blocks is leftover
+def classify_blocks(text):
+    return {
+        'article': find_articles(text),
+        'poetry': find_poetry(text),
+        'advertisement': find_advertisements(text),
+    }
@@ -0,0 +1,148 @@
+import logging
+import metrics
+from database import run_transaction
+
+# Resumable progress for the model stages (5_, 6_, 8_, 11_).
+# A stage commits after every batch, and in the same transaction records its checkpoint: the
+# last article_id it finished and the version of the model it ran. On restart it resumes after
+# that article; when the model version has changed it starts over, since the earlier results
+# came from another model. An article that fails is retried on its own, and if it fails again
+# it goes to the dead_letters table with the error instead of failing its batch.
+# Pass --restart to a stage to ignore its checkpoint (and retry its dead letters).
+
+# Function to create the checkpoint and dead-letter tables if they do not exist (stages starting
+# together take turns, since concurrent CREATE TABLE IF NOT EXISTS can still collide)
+def ensure_checkpoint_tables(cursor):
+    cursor.execute("SELECT pg_advisory_xact_lock(hashtext('stage_checkpoints'));")
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS stage_checkpoints (
+            stage VARCHAR(50) PRIMARY KEY,
+            model_version VARCHAR(255) NOT NULL,
+            last_article_id INT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS dead_letters (
+            stage VARCHAR(50) NOT NULL,
+            article_id INT NOT NULL REFERENCES Articles(article_id),
+            model_version VARCHAR(255),
+            error TEXT,
+            failures INT NOT NULL DEFAULT 1,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (stage, article_id)
+        );
+    """)
+
+# Function to load a stage's checkpoint: the last article_id done with this model version, or
+# None to start from the beginning
+def load_checkpoint(cursor, stage, model_version):
+    cursor.execute("SELECT model_version, last_article_id FROM stage_checkpoints WHERE stage = %s;", (stage,))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    if row[0] != model_version:
+        logging.info(f"[INFO] Stage {stage}: checkpoint was made with {row[0]}, starting over with {model_version}.")
+        return None
+    logging.info(f"[INFO] Stage {stage}: resuming after article {row[1]}.")
+    return row[1]
+
+# Function to record a stage's checkpoint; commit it together with the batch it covers
+def save_checkpoint(cursor, stage, model_version, last_article_id):
+    cursor.execute("""
+        INSERT INTO stage_checkpoints (stage, model_version, last_article_id, updated_at)
+        VALUES (%s, %s, %s, NOW())
+        ON CONFLICT (stage) DO UPDATE SET model_version = EXCLUDED.model_version,
+            last_article_id = EXCLUDED.last_article_id, updated_at = NOW();
+    """, (stage, model_version, last_article_id))
+
+# Function to remove a stage's checkpoint, so its next run starts from the beginning
+def clear_checkpoint(cursor, stage):
+    cursor.execute("DELETE FROM stage_checkpoints WHERE stage = %s;", (stage,))
+
+# Function to record an article that failed a stage
+def dead_letter(cursor, stage, model_version, article_id, error):
+    cursor.execute("""
+        INSERT INTO dead_letters (stage, article_id, model_version, error)
+        VALUES (%s, %s, %s, %s)
+        ON CONFLICT (stage, article_id) DO UPDATE SET model_version = EXCLUDED.model_version,
+            error = EXCLUDED.error, failures = dead_letters.failures + 1, updated_at = NOW();
+    """, (stage, article_id, model_version, error[:1000]))
+
+# Function to build the input filter of a resumed stage whose input is written by another stage
+# (8_ and 11_ read the summaries): such an input can gain articles below the checkpoint, so a
+# resumed run scans from the first article and takes the articles after the checkpoint, and
+# below it the articles whose output is still missing (pending) and that are not dead letters.
+# The checkpoint then only skips the articles already done. Returns the where and its params
+# for database.iter_keyset, which is started from the first article.
+def resume_filter(stage, where, pending, after):
+    if after is None:
+        return where, ()
+    return (f"({where}) AND (article_id > %s OR (({pending}) AND NOT EXISTS ("
+            f"SELECT 1 FROM dead_letters WHERE dead_letters.stage = %s AND dead_letters.article_id = articles.article_id)))",
+            (after, stage))
+
+# Function to run process(cursor, rows) on a batch of rows keyed by article_id (first column).
+# If the batch fails, its rows are retried one at a time and the rows that fail again are
+# dead-lettered, so one bad article no longer costs the batch. Articles that succeed leave the
+# dead letters. Returns the number of dead-lettered rows. Errors of the connection itself
+# cannot be undone with a savepoint and are raised.
+def process_batch(cursor, stage, model_version, rows, process):
+    failed = []
+    cursor.execute("SAVEPOINT stage_batch;")
+    try:
+        process(cursor, rows)
+    except Exception as e:
+        cursor.execute("ROLLBACK TO SAVEPOINT stage_batch;")
+        logging.warning(f"[WARNING] Stage {stage}: batch of {len(rows)} failed ({e}); retrying its articles one at a time.")
+        for row in rows:
+            cursor.execute("SAVEPOINT stage_article;")
+            try:
+                process(cursor, [row])
+                cursor.execute("RELEASE SAVEPOINT stage_article;")
+            except Exception as e:
+                cursor.execute("ROLLBACK TO SAVEPOINT stage_article;")
+                logging.error(f"[ERROR] Stage {stage}: article {row[0]} failed and was dead-lettered: {e}")
+                metrics.count("errors")
+                dead_letter(cursor, stage, model_version, row[0], f"{type(e).__name__}: {e}")
+                failed.append(row[0])
+    cursor.execute("RELEASE SAVEPOINT stage_batch;")
+
+    done = [row[0] for row in rows if row[0] not in failed]
+    if done:
+        cursor.execute("DELETE FROM dead_letters WHERE stage = %s AND article_id = ANY(%s);", (stage, done))
+    return len(failed)
+
+# Function to run a model stage over its input with checkpoints: batches(cursor, after) yields the
+# batches after the given article_id (None for all), and process(cursor, rows) does the stage's
+# work on one batch. Every batch is committed with its checkpoint. Returns the number of
+# articles done and dead-lettered.
+def run_checkpointed(conn, stage, model_version, batches, process, restart=False):
+    with conn.cursor() as cursor:
+        ensure_checkpoint_tables(cursor)
+        if restart:
+            clear_checkpoint(cursor, stage)
+        after = load_checkpoint(cursor, stage, model_version)
+    conn.commit()
+
+    done = 0
+    dead = 0
+    with conn.cursor() as cursor:
+        for rows in batches(cursor, after):
+            failed = process_batch(cursor, stage, model_version, rows, process)
+            save_checkpoint(cursor, stage, model_version, rows[-1][0])
+            conn.commit()
+            done += len(rows) - failed
+            dead += failed
+            logging.info(f"[INFO] Stage {stage}: {done} articles done, {dead} dead-lettered, checkpoint at article {rows[-1][0]}.")
+    return done, dead
+
+# Function to wrap a stage's process(cursor, rows) for the job queue (see job_queue.py), so that a
+# bad article is dead-lettered instead of failing its whole batch of jobs. The tables are created
+# here, in their own transaction, so the workers' batches never wait on the table lock.
+def with_dead_letters(stage, model_version, process):
+    run_transaction(ensure_checkpoint_tables)
+
+    def process_with_dead_letters(cursor, rows):
+        process_batch(cursor, stage, model_version, rows, process)
+    return process_with_dead_letters
@@ -0,0 +1,229 @@
+import io
+import os
+import time
+import logging
+import configparser
+import psycopg2
+import psycopg2.extras
+import psycopg2.extensions
+import metrics
+import sqlite_backend
+
+# Shared PostgreSQL access for every stage and tool.
+# Connections come from a small per-process pool: closing a pooled connection hands it back
+# instead of disconnecting, so the existing connect/close code in the stages reuses warm
+# connections (parallel workers each get their own pool, since a forked connection cannot be
+# shared). Every connection gets the configured statement timeout, connecting is retried with
+# backoff, and run_transaction retries a unit of work on transient errors (lost connection,
+# deadlock, serialization failure). write_values and copy_rows are the batched write helpers,
+# and iter_keyset is the batched reader every stage streams its input with.
+# With backend = sqlite the same functions work on a local single-file database instead of the
+# server (see sqlite_backend.py), for benchmarks and test runs on one machine.
+
+# Load settings from the ini file
+config = configparser.ConfigParser()
+config.read('settings.ini')
+
+# Storage backend: postgres, or sqlite for the local database file (sqlite_path)
+backend = config.get('database', 'backend', fallback='postgres')
+
+# Connection settings; the optional keys below tune the pool and the retries
+DB_SETTINGS = {
+    "host": config.get('database', 'host', fallback=None),
+    "database": config.get('database', 'database', fallback=None),
+    "user": config.get('database', 'user', fallback=None),
+    "password": config.get('database', 'password', fallback=None),
+    "port": config.get('database', 'port', fallback=None),
+}
+
+# Statement timeout for every connection in milliseconds (0 = no timeout)
+statement_timeout_ms = config.getint('database', 'statement_timeout_ms', fallback=0)
+
+# Idle connections kept per process
+pool_size = config.getint('database', 'pool_size', fallback=4)
+
+# Attempts for connecting and for run_transaction, and the first backoff delay in seconds
+max_retries = config.getint('database', 'max_retries', fallback=3)
+retry_delay = config.getfloat('database', 'retry_delay', fallback=1.0)
+
+# Rows per statement for write_values
+VALUES_PAGE_SIZE = 1000
+
+# Errors worth retrying: the server went away, or the transaction lost a deadlock or serialization race.
+# A statement cancelled by statement_timeout is an OperationalError too, but is not retried (see run_transaction).
+TRANSIENT_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError, psycopg2.extensions.TransactionRollbackError)
+
+# Escapes for the COPY text format (NUL characters cannot be stored in text columns at all)
+COPY_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r', '\x00': ''})
+
+# Idle connections of this process, and the process they belong to
+_idle = []
+_idle_pid = None
+
+
+class PooledConnection(psycopg2.extensions.connection):
+    # close() returns the connection to the pool; discard() really closes it
+    def close(self):
+        release_db(self)
+
+    def discard(self):
+        super().close()
+
+
+# Function to open a new connection, retrying with backoff; returns None if every attempt fails
+def open_connection(statement_timeout=None):
+    timeout = statement_timeout_ms if statement_timeout is None else statement_timeout
+    options = f"-c statement_timeout={timeout}" if timeout else None
+    for attempt in range(1, max_retries + 1):
+        try:
+            conn = psycopg2.connect(connection_factory=PooledConnection, options=options, **DB_SETTINGS)
+            conn.statement_timeout = timeout
+            return conn
+        except psycopg2.OperationalError as e:
+            logging.warning(f"[WARNING] Connection attempt {attempt} of {max_retries} failed: {e}")
+            if attempt < max_retries:
+                time.sleep(retry_delay * 2 ** (attempt - 1))
+    return None
+
+# Function to get a connection from this process's pool (or a new one); statement_timeout
+# overrides the configured timeout in milliseconds. Returns None if no connection can be made.
+def connect_db(statement_timeout=None, autocommit=False):
+    global _idle, _idle_pid
+    if backend == "sqlite":
+        # Opening the file is cheap, so local connections are not pooled
+        return sqlite_backend.connect(statement_timeout_ms if statement_timeout is None else statement_timeout, autocommit)
+    if _idle_pid != os.getpid():
+        # A forked worker must not reuse its parent's connections
+        _idle = []
+        _idle_pid = os.getpid()
+
+    timeout = statement_timeout_ms if statement_timeout is None else statement_timeout
+    conn = None
+    while _idle:
+        candidate = _idle.pop()
+        if not candidate.closed:
+            conn = candidate
+            break
+
+    if conn is None:
+        conn = open_connection(timeout)
+        if conn is None:
+            logging.error("[ERROR] Could not connect to the database.")
+            return None
+        logging.info("[INFO] Connected to the database.")
+    elif conn.statement_timeout != timeout:
+        with conn.cursor() as cursor:
+            cursor.execute("SET statement_timeout = %s", (timeout,))
+        conn.commit()
+        conn.statement_timeout = timeout
+
+    conn.autocommit = autocommit
+    return conn
+
+# Function to hand a connection back to the pool. Unfinished work is rolled back, as closing
+# would have done; broken connections and connections beyond the pool size are closed.
+def release_db(conn):
+    if conn.closed:
+        return
+    status = conn.info.transaction_status
+    if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+        conn.discard()
+        return
+    if status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+        conn.rollback()
+    if _idle_pid == os.getpid() and len(_idle) < pool_size:
+        conn.autocommit = False
+        _idle.append(conn)
+    else:
+        conn.discard()
+
+# Function to close every idle connection of this process
+def close_pool():
+    while _idle:
+        _idle.pop().discard()
+
+# Function to run work(cursor, *args) in one transaction and commit it, retrying with a fresh
+# connection on transient errors. Returns what work returns; other errors are raised, as is a
+# statement cancelled by its timeout (it would only run into the timeout again).
+def run_transaction(work, *args, statement_timeout=None):
+    for attempt in range(1, max_retries + 1):
+        conn = connect_db(statement_timeout)
+        if conn is None:
+            raise psycopg2.OperationalError("could not connect to the database")
+        try:
+            with conn.cursor() as cursor:
+                result = work(cursor, *args)
+            conn.commit()
+            return result
+        except psycopg2.extensions.QueryCanceledError:
+            raise
+        except TRANSIENT_ERRORS as e:
+            if attempt == max_retries:
+                raise
+            logging.warning(f"[WARNING] Transient database error (attempt {attempt} of {max_retries}): {e}")
+            conn.discard()
+            time.sleep(retry_delay * 2 ** (attempt - 1))
+        finally:
+            conn.close()
+
+# Function to stream the rows of a query in batches with keyset pagination. Each batch starts
+# after the last key of the previous one, so every batch is one index range scan however far
+# into the table it is; LIMIT/OFFSET rescans every skipped row, and skips rows outright when
+# the stage's own writes take rows out of the filter. The key column must be unique and
+# selected first. The cursor is free for writes between batches. after resumes after a key.
+def iter_keyset(cursor, select, key, where=None, params=(), batch_size=100, after=None):
+    last_key = after
+    while True:
+        conditions = [f"({where})"] if where else []
+        query_params = list(params)
+        if last_key is not None:
+            conditions.append(f"{key} > %s")
+            query_params.append(last_key)
+        query = select
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        with metrics.timer("db_fetch_seconds"):
+            cursor.execute(f"{query} ORDER BY {key} LIMIT %s", query_params + [batch_size])
+            rows = cursor.fetchall()
+        metrics.count("rows_fetched", len(rows))
+        if not rows:
+            break
+        yield rows
+        if len(rows) < batch_size:
+            break
+        last_key = rows[-1][0]
+
+# Function to write many rows with multi-row statements; query has a single VALUES %s placeholder
+def write_values(cursor, query, rows, template=None, page_size=VALUES_PAGE_SIZE):
+    rows = list(rows)
+    with metrics.timer("db_write_seconds"):
+        if backend == "sqlite":
+            sqlite_backend.write_values(cursor, query, rows, template=template, page_size=page_size)
+        else:
+            psycopg2.extras.execute_values(cursor, query, rows, template=template, page_size=page_size)
+    metrics.count("rows_written", len(rows))
+
+# Function to format one row for the COPY text format (None becomes NULL)
+def copy_row(values):
+    return '\t'.join('\\N' if value is None else str(value).translate(COPY_ESCAPES) for value in values) + '\n'
+
+# Function to COPY rows already formatted with copy_row from a buffer into a table (the caller
+# counts the rows written, since the buffer often goes to a staging table)
+def copy_buffer(cursor, table, columns, buffer):
+    buffer.seek(0)
+    with metrics.timer("db_write_seconds"):
+        if backend == "sqlite":
+            sqlite_backend.copy_buffer(cursor, table, columns, buffer)
+        else:
+            cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN", buffer)
+
+# Function to COPY rows (tuples) into a table; returns the row count
+def copy_rows(cursor, table, columns, rows):
+    buffer = io.StringIO()
+    count = 0
+    for values in rows:
+        buffer.write(copy_row(values))
+        count += 1
+    copy_buffer(cursor, table, columns, buffer)
+    metrics.count("rows_written", count)
+    return count
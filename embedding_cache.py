@@ -0,0 +1,142 @@
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import unicodedata
+import configparser
+import numpy as np
+import metrics
+
+# Persistent cache of text embeddings, keyed by (model name, hash of the normalized text).
+# Reprints, recurring advertisements and re-ingested issues put the same text under several
+# article_ids, and re-runs and model swaps embed texts that were embedded before. encode_cached
+# looks every text up first and only hands the model the texts it has never seen with that
+# model (each distinct text once, even when a batch holds several copies). The text is
+# normalized before hashing (Unicode NFC, runs of whitespace collapsed), so copies that differ
+# only in OCR line breaks share an entry. The cache is a small SQLite file like the encoding
+# cache; when it grows past max_mb, the least recently used entries are evicted.
+
+# Load settings from the ini file
+config = configparser.ConfigParser()
+config.read('settings.ini')
+
+# Location of the cache, its size limit, and whether the stages use it at all
+cache_path = config.get('embedding_cache', 'file', fallback='embedding_cache.db')
+max_mb = config.getfloat('embedding_cache', 'max_mb', fallback=2048)
+enabled = config.getboolean('embedding_cache', 'enabled', fallback=True)
+
+# Share of the limit the cache is trimmed to when it is over, so eviction does not run on every batch
+EVICT_TO = 0.9
+
+# Hashes per lookup statement (SQLite's parameter limit)
+LOOKUP_CHUNK = 900
+
+# Runs of whitespace, collapsed by the normalization
+WHITESPACE_PATTERN = re.compile(r'\s+')
+
+# One cache connection per process (worker processes must not share a forked connection)
+_connection = None
+_connection_key = None
+
+# Function to open (or reuse) the cache database for this process
+def get_cache():
+    global _connection, _connection_key
+    key = (os.getpid(), cache_path)
+    if _connection is None or _connection_key != key:
+        _connection = sqlite3.connect(cache_path, timeout=30)
+        # WAL lets the queue workers of a stage read the cache while one of them writes
+        _connection.execute("PRAGMA journal_mode = WAL")
+        _connection.execute("""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT NOT NULL,
+                content_hash TEXT NOT NULL,
+                dtype TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (model, content_hash)
+            )
+        """)
+        _connection.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON embeddings(last_used)")
+        _connection.commit()
+        _connection_key = key
+    return _connection
+
+# Function to hash a text after normalizing it
+def content_hash(text):
+    normalized = WHITESPACE_PATTERN.sub(' ', unicodedata.normalize('NFC', text or '')).strip()
+    return hashlib.blake2b(normalized.encode('utf-8'), digest_size=16).hexdigest()
+
+# Function to look up cached vectors of a model; returns {hash: vector} for the hashes found and
+# marks them as used
+def lookup(model_name, hashes):
+    connection = get_cache()
+    hashes = list(hashes)
+    found = {}
+    now = time.time()
+    for start in range(0, len(hashes), LOOKUP_CHUNK):
+        chunk = hashes[start:start + LOOKUP_CHUNK]
+        placeholders = ', '.join('?' * len(chunk))
+        rows = connection.execute(
+            f"SELECT content_hash, dtype, vector FROM embeddings WHERE model = ? AND content_hash IN ({placeholders})",
+            [model_name] + chunk).fetchall()
+        for key, dtype, vector in rows:
+            found[key] = np.frombuffer(vector, dtype=dtype)
+        if rows:
+            connection.execute(
+                f"UPDATE embeddings SET last_used = ? WHERE model = ? AND content_hash IN ({', '.join('?' * len(rows))})",
+                [now, model_name] + [row[0] for row in rows])
+    connection.commit()
+    return found
+
+# Function to add vectors of a model ({hash: vector}) to the cache, then evict if it is over the limit
+def store(model_name, vectors):
+    connection = get_cache()
+    now = time.time()
+    connection.executemany(
+        "INSERT OR REPLACE INTO embeddings (model, content_hash, dtype, vector, last_used) VALUES (?, ?, ?, ?, ?)",
+        [(model_name, key, vector.dtype.str, vector.tobytes(), now) for key, vector in vectors.items()])
+    connection.commit()
+    evict()
+
+# Function to evict the least recently used entries while the cache is over max_mb. The size is
+# the pages in use (freed pages are reused by later inserts, so the file stops growing).
+def evict():
+    connection = get_cache()
+    page_size = connection.execute("PRAGMA page_size").fetchone()[0]
+    pages = connection.execute("PRAGMA page_count").fetchone()[0] - connection.execute("PRAGMA freelist_count").fetchone()[0]
+    used = pages * page_size
+    limit = max_mb * 1024 * 1024
+    if used <= limit:
+        return 0
+    entries = connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+    evicted = entries - int(entries * limit * EVICT_TO / used)
+    connection.execute("""
+        DELETE FROM embeddings WHERE rowid IN (SELECT rowid FROM embeddings ORDER BY last_used LIMIT ?)
+    """, (evicted,))
+    connection.commit()
+    metrics.count("embedding_cache_evictions", evicted)
+    return evicted
+
+# Function to embed texts through the cache: encode(indexes) must return the vectors of
+# texts[indexes] and is only called for texts not cached for this model. Returns the vectors
+# of all texts, in order, as one array.
+def encode_cached(model_name, texts, encode, use_cache=None):
+    use_cache = enabled if use_cache is None else use_cache
+    hashes = [content_hash(text) for text in texts]
+    found = lookup(model_name, set(hashes)) if use_cache else {}
+
+    # The first text of every hash not found is encoded; its copies reuse the vector
+    missing = {}
+    for index, key in enumerate(hashes):
+        if key not in found and key not in missing:
+            missing[key] = index
+    metrics.count("embedding_cache_hits", len(texts) - len(missing))
+    metrics.count("embedding_cache_misses", len(missing))
+
+    if missing:
+        encoded = dict(zip(missing, encode(list(missing.values()))))
+        if use_cache:
+            store(model_name, encoded)
+        found.update(encoded)
+    return np.stack([found[key] for key in hashes])
@@ -0,0 +1,152 @@
+import os
+import queue
+import logging
+import multiprocessing
+import metrics
+
+# Pool of encoder processes with a single writer (5_sentence_transformer.py --encoders N).
+# One encode call does not keep a many-core CPU busy, and one Python interpreter cannot do more.
+# The pool starts N encoder processes. Each loads the model, takes its own share of the cores
+# (pinned to them where the OS allows, with that many torch threads), encodes the batches it
+# takes from a shared task queue and sends the results back. The parent process reads the
+# batches and writes the results in input order, one batch per transaction as without the pool,
+# so the checkpoints and dead letters work unchanged (see checkpoints.py). A bounded number of
+# batches is in flight, so reading stays just ahead of the encoders.
+
+# Environment variables of the native thread pools, set for the encoder processes before they
+# import torch
+THREAD_VARIABLES = ("OMP_NUM_THREADS", "MKL_NUM_THREADS")
+
+# Seconds between checks that the encoders are still alive while waiting for a result
+POLL_SECONDS = 5
+
+# Error of an article an encoder could not embed, raised where its result is written
+class EncodeError(Exception):
+    pass
+
+# Function to list the cores this process may run on
+def available_cores():
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+# Function to split the cores among the encoders, `threads` each; None for every encoder when
+# there are too few cores to give each its own (the OS then schedules them)
+def core_sets(encoders, threads):
+    cores = available_cores()
+    if not hasattr(os, "sched_setaffinity") or encoders * threads > len(cores):
+        return [None] * encoders
+    return [cores[index * threads:(index + 1) * threads] for index in range(encoders)]
+
+# Function to encode a batch of rows keyed by article_id (first column); when the batch fails,
+# its rows are encoded one at a time so one bad article does not fail the others. Returns
+# ({article_id: result}, {article_id: error}).
+def encode_rows(encode, rows):
+    try:
+        return encode(rows), {}
+    except Exception as e:
+        logging.warning(f"[WARNING] Encoder {os.getpid()}: batch of {len(rows)} failed ({e}); encoding its articles one at a time.")
+    encoded = {}
+    errors = {}
+    for row in rows:
+        try:
+            encoded.update(encode([row]))
+        except Exception as e:
+            errors[row[0]] = f"{type(e).__name__}: {e}"
+    return encoded, errors
+
+# Function run in each encoder process: set its torch threads, then encode (sequence, rows)
+# tasks until it receives None. Its metrics are written per process.
+def encoder_process(stage, encode, threads, tasks, results):
+    @metrics.instrumented(stage, per_process=True)
+    def run():
+        import torch
+        torch.set_num_threads(threads)
+        try:
+            torch.set_num_interop_threads(1)
+        except RuntimeError:
+            # Already set when the stage module applied this host's tuned settings
+            pass
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            sequence, rows = task
+            encoded, errors = encode_rows(encode, rows)
+            results.put((sequence, encoded, errors))
+    run()
+
+# Function to start the encoder processes; encode(rows) must be picklable (a module-level
+# function, or a functools.partial of one)
+def start_encoders(context, stage, encode, encoders, threads, tasks, results):
+    processes = []
+    saved = {name: os.environ.get(name) for name in THREAD_VARIABLES}
+    os.environ.update({name: str(threads) for name in THREAD_VARIABLES})
+    try:
+        for cores in core_sets(encoders, threads):
+            process = context.Process(target=encoder_process, args=(stage, encode, threads, tasks, results), daemon=True)
+            process.start()
+            # Pinned while the interpreter is still starting, so the threads torch creates
+            # later inherit the cores
+            if cores:
+                os.sched_setaffinity(process.pid, cores)
+            processes.append(process)
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+    return processes
+
+# Generator running the batches through a pool of encoder processes: yields (rows, {article_id:
+# result}, {article_id: error}) for every batch, in input order. threads is the torch threads
+# (and cores) per encoder, by default the available cores divided among the encoders; window is
+# the batches in flight (default two per encoder).
+def run_pool(stage, encode, batches, encoders, threads=None, window=None):
+    threads = threads or max(1, len(available_cores()) // encoders)
+    window = window or 2 * encoders
+    context = multiprocessing.get_context("spawn")
+    tasks = context.Queue()
+    results = context.Queue()
+    processes = start_encoders(context, stage, encode, encoders, threads, tasks, results)
+    logging.info(f"[INFO] Stage {stage}: started {encoders} encoder processes with {threads} threads each.")
+
+    batches = iter(batches)
+    pending = {}
+    ready = {}
+    sent = 0
+    next_sequence = 0
+    finished = False
+    try:
+        while True:
+            while len(pending) < window:
+                rows = next(batches, None)
+                if rows is None:
+                    break
+                tasks.put((sent, rows))
+                pending[sent] = rows
+                sent += 1
+            if not pending:
+                break
+
+            while next_sequence not in ready:
+                try:
+                    sequence, encoded, errors = results.get(timeout=POLL_SECONDS)
+                    ready[sequence] = (encoded, errors)
+                except queue.Empty:
+                    dead = [process for process in processes if not process.is_alive()]
+                    if dead:
+                        raise RuntimeError(f"encoder process {dead[0].pid} exited with code {dead[0].exitcode}")
+            encoded, errors = ready.pop(next_sequence)
+            yield pending.pop(next_sequence), encoded, errors
+            next_sequence += 1
+        finished = True
+    finally:
+        # The encoders stop after their last task; on an error they are stopped at once
+        for _ in processes:
+            tasks.put(None)
+        for process in processes:
+            if not finished:
+                process.terminate()
+            process.join()
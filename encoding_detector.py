@@ -0,0 +1,227 @@
+import os
+import re
+import mmap
+import codecs
+import sqlite3
+import hashlib
+import contextlib
+import configparser
+import chardet
+
+# Sampled, cached encoding detection for the segmentation stages.
+# chardet is run on a bounded sample of each file first; the whole file is only scanned
+# when the sample is inconclusive or the guessed encoding fails to decode the full file. A
+# sample that holds every non-ASCII line of the file is conclusive on its own.
+# Results are cached per file (size + mtime + content hash), so later stages and re-runs
+# skip detection entirely. Files are memory-mapped and hashed, validated and (if needed)
+# fully scanned in chunks, so memory use stays bounded even for whole bound volumes.
+
+# Load settings from the ini file
+config = configparser.ConfigParser()
+config.read('settings.ini')
+
+# Location of the persistent detection cache (a small SQLite file)
+cache_path = config.get('directories', 'encoding_cache', fallback='encoding_cache.db')
+
+# Bytes handed to chardet before falling back to a full scan
+SAMPLE_SIZE = 64 * 1024
+
+# Bytes of the sample taken from the head of the file (for a BOM or an all-ASCII file); the rest
+# of the sample goes to the lines with non-ASCII bytes
+HEAD_SIZE = 8 * 1024
+
+# Chunk size for hashing, validating and full scans of memory-mapped files
+CHUNK_SIZE = 4 * 1024 * 1024
+
+# Runs of non-ASCII bytes, used to pick the informative lines for the sample
+NON_ASCII_PATTERN = re.compile(rb'[\x80-\xff]+')
+
+# Minimum chardet confidence for a sample result to be trusted (chardet caps
+# single-byte Latin results at 0.73, so a higher bar would always force a full scan)
+MIN_CONFIDENCE = 0.7
+
+# One cache connection per process (worker processes must not share a forked connection)
+_connection = None
+_connection_key = None
+
+# Function to open (or reuse) the cache database for this process
+def get_cache():
+    global _connection, _connection_key
+    key = (os.getpid(), cache_path)
+    if _connection is None or _connection_key != key:
+        _connection = sqlite3.connect(cache_path, timeout=30)
+        _connection.execute("""
+            CREATE TABLE IF NOT EXISTS encodings (
+                path TEXT PRIMARY KEY,
+                size INTEGER,
+                mtime_ns INTEGER,
+                content_hash TEXT,
+                encoding TEXT,
+                confidence REAL,
+                method TEXT
+            )
+        """)
+        _connection.execute("CREATE INDEX IF NOT EXISTS idx_encodings_content_hash ON encodings(content_hash)")
+        _connection.commit()
+        _connection_key = key
+    return _connection
+
+# Function to build a bounded sample: the head of the file plus the lines around non-ASCII bytes.
+# OCR text is almost all ASCII, so the few non-ASCII lines are what tell encodings apart.
+# Returns the sample and whether it holds every line of the file with non-ASCII bytes.
+def build_sample(raw_data, sample_size=SAMPLE_SIZE, head_size=HEAD_SIZE):
+    if len(raw_data) <= sample_size:
+        return raw_data, True
+
+    # The head ends at a line break, so that no character is cut in two
+    head = raw_data[:raw_data.rfind(b'\n', 0, head_size) + 1 or head_size]
+    snippets = []
+    budget = sample_size - len(head)
+    position = len(head)
+    for match in NON_ASCII_PATTERN.finditer(raw_data, len(head)):
+        # A line with several non-ASCII runs is taken once
+        if match.start() < position:
+            continue
+        line_start = max(raw_data.rfind(b'\n', 0, match.start()) + 1, len(head))
+        line_end = raw_data.find(b'\n', match.end())
+        if line_end == -1:
+            line_end = len(raw_data)
+        snippet = raw_data[line_start:line_end]
+        if len(snippet) > budget:
+            return b'\n'.join([head] + snippets), False
+        snippets.append(snippet)
+        budget -= len(snippet) + 1
+        position = line_end
+    return b'\n'.join([head] + snippets), True
+
+# Function to check whether an encoding keeps ASCII as it is, so that a file's ASCII bytes decode
+# the same in any encoding and only its non-ASCII lines tell encodings apart
+def ascii_compatible(encoding):
+    try:
+        return codecs.lookup(encoding).decode(b'Trinity Journal\n')[0] == 'Trinity Journal\n'
+    except (LookupError, UnicodeDecodeError):
+        return False
+
+# Function to memory-map a file read-only (empty files cannot be mapped, so they come back as b'')
+@contextlib.contextmanager
+def open_mapped(path):
+    with open(path, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            yield b''
+        else:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                yield mapped
+
+# Function to hash file contents chunk by chunk
+def content_sha1(raw_data, chunk_size=CHUNK_SIZE):
+    digest = hashlib.sha1()
+    for offset in range(0, len(raw_data), chunk_size):
+        digest.update(raw_data[offset:offset + chunk_size])
+    return digest.hexdigest()
+
+# Function to get the content hash of a file: from the cache when the file is unchanged since it
+# was hashed, otherwise hashed in chunks over a memory map and recorded, so that detect_encoding
+# (and the incremental runs of segmenter.py) never hash the same file twice
+def file_sha1(file_path, use_cache=True):
+    path = os.path.abspath(file_path)
+    stat = os.stat(path)
+
+    if use_cache:
+        cache = get_cache()
+        row = cache.execute(
+            "SELECT size, mtime_ns, content_hash FROM encodings WHERE path = ?", (path,)
+        ).fetchone()
+        if row and row[0] == stat.st_size and row[1] == stat.st_mtime_ns and row[2]:
+            return row[2]
+
+    with open_mapped(path) as raw_data:
+        content_hash = content_sha1(raw_data)
+
+    # Recorded without an encoding; detect_encoding fills it in when the file is first read
+    if use_cache:
+        cache.execute(
+            "INSERT OR REPLACE INTO encodings (path, size, mtime_ns, content_hash) VALUES (?, ?, ?, ?)",
+            (path, stat.st_size, stat.st_mtime_ns, content_hash)
+        )
+        cache.commit()
+    return content_hash
+
+# Function to check that an encoding decodes the whole file without errors
+def decodes_cleanly(raw_data, encoding, chunk_size=CHUNK_SIZE):
+    if encoding.lower() == 'ascii':
+        return NON_ASCII_PATTERN.search(raw_data) is None
+    try:
+        decoder = codecs.getincrementaldecoder(encoding)()
+        for offset in range(0, len(raw_data), chunk_size):
+            decoder.decode(raw_data[offset:offset + chunk_size])
+        decoder.decode(b'', final=True)
+        return True
+    except (UnicodeDecodeError, LookupError):
+        return False
+
+# Function to detect the encoding of raw bytes, sampling first and scanning fully only if needed
+def detect_bytes(raw_data, sample_size=SAMPLE_SIZE, min_confidence=MIN_CONFIDENCE, chunk_size=CHUNK_SIZE):
+    if len(raw_data) > sample_size:
+        sample, complete = build_sample(raw_data, sample_size)
+        result = chardet.detect(sample)
+        encoding = result['encoding']
+        confidence = result['confidence'] or 0.0
+        # A sample with every non-ASCII line of the file holds all the evidence a full scan would
+        # see, so its guess stands at any confidence (newer chardet releases rate single-byte
+        # Latin text below MIN_CONFIDENCE), and decoding the sample checks the whole file
+        if encoding and complete and ascii_compatible(encoding) and decodes_cleanly(sample, encoding, chunk_size):
+            return encoding, confidence, 'sample'
+        if encoding and confidence >= min_confidence and decodes_cleanly(raw_data, encoding, chunk_size):
+            return encoding, confidence, 'sample'
+
+    # Full scan, fed to chardet in chunks so the file never has to be copied into memory
+    detector = chardet.UniversalDetector()
+    for offset in range(0, len(raw_data), chunk_size):
+        detector.feed(raw_data[offset:offset + chunk_size])
+        if detector.done:
+            break
+    detector.close()
+    return detector.result['encoding'], detector.result['confidence'] or 0.0, 'full'
+
+# Function to detect the encoding of a file, using the cache when the file is unchanged
+def detect_encoding(file_path, use_cache=True):
+    path = os.path.abspath(file_path)
+    stat = os.stat(path)
+
+    # An unchanged file returns its cached encoding, or reuses its hash if it was only hashed so far
+    content_hash = None
+    if use_cache:
+        cache = get_cache()
+        row = cache.execute(
+            "SELECT size, mtime_ns, encoding, content_hash FROM encodings WHERE path = ?", (path,)
+        ).fetchone()
+        if row and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+            if row[2]:
+                return row[2]
+            content_hash = row[3]
+
+    with open_mapped(path) as raw_data:
+        # The hash is only needed for the cache
+        if use_cache and content_hash is None:
+            content_hash = content_sha1(raw_data)
+
+        # A file with identical content seen under any path (or before a touch) reuses its result
+        cached = None
+        if use_cache:
+            cached = cache.execute(
+                "SELECT encoding, confidence FROM encodings WHERE content_hash = ? AND encoding IS NOT NULL LIMIT 1", (content_hash,)
+            ).fetchone()
+
+        if cached:
+            encoding, confidence, method = cached[0], cached[1], 'cache'
+        else:
+            encoding, confidence, method = detect_bytes(raw_data)
+
+    if use_cache:
+        cache.execute(
+            "INSERT OR REPLACE INTO encodings (path, size, mtime_ns, content_hash, encoding, confidence, method) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (path, stat.st_size, stat.st_mtime_ns, content_hash, encoding, confidence, method)
+        )
+        cache.commit()
+
+    return encoding
@@ -0,0 +1,239 @@
+import os
+import time
+import socket
+import logging
+import threading
+import contextlib
+import configparser
+import multiprocessing
+import psycopg2
+import database
+from database import connect_db
+import metrics
+import profiling
+
+# Work queue for the stages that process articles one batch at a time (5_, 6_, 8_, 11_).
+# Every (stage, article) pair is a row in article_jobs. Workers claim batches with
+# SELECT ... FOR UPDATE SKIP LOCKED, so any number of worker processes, on one machine or
+# several, share a stage without ever claiming the same article. A claim is a lease: a
+# worker that dies leaves its jobs running until the lease expires, and then they are
+# claimed again. While a batch is processed, a heartbeat keeps renewing its lease, so a batch
+# slower than lease_seconds is not claimed by a second worker. A failed batch goes back to
+# pending until it has used up max_attempts, after which its jobs stay failed with the last error.
+# A stage's writes and the completion of its jobs are committed in the same transaction, and
+# only jobs still leased to the worker are completed or handed back: a worker that lost a job
+# to another worker (after the lease expired anyway, say while the database was unreachable)
+# rolls its batch back.
+
+# Load settings from the ini file
+config = configparser.ConfigParser()
+config.read('settings.ini')
+
+# Seconds a claimed batch stays leased to its worker
+lease_seconds = config.getint('queue', 'lease_seconds', fallback=600)
+
+# Attempts per job before it is left as failed
+max_attempts = config.getint('queue', 'max_attempts', fallback=3)
+
+# Function to create the job table if it does not exist (workers starting together take turns,
+# since concurrent CREATE TABLE IF NOT EXISTS can still collide)
+def ensure_job_table(cursor):
+    cursor.execute("SELECT pg_advisory_xact_lock(hashtext('article_jobs'));")
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS article_jobs (
+            stage VARCHAR(50) NOT NULL,
+            article_id INT NOT NULL REFERENCES Articles(article_id),
+            status VARCHAR(20) NOT NULL DEFAULT 'pending',  -- pending, running, done or failed
+            attempts INT NOT NULL DEFAULT 0,
+            worker VARCHAR(255),
+            lease_expires_at TIMESTAMP,
+            last_error TEXT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (stage, article_id)
+        );
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_article_jobs_claim ON article_jobs (stage, status, article_id);")
+
+# Function to add a job for every article matching the stage's filter that has none yet; returns the count
+def enqueue_jobs(cursor, stage, where=None):
+    cursor.execute(f"""
+        INSERT INTO article_jobs (stage, article_id)
+        SELECT %s, article_id FROM articles {f'WHERE {where}' if where else ''}
+        ON CONFLICT (stage, article_id) DO NOTHING;
+    """, (stage,))
+    return cursor.rowcount
+
+# Function to claim the next batch of jobs for a worker: pending jobs, and running jobs whose
+# lease has expired. Jobs out of attempts are marked failed first. Returns the article IDs.
+def claim_jobs(cursor, stage, worker, batch_size, lease=None, attempts=None):
+    lease = lease_seconds if lease is None else lease
+    attempts = max_attempts if attempts is None else attempts
+    cursor.execute("""
+        UPDATE article_jobs SET status = 'failed', lease_expires_at = NULL, updated_at = NOW(),
+            last_error = COALESCE(last_error, 'lease expired')
+        WHERE stage = %s AND status = 'running' AND lease_expires_at < NOW() AND attempts >= %s;
+    """, (stage, attempts))
+    cursor.execute("""
+        WITH claimed AS (
+            SELECT stage, article_id FROM article_jobs
+            WHERE stage = %s AND (status = 'pending' OR (status = 'running' AND lease_expires_at < NOW()))
+            ORDER BY article_id
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        )
+        UPDATE article_jobs j SET status = 'running', worker = %s, attempts = j.attempts + 1,
+            lease_expires_at = NOW() + %s * INTERVAL '1 second', updated_at = NOW()
+        FROM claimed c
+        WHERE j.stage = c.stage AND j.article_id = c.article_id
+        RETURNING j.article_id;
+    """, (stage, batch_size, worker, lease))
+    return sorted(row[0] for row in cursor.fetchall())
+
+# Function to mark a worker's claimed jobs as done; jobs no longer leased to it are left alone.
+# Returns the count completed.
+def complete_jobs(cursor, stage, worker, article_ids):
+    cursor.execute("""
+        UPDATE article_jobs SET status = 'done', lease_expires_at = NULL, last_error = NULL, updated_at = NOW()
+        WHERE stage = %s AND article_id = ANY(%s) AND worker = %s AND status = 'running';
+    """, (stage, list(article_ids), worker))
+    return cursor.rowcount
+
+# Function to hand a worker's failed jobs back to the queue, or leave them failed once out of
+# attempts; jobs no longer leased to it are left alone
+def fail_jobs(cursor, stage, worker, article_ids, error, attempts=None):
+    attempts = max_attempts if attempts is None else attempts
+    cursor.execute("""
+        UPDATE article_jobs SET status = CASE WHEN attempts >= %s THEN 'failed' ELSE 'pending' END,
+            lease_expires_at = NULL, last_error = %s, updated_at = NOW()
+        WHERE stage = %s AND article_id = ANY(%s) AND worker = %s AND status = 'running';
+    """, (attempts, error[:1000], stage, list(article_ids), worker))
+
+# Function to extend the lease of a worker's jobs that are still running; returns the count.
+# Jobs locked by the worker's own transaction (being completed) are skipped, not waited for.
+def renew_lease(cursor, stage, worker, article_ids, lease=None):
+    lease = lease_seconds if lease is None else lease
+    cursor.execute("""
+        WITH leased AS (
+            SELECT stage, article_id FROM article_jobs
+            WHERE stage = %s AND article_id = ANY(%s) AND worker = %s AND status = 'running'
+            FOR UPDATE SKIP LOCKED
+        )
+        UPDATE article_jobs j SET lease_expires_at = NOW() + %s * INTERVAL '1 second', updated_at = NOW()
+        FROM leased l
+        WHERE j.stage = l.stage AND j.article_id = l.article_id;
+    """, (stage, list(article_ids), worker, lease))
+    return cursor.rowcount
+
+# Context manager renewing the lease of a batch every third of the lease while the batch is
+# processed, from a thread with its own connection
+@contextlib.contextmanager
+def lease_heartbeat(stage, worker, article_ids, lease=None):
+    lease = lease_seconds if lease is None else lease
+    stop = threading.Event()
+
+    def beat():
+        while not stop.wait(lease / 3):
+            try:
+                database.run_transaction(renew_lease, stage, worker, article_ids, lease)
+            except psycopg2.Error as e:
+                logging.warning(f"[WARNING] Worker {worker}: could not renew the lease of its {stage} batch: {e}")
+
+    thread = threading.Thread(target=beat, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+# Function to put a stage's failed jobs back in the queue with fresh attempts; returns the count
+def requeue_failed(cursor, stage):
+    cursor.execute("""
+        UPDATE article_jobs SET status = 'pending', attempts = 0, updated_at = NOW()
+        WHERE stage = %s AND status = 'failed';
+    """, (stage,))
+    return cursor.rowcount
+
+# Function to count a stage's jobs by status
+def job_counts(cursor, stage):
+    cursor.execute("SELECT status, COUNT(*) FROM article_jobs WHERE stage = %s GROUP BY status;", (stage,))
+    return dict(cursor.fetchall())
+
+# Function to run one worker until the stage's queue is empty. select_rows is a query with one
+# ANY(%s) placeholder for the claimed article IDs; process_batch(cursor, rows) does the stage's
+# work and writes on the given cursor, and is committed together with the job completions.
+def run_worker(stage, select_rows, process_batch, batch_size=100, where=None):
+    if database.backend == "sqlite":
+        logging.error(f"[ERROR] The {stage} queue needs PostgreSQL (FOR UPDATE SKIP LOCKED); on the local SQLite database run the stage without --queue.")
+        return 0
+
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    conn = connect_db()
+    if conn is None:
+        return 0
+
+    with conn.cursor() as cursor:
+        ensure_job_table(cursor)
+        added = enqueue_jobs(cursor, stage, where)
+    conn.commit()
+    if added:
+        logging.info(f"[INFO] Queued {added} new {stage} jobs.")
+
+    processed = 0
+    start = time.time()
+    while True:
+        with conn.cursor() as cursor:
+            article_ids = claim_jobs(cursor, stage, worker, batch_size)
+        conn.commit()
+        if not article_ids:
+            break
+
+        try:
+            with lease_heartbeat(stage, worker, article_ids):
+                with conn.cursor() as cursor, profiling.batch():
+                    with metrics.timer("db_fetch_seconds"):
+                        cursor.execute(select_rows, (article_ids,))
+                        rows = cursor.fetchall()
+                    metrics.count("rows_fetched", len(rows))
+                    process_batch(cursor, rows)
+                    completed = complete_jobs(cursor, stage, worker, article_ids)
+                if completed < len(article_ids):
+                    # Another worker has claimed some of the jobs; it writes them
+                    conn.rollback()
+                    logging.warning(f"[WARNING] Worker {worker}: {len(article_ids) - completed} of its {len(article_ids)} {stage} jobs were claimed by another worker; batch rolled back.")
+                    with conn.cursor() as cursor:
+                        fail_jobs(cursor, stage, worker, article_ids, "lease lost to another worker")
+                    conn.commit()
+                    continue
+                conn.commit()
+            processed += len(article_ids)
+            logging.info(f"[INFO] Worker {worker}: {processed} {stage} jobs done ({processed / max(time.time() - start, 1e-9):.1f}/s).")
+        except Exception as e:
+            conn.rollback()
+            metrics.count("errors")
+            logging.error(f"[ERROR] Worker {worker}: batch of {len(article_ids)} {stage} jobs failed: {e}")
+            with conn.cursor() as cursor:
+                fail_jobs(cursor, stage, worker, article_ids, str(e))
+            conn.commit()
+
+    with conn.cursor() as cursor:
+        counts = job_counts(cursor, stage)
+    conn.commit()
+    conn.close()
+    logging.info(f"[INFO] Worker {worker} finished: {processed} jobs done; {stage} queue: {counts}.")
+    return processed
+
+# Function to run a worker function in `workers` processes on this machine (1 runs it in this
+# process). Further machines simply run the same stage with --queue against the same database.
+def run_workers(target, workers=1):
+    if workers <= 1:
+        target()
+        return
+    if profiling.is_active():
+        logging.warning("[WARNING] --profile only samples this process, not the worker processes; use --workers 1 to profile the stage.")
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=target) for _ in range(workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
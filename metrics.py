@@ -0,0 +1,226 @@
+import os
+import json
+import time
+import socket
+import logging
+import functools
+import contextlib
+import configparser
+from datetime import datetime
+
+# Per-stage throughput and latency metrics.
+# A stage's entry function is wrapped with @instrumented("stage"); while it runs, the shared
+# helpers (database.iter_keyset, write_values, copy_buffer) and the stage's own model calls
+# record into the active stage's counters and latency histograms. When the stage finishes,
+# the metrics are written as a Prometheus textfile (for node_exporter's textfile collector)
+# and as a JSON summary, both in the metrics directory.
+
+# Load settings from the ini file
+config = configparser.ConfigParser()
+config.read('settings.ini')
+
+# Directory for the .prom textfiles and JSON summaries
+metrics_directory = config.get('metrics', 'directory', fallback='metrics')
+
+# Whether count_tokens runs the model's tokenizer over every batch a second time for an exact
+# token count; by default the stages count whitespace-separated words, which costs nothing
+exact_tokens = config.getboolean('metrics', 'exact_tokens', fallback=False)
+
+# Histogram buckets in seconds, from a fast DB round trip to a slow model batch
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Counters that are also exported as a per-second rate over the run
+RATE_COUNTERS = ("articles", "tokens", "rows_fetched", "rows_written")
+
+# Descriptions of the metrics the stages record (anything else is exported undescribed)
+DESCRIPTIONS = {
+    "articles": "Articles (or summaries, entities) processed",
+    "tokens": "Model input tokens processed",
+    "rows_written": "Rows written to the database",
+    "rows_fetched": "Rows read from the database",
+    "errors": "Errors caught while processing",
+    "model_batch_seconds": "Latency of one model batch",
+    "db_fetch_seconds": "Latency of one database read",
+    "db_write_seconds": "Latency of one batched database write",
+}
+
+
+class StageMetrics:
+    def __init__(self, stage, per_process=False):
+        self.stage = stage
+        self.per_process = per_process
+        self.started = time.time()
+        self.finished = None
+        self.counters = {}
+        self.observations = {}
+
+    # Function to add to a counter
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    # Function to record one latency observation in seconds
+    def observe(self, name, seconds):
+        self.observations.setdefault(name, []).append(seconds)
+
+    # Function to time a block of code into a histogram
+    @contextlib.contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    # Function to compute the run time and per-second rates of the counters
+    def rates(self):
+        seconds = max((self.finished or time.time()) - self.started, 1e-9)
+        return seconds, {f"{name}_per_second": self.counters[name] / seconds for name in RATE_COUNTERS if name in self.counters}
+
+    # Function to summarize the histograms (count, sum, mean, p50, p95, max)
+    def histogram_summary(self):
+        summary = {}
+        for name, values in self.observations.items():
+            ordered = sorted(values)
+            summary[name] = {
+                "count": len(ordered),
+                "sum": sum(ordered),
+                "mean": sum(ordered) / len(ordered),
+                "p50": ordered[len(ordered) // 2],
+                "p95": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+                "max": ordered[-1],
+            }
+        return summary
+
+    # Function to build the label set of every series; per-process metrics also carry host and
+    # pid, because node_exporter rejects the same series appearing in two textfiles
+    def labels(self):
+        labels = f'stage="{self.stage}"'
+        if self.per_process:
+            labels += f',host="{socket.gethostname()}",pid="{os.getpid()}"'
+        return labels
+
+    # Function to render the metrics in the Prometheus text exposition format
+    def prometheus_text(self):
+        labels = self.labels()
+        seconds, rates = self.rates()
+        lines = [
+            "# HELP trinity_stage_seconds Wall time of the stage run",
+            "# TYPE trinity_stage_seconds gauge",
+            f"trinity_stage_seconds{{{labels}}} {seconds:.6f}",
+            "# HELP trinity_stage_last_run_timestamp_seconds End of the stage run",
+            "# TYPE trinity_stage_last_run_timestamp_seconds gauge",
+            f"trinity_stage_last_run_timestamp_seconds{{{labels}}} {self.finished or time.time():.3f}",
+        ]
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"# HELP trinity_{name}_total {DESCRIPTIONS.get(name, name)}")
+            lines.append(f"# TYPE trinity_{name}_total counter")
+            lines.append(f"trinity_{name}_total{{{labels}}} {value}")
+        for name, value in sorted(rates.items()):
+            lines.append(f"# HELP trinity_{name} Average rate over the stage run")
+            lines.append(f"# TYPE trinity_{name} gauge")
+            lines.append(f"trinity_{name}{{{labels}}} {value:.6f}")
+        for name, values in sorted(self.observations.items()):
+            lines.append(f"# HELP trinity_{name} {DESCRIPTIONS.get(name, name)}")
+            lines.append(f"# TYPE trinity_{name} histogram")
+            for bucket in BUCKETS:
+                lines.append(f'trinity_{name}_bucket{{{labels},le="{bucket}"}} {sum(1 for value in values if value <= bucket)}')
+            lines.append(f'trinity_{name}_bucket{{{labels},le="+Inf"}} {len(values)}')
+            lines.append(f"trinity_{name}_sum{{{labels}}} {sum(values):.6f}")
+            lines.append(f"trinity_{name}_count{{{labels}}} {len(values)}")
+        return "\n".join(lines) + "\n"
+
+    # Function to build the JSON summary of the run
+    def summary(self):
+        seconds, rates = self.rates()
+        return {
+            "stage": self.stage,
+            "host": socket.gethostname(),
+            "pid": os.getpid(),
+            "started": datetime.fromtimestamp(self.started).isoformat(timespec='seconds'),
+            "seconds": seconds,
+            "counters": self.counters,
+            "rates": rates,
+            "latency": self.histogram_summary(),
+        }
+
+    # Function to write the Prometheus textfile and the JSON summary; returns their paths
+    def write(self, directory=None, suffix=""):
+        directory = directory or metrics_directory
+        os.makedirs(directory, exist_ok=True)
+        paths = []
+        for extension, content in ((".prom", self.prometheus_text()), ("_metrics.json", json.dumps(self.summary(), indent=2))):
+            path = os.path.join(directory, f"{self.stage}{suffix}{extension}")
+            # Written under a temporary name first, so the textfile collector never reads half a file
+            with open(path + ".tmp", 'w', encoding='utf-8') as file:
+                file.write(content)
+            os.replace(path + ".tmp", path)
+            paths.append(path)
+        return paths
+
+
+# The stage currently running in this process (helpers record into a throwaway one otherwise)
+_active = StageMetrics("unassigned")
+
+# Function to get the active stage's metrics
+def current():
+    return _active
+
+# Function to add to a counter of the active stage
+def count(name, amount=1):
+    _active.count(name, amount)
+
+# Function to time a block of code into a histogram of the active stage
+def timer(name):
+    return _active.timer(name)
+
+# Function to count the model input tokens of a batch of texts. The model pipelines tokenize
+# internally and do not return their encodings, so an exact count means tokenizing the batch
+# again; that only happens with exact_tokens set (and a tokenizer given). Otherwise the words
+# are counted.
+def count_tokens(texts, tokenizer=None):
+    texts = [text or '' for text in texts]
+    if tokenizer is not None and exact_tokens:
+        try:
+            amount = sum(len(ids) for ids in tokenizer(texts, add_special_tokens=False)["input_ids"])
+        except Exception:
+            amount = sum(len(text.split()) for text in texts)
+    else:
+        amount = sum(len(text.split()) for text in texts)
+    _active.count("tokens", amount)
+
+# Function to log a one-line summary of a finished stage
+def log_summary(stage_metrics):
+    seconds, rates = stage_metrics.rates()
+    parts = [f"{seconds:.1f} s"]
+    parts += [f"{name.replace('_per_second', '')} {value:.1f}/s" for name, value in sorted(rates.items())]
+    for name, summary in sorted(stage_metrics.histogram_summary().items()):
+        parts.append(f"{name} p50 {summary['p50'] * 1000:.1f} ms p95 {summary['p95'] * 1000:.1f} ms")
+    logging.info(f"[INFO] Stage {stage_metrics.stage}: " + ", ".join(parts))
+
+# Decorator for a stage's entry function: collects the stage's metrics while it runs and writes
+# them when it ends (also after an error). Worker processes (per_process=True) each write
+# their own files, named with host and pid, and label their series with both.
+def instrumented(stage, per_process=False):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            global _active
+            previous, _active = _active, StageMetrics(stage, per_process)
+            stage_metrics = _active
+            try:
+                return function(*args, **kwargs)
+            except Exception:
+                stage_metrics.count("errors")
+                raise
+            finally:
+                stage_metrics.finished = time.time()
+                _active = previous
+                suffix = f"_{socket.gethostname()}_{os.getpid()}" if per_process else ""
+                try:
+                    paths = stage_metrics.write(suffix=suffix)
+                    log_summary(stage_metrics)
+                    logging.info(f"[INFO] Metrics saved to {', '.join(paths)}")
+                except OSError as e:
+                    logging.error(f"[ERROR] Could not save the metrics of stage {stage}: {e}")
+        return wrapper
+    return decorator
@@ -0,0 +1,28 @@
+import functools
+
+# Shared model loading for the stages and the query tool.
+# Every model is loaded once per process and reused: when pipeline.py runs several stages in
+# one process, a model two stages share (the NER model of 6_ and 11_) is loaded only once,
+# and the query tool no longer reloads its models for every question.
+
+# Function to load (or reuse) a Hugging Face pipeline; arguments must be hashable
+@functools.lru_cache(maxsize=None)
+def get_pipeline(task, model=None, **options):
+    from transformers import pipeline
+    return pipeline(task, model=model, **options)
+
+# NER model of 6_ and 11_ (its name is the model version of their checkpoints)
+NER_MODEL = "dbmdz/bert-large-cased-finetuned-conll03-english"
+
+# Function to load (or reuse) the NER pipeline of 6_ and 11_, on the GPU if there is one. The
+# cache key includes every argument, so both stages load it only through here.
+def get_ner_pipeline():
+    import torch
+    device = 0 if torch.cuda.is_available() else -1  # 0 for GPU, -1 for CPU
+    return get_pipeline("ner", model=NER_MODEL, grouped_entities=True, device=device)
+
+# Function to load (or reuse) a sentence transformer model
+@functools.lru_cache(maxsize=None)
+def get_sentence_transformer(model_name):
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(model_name)
@@ -0,0 +1,84 @@
+import re
+import configparser
+import numpy as np
+from database import write_values
+
+# Passage-level embeddings (5_sentence_transformer.py --passages).
+# The embedding model reads at most 512 tokens, so a whole-article embedding only covers the
+# opening of a long article. In passage mode every article is split into overlapping passages
+# of a fixed number of tokens, each passage is embedded and stored in the passages table (as a
+# character span of the article, with its vector), and the article's vector is pooled
+# from its passage vectors. Search can then return the passage that matched.
+
+# Load settings from the ini file
+config = configparser.ConfigParser()
+config.read('settings.ini')
+
+# Tokens per passage, and tokens shared by consecutive passages
+passage_tokens = config.getint('passages', 'tokens', fallback=256)
+passage_overlap = config.getint('passages', 'overlap', fallback=64)
+
+# Function to create the passages table if it does not exist (stages starting together take
+# turns, since concurrent CREATE TABLE IF NOT EXISTS can still collide)
+def ensure_passages_table(cursor):
+    cursor.execute("SELECT pg_advisory_xact_lock(hashtext('passages'));")
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS passages (
+            passage_id SERIAL PRIMARY KEY,
+            article_id INT NOT NULL REFERENCES Articles(article_id),
+            passage_index INT NOT NULL,
+            start_pos INT NOT NULL,
+            end_pos INT NOT NULL,
+            token_count INT,
+            model_version VARCHAR(255),
+            embedding_vector BYTEA,
+            embedding_dtype VARCHAR(16),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (article_id, passage_index)
+        );
+    """)
+
+# Function to get the character span of every token of a text (whitespace-separated words when
+# the tokenizer cannot report offsets)
+def token_spans(text, tokenizer=None):
+    if tokenizer is not None:
+        try:
+            return tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)["offset_mapping"]
+        except Exception:
+            pass
+    return [match.span() for match in re.finditer(r"\S+", text)]
+
+# Function to split a text into passages of at most `size` tokens, each starting size - overlap
+# tokens after the previous one. Returns (start_pos, end_pos, token count) character spans; an
+# empty text is one empty passage.
+def split_passages(text, tokenizer=None, size=None, overlap=None):
+    size = passage_tokens if size is None else size
+    overlap = passage_overlap if overlap is None else overlap
+    spans = token_spans(text, tokenizer)
+    step = max(1, size - overlap)
+    passages = []
+    for first in range(0, len(spans), step):
+        last = min(first + size, len(spans))
+        passages.append((spans[first][0], spans[last - 1][1], last - first))
+        if last == len(spans):
+            break
+    return passages or [(0, len(text), 0)]
+
+# Function to pool an article's passage vectors into its vector: their mean weighted by token
+# count, scaled to the passages' average norm (so unit vectors pool to a unit vector)
+def pool_passages(vectors, token_counts):
+    weights = np.maximum(np.asarray(token_counts, dtype=np.float64), 1)
+    pooled = np.average(vectors, axis=0, weights=weights)
+    norm = np.linalg.norm(pooled)
+    if norm > 0:
+        pooled *= np.linalg.norm(vectors, axis=1).mean() / norm
+    return pooled.astype(vectors.dtype)
+
+# Function to replace the passages of the given articles; rows are (article_id, passage_index,
+# start_pos, end_pos, token_count, model_version, vector bytes, vector dtype) (see vectors.py)
+def write_passages(cursor, article_ids, rows):
+    cursor.execute("DELETE FROM passages WHERE article_id = ANY(%s);", (list(article_ids),))
+    write_values(cursor, """
+        INSERT INTO passages (article_id, passage_index, start_pos, end_pos, token_count, model_version, embedding_vector, embedding_dtype)
+        VALUES %s;
+    """, rows)
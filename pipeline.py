@@ -0,0 +1,202 @@
+import os
+import time
+import hashlib
+import logging
+import argparse
+import importlib
+import configparser
+from datetime import datetime
+from database import connect_db
+from segmenter import load_state, save_state
+import tuning
+
+# Orchestrator for the database stages (4_ to 11_ and 20.1_).
+# The stages run in one process in dependency order. Each stage module is imported once, so
+# its models load once, and models.py shares models between stages. database.py keeps the
+# connections warm between stages. Before a stage runs, its input is fingerprinted: the
+# segmented files for the loader, and a row count plus the highest key of the input rows for
+# the other stages. A stage whose fingerprint matches the last successful run is skipped.
+# A stage succeeded only if its entry function returned True: the stages log and roll back
+# their own errors, so a stage that raised or returned anything else failed, keeps its old
+# fingerprint (it runs again next time) and blocks its downstream stages.
+# Timings and fingerprints are kept in the state file.
+# Full rebuild:  python pipeline.py --force       Only what changed:  python pipeline.py
+
+# Initialize logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Load settings from the ini file
+config = configparser.ConfigParser()
+config.read('settings.ini')
+
+# Location of the orchestrator state (input fingerprints and timings of the last runs)
+state_path = config.get('directories', 'pipeline_state', fallback='pipeline_state.json')
+
+# Input fingerprints of the database stages: row count and highest key of the rows they read
+ARTICLES = "SELECT COUNT(*), MAX(article_id) FROM articles"
+EMBEDDED_ARTICLES = "SELECT COUNT(*), MAX(article_id) FROM articles WHERE embedding_vector IS NOT NULL"
+SUMMARIES = "SELECT COUNT(*), MAX(article_id) FROM articles WHERE summary IS NOT NULL"
+LOCATIONS = "SELECT COUNT(*), MAX(entity_id) FROM entities WHERE entity_type = 'LOC'"
+
+# Stages in dependency order: name -> (module, entry function, keyword arguments, upstream stages, input fingerprint).
+# The model stages use their host's tuned batch size (see tuning.py).
+# Summaries are written outside the pipeline, so the summary stages only wait for the load.
+STAGES = {
+    "load": ("4_segmented_to_db", "process_all_files", {}, (), None),
+    "embeddings": ("5_sentence_transformer", "process_articles_in_batches", {}, ("load",), ARTICLES),
+    "ner": ("6_NER_to_database", "run_ner_pipeline", {}, ("load",), ARTICLES),
+    "lda": ("7_LDA_to_DB", "run_lda_pipeline", {"num_topics": 10}, ("load",), ARTICLES),
+    "sentiment": ("8_sentiment_analysis_to_DB", "run_sentiment_analysis_pipeline", {}, ("load",), SUMMARIES),
+    "faiss": ("9_FAISS_to_DB", "run_faiss_pipeline", {}, ("embeddings",), EMBEDDED_ARTICLES),
+    "geocode": ("10_GEO_to_DB", "run_geo_pipeline", {"batch_size": 100}, ("ner",), LOCATIONS),
+    "summary_ner": ("11_NER_TO_SUMMARY", "run_ner_summaries_pipeline", {}, ("load",), SUMMARIES),
+    "summary_lda": ("20.1_LDA_to_DB_SUMMARIES", "run_lda_pipeline_on_summaries", {"num_topics": 10}, ("load",), SUMMARIES),
+}
+
+# Function to fingerprint the loader's input: the names, sizes and mtimes of the segmented files
+def directory_fingerprint(directory):
+    digest = hashlib.sha1()
+    for name in sorted(os.listdir(directory)):
+        if name.lower().endswith((".txt", ".jsonl")):
+            stat = os.stat(os.path.join(directory, name))
+            digest.update(f"{name}\t{stat.st_size}\t{stat.st_mtime_ns}\n".encode('utf-8'))
+    return digest.hexdigest()
+
+# Function to fingerprint a stage's input (None if it cannot be read)
+def input_fingerprint(stage, module):
+    query = STAGES[stage][4]
+    if query is None:
+        return directory_fingerprint(module.input_directory)
+
+    conn = connect_db()
+    if conn is None:
+        return None
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(query)
+            return [str(value) if value is not None else None for value in cursor.fetchone()]
+    finally:
+        conn.close()
+
+# Function to order the selected stages so that every stage comes after its upstream stages
+def stage_order(selected):
+    order = []
+    visiting = set()
+
+    def visit(stage):
+        if stage in order:
+            return
+        if stage in visiting:
+            raise ValueError(f"dependency cycle at stage {stage!r}")
+        visiting.add(stage)
+        for upstream in STAGES[stage][3]:
+            visit(upstream)
+        visiting.discard(stage)
+        order.append(stage)
+
+    for stage in STAGES:
+        visit(stage)
+    return [stage for stage in order if stage in selected]
+
+# Function to import a stage module once (loading its models), timing the import
+def load_stage_module(stage, modules, timings):
+    if stage not in modules:
+        start = time.perf_counter()
+        modules[stage] = importlib.import_module(STAGES[stage][0])
+        timings[stage]["import_seconds"] = time.perf_counter() - start
+    return modules[stage]
+
+# Function to run the selected stages; unchanged stages are skipped unless forced, and the
+# stages downstream of a failed stage are not run
+def run_pipeline(selected=None, force=False, dry_run=False, warm=False):
+    selected = set(selected or STAGES)
+    state = load_state(state_path)
+    stage_states = state.setdefault("stages", {})
+    modules = {}
+    timings = {stage: {"status": "pending"} for stage in selected}
+    failed = set()
+
+    order = stage_order(selected)
+    if warm:
+        # Load every selected stage's models up front, so the stage timings are run time only
+        for stage in order:
+            load_stage_module(stage, modules, timings)
+
+    for stage in order:
+        timing = timings[stage]
+        if any(upstream in failed for upstream in STAGES[stage][3]):
+            logging.warning(f"[WARNING] Skipping stage {stage}: an upstream stage failed.")
+            timing["status"] = "blocked"
+            failed.add(stage)
+            continue
+
+        # Only the loader's module is needed to fingerprint its input; the model stages are
+        # imported once they are known to run
+        module = load_stage_module(stage, modules, timings) if STAGES[stage][4] is None else None
+        fingerprint = input_fingerprint(stage, module)
+        previous = stage_states.get(stage, {})
+        if not force and fingerprint is not None and previous.get("input") == fingerprint:
+            logging.info(f"[INFO] Stage {stage}: input unchanged since {previous.get('finished')}, skipped.")
+            timing["status"] = "unchanged"
+            continue
+        if dry_run:
+            logging.info(f"[INFO] Stage {stage} would run.")
+            timing["status"] = "would run"
+            continue
+
+        logging.info(f"[INFO] Running stage {stage} ({STAGES[stage][0]}).")
+        module = load_stage_module(stage, modules, timings)
+        # The torch threads tuned for this stage, also when another stage's module set them last
+        tuning.apply_threads(stage)
+        start = time.perf_counter()
+        try:
+            completed = getattr(module, STAGES[stage][1])(**STAGES[stage][2])
+        except Exception as e:
+            completed = False
+            logging.error(f"[ERROR] Stage {stage} failed: {e}")
+        else:
+            if completed is not True:
+                logging.error(f"[ERROR] Stage {stage} failed (see its errors above).")
+        timing["seconds"] = time.perf_counter() - start
+        if completed is not True:
+            timing["status"] = "failed"
+            failed.add(stage)
+            continue
+        timing["status"] = "ran"
+
+        # The fingerprint after the run, so a stage that writes to its own input is not rerun
+        stage_states[stage] = {
+            "input": input_fingerprint(stage, module),
+            "finished": datetime.now().isoformat(timespec='seconds'),
+            "seconds": round(timing["seconds"], 3),
+            "import_seconds": round(timing.get("import_seconds", 0.0), 3),
+        }
+        save_state(state_path, state)
+
+    print_timings(order, timings)
+    return timings
+
+# Function to print the per-stage timing summary
+def print_timings(order, timings):
+    print(f"{'stage':<12} {'status':<10} {'import s':>9} {'run s':>9}")
+    for stage in order:
+        timing = timings[stage]
+        import_seconds = f"{timing['import_seconds']:.2f}" if "import_seconds" in timing else "-"
+        seconds = f"{timing['seconds']:.2f}" if "seconds" in timing else "-"
+        print(f"{stage:<12} {timing['status']:<10} {import_seconds:>9} {seconds:>9}")
+
+# Main function
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the database stages as a dependency graph in one process.")
+    parser.add_argument("--stages", default=None, help=f"Comma-separated stages to consider (default all): {', '.join(STAGES)}")
+    parser.add_argument("--force", action="store_true", help="Run the stages even if their input is unchanged (full rebuild)")
+    parser.add_argument("--dry-run", action="store_true", help="Only report which stages would run")
+    parser.add_argument("--warm", action="store_true", help="Load the models of all selected stages before running any")
+    args = parser.parse_args()
+
+    stages = [stage.strip() for stage in args.stages.split(',') if stage.strip()] if args.stages else None
+    for stage in stages or ():
+        if stage not in STAGES:
+            parser.error(f"unknown stage {stage!r}")
+
+    run_pipeline(stages, args.force, args.dry_run, args.warm)
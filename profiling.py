@@ -0,0 +1,172 @@
+import io
+import os
+import time
+import pstats
+import cProfile
+import logging
+import tracemalloc
+import contextlib
+import configparser
+from datetime import datetime
+
+# Profiling mode for the stages and the query tool (--profile).
+# A profiling session samples the first few batches of a run: while a sampled batch runs,
+# cProfile records the calls and tracemalloc traces the allocations. The rest of the run is
+# not slowed down. At the end of the session a per-run directory gets:
+# - profile.pstats, the merged cProfile stats (for pstats, snakeviz, ...)
+# - peak_batch.snapshot, the tracemalloc snapshot of the batch with the highest peak memory
+# - report.txt, the per-batch time and peak memory, and the top functions and allocations
+# The stages mark their batches by looping over profiling.sample(batches), or with
+# "with profiling.batch():"; both cost nothing when no session is running. Only this process
+# is profiled, so profile worker pools with --workers 1.
+
+# Load settings from the ini file
+config = configparser.ConfigParser()
+config.read('settings.ini')
+
+# Directory for the per-run profile directories
+profile_directory = config.get('profiling', 'directory', fallback='profiles')
+
+# Batches sampled per run, and lines per section of the report
+profile_batches = config.getint('profiling', 'batches', fallback=5)
+profile_top = config.getint('profiling', 'top', fallback=25)
+
+
+class Profiler:
+    def __init__(self, stage, batches=None, top=None, directory=None):
+        self.stage = stage
+        self.batches = profile_batches if batches is None else batches
+        self.top = profile_top if top is None else top
+        self.run_directory = os.path.join(directory or profile_directory,
+                                          f"{stage}_{datetime.now():%Y%m%d_%H%M%S}_{os.getpid()}")
+        self.profile = cProfile.Profile()
+        self.samples = []  # (batch number, seconds, peak bytes)
+        self.seen = 0
+        self.depth = 0
+        self.peak_snapshot = None
+
+    # Function to profile one batch, if the sample is not full yet (nested batches count as one)
+    @contextlib.contextmanager
+    def batch(self):
+        self.seen += 1
+        if self.depth or len(self.samples) >= self.batches:
+            yield
+            return
+
+        self.depth += 1
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start(25)
+        tracemalloc.reset_peak()
+        base, _ = tracemalloc.get_traced_memory()
+        start = time.perf_counter()
+        self.profile.enable()
+        try:
+            yield
+        finally:
+            self.profile.disable()
+            seconds = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            peak -= base
+            if not self.samples or peak > max(sample[2] for sample in self.samples):
+                self.peak_snapshot = tracemalloc.take_snapshot()
+            if started_tracing:
+                tracemalloc.stop()
+            self.samples.append((self.seen, seconds, peak))
+            self.depth -= 1
+
+    # Function to build the sections of the text report: the batches, the top functions by own
+    # and by cumulative time, and the top allocations of the peak batch
+    def report_sections(self):
+        lines = [f"Profile of stage {self.stage}: {len(self.samples)} of {self.seen} batches sampled",
+                 f"{'batch':>7} {'seconds':>10} {'peak MiB':>10}"]
+        for number, seconds, peak in self.samples:
+            lines.append(f"{number:>7} {seconds:>10.3f} {peak / 2 ** 20:>10.1f}")
+        sections = ["\n".join(lines)]
+
+        for sort, title in (("tottime", "own"), ("cumulative", "cumulative")):
+            stream = io.StringIO()
+            pstats.Stats(self.profile, stream=stream).strip_dirs().sort_stats(sort).print_stats(self.top)
+            # Keep the table, without the pstats preamble
+            table = stream.getvalue()
+            sections.append(f"Top {self.top} functions by {title} time\n" + table[table.find("   ncalls"):].rstrip())
+
+        if self.peak_snapshot is not None:
+            snapshot = self.peak_snapshot.filter_traces((
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            ))
+            lines = [f"Top {self.top} allocations still held at the end of the peak batch"]
+            for statistic in snapshot.statistics('lineno')[:self.top]:
+                lines.append(f"{statistic.size / 1024:>10.1f} KiB {statistic.count:>9} blocks  {statistic.traceback[0]}")
+            sections.append("\n".join(lines))
+        return sections
+
+    # Function to write the profile files; returns the report sections
+    def write(self):
+        os.makedirs(self.run_directory, exist_ok=True)
+        self.profile.dump_stats(os.path.join(self.run_directory, "profile.pstats"))
+        if self.peak_snapshot is not None:
+            self.peak_snapshot.dump(os.path.join(self.run_directory, "peak_batch.snapshot"))
+        sections = self.report_sections()
+        with open(os.path.join(self.run_directory, "report.txt"), 'w', encoding='utf-8') as file:
+            file.write("\n\n".join(sections) + "\n")
+        return sections
+
+
+# The profiling session of this process, if any
+_active = None
+
+# Function to profile the next batch of the active session (does nothing without a session)
+def batch():
+    return _active.batch() if _active is not None else contextlib.nullcontext()
+
+# Function to tell whether a profiling session is running in this process
+def is_active():
+    return _active is not None
+
+# Generator that yields the items of an iterable, profiling the loop body of each item as a batch
+def sample(iterable):
+    for item in iterable:
+        with batch():
+            yield item
+
+# Function to start a profiling session
+def start(stage, batches=None, top=None):
+    global _active
+    _active = Profiler(stage, batches, top)
+    logging.info(f"[INFO] Profiling the first {_active.batches} batches of stage {stage}.")
+    return _active
+
+# Function to end the session and write its files; returns the run directory
+def finish():
+    global _active
+    profiler, _active = _active, None
+    if profiler is None:
+        return None
+    if not profiler.samples:
+        logging.warning(f"[WARNING] Stage {profiler.stage} ran no batches; nothing was profiled.")
+        return None
+    # The batches and the top functions by own time go to the console as well
+    sections = profiler.write()
+    print("\n\n".join(sections[:2]))
+    logging.info(f"[INFO] Profile saved to {profiler.run_directory}")
+    return profiler.run_directory
+
+# Context manager that profiles what runs inside it when enabled (the --profile flag)
+@contextlib.contextmanager
+def session(stage, enabled=True, batches=None):
+    if not enabled:
+        yield
+        return
+    start(stage, batches)
+    try:
+        yield
+    finally:
+        finish()
+
+# Function to add the profiling options to a stage's argument parser
+def add_profile_arguments(parser):
+    parser.add_argument("--profile", action="store_true",
+                        help="Profile a sample of batches with cProfile and tracemalloc and write a top-N report")
+    parser.add_argument("--profile-batches", type=int, default=profile_batches, help="Batches to profile with --profile")
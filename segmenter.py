@@ -0,0 +1,521 @@
+import os
+import io
+import codecs
+import re
+import json
+import time
+import hashlib
+import argparse
+import configparser
+import functools
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from encoding_detector import detect_encoding, open_mapped, file_sha1
+from block_classifier import classify_blocks
+from text_cleaner import TextCleaner
+import profiling
+
+# Fused segmentation engine: runs the logic of 1_article_divider.py, 2_article_divider.py
+# and 3_article_divider.py back to back in memory, so every issue is read, encoding-detected
+# and written exactly once instead of three times.
+
+# Load settings from the ini file
+config = configparser.ConfigParser()
+config.read('settings.ini')
+input_directory = config['directories']['input_directory']
+output_directory = config['directories']['output_directory']
+
+# Separator line used by every segmentation stage
+SEPARATOR = "===================================="
+
+# Stage 2 pattern (all-caps titles and their bodies)
+title_body_pattern = re.compile(r'([A-Z\s,\'\.]+)(?:\n|\n\n)(.+?)(?=\n[A-Z\s,\'\.]+\n|\n\n|\Z)', re.DOTALL)
+
+# Inputs larger than this (e.g. whole bound volumes) are memory-mapped and streamed in windows
+STREAM_THRESHOLD = 64 * 1024 * 1024
+
+# Target size of each streamed window; windows are cut back to the last blank line so paragraphs stay whole
+WINDOW_SIZE = 4 * 1024 * 1024
+
+# Version of the segmentation and cleaning rules (this module, block_classifier.py and
+# text_cleaner.py). It is part of the settings fingerprint of every processed file, so bump it
+# whenever a change alters the output: the next run then reprocesses the unchanged inputs too.
+SEGMENTER_VERSION = 2
+
+# Function to stream a large file as decoded text windows of roughly window_size bytes.
+# Newlines are translated the same way as reading the file in text mode.
+def iter_text_windows(file_path, encoding, window_size=WINDOW_SIZE):
+    decoder = codecs.getincrementaldecoder(encoding or 'utf-8')(errors='replace')
+    with open_mapped(file_path) as mapped:
+        carry = ''
+        for offset in range(0, len(mapped), window_size):
+            final = offset + window_size >= len(mapped)
+            text = carry + decoder.decode(mapped[offset:offset + window_size], final)
+
+            # Hold back a trailing '\r' in case the next window starts with its '\n'
+            held = ''
+            if not final and text.endswith('\r'):
+                text, held = text[:-1], '\r'
+            text = text.replace('\r\n', '\n').replace('\r', '\n')
+
+            if final:
+                yield text
+                return
+
+            # Cut after the last blank line (or failing that, the last newline) in the window
+            cut = text.rfind('\n\n')
+            cut = cut + 2 if cut != -1 else text.rfind('\n') + 1
+            if cut > 0:
+                yield text[:cut]
+                text = text[cut:]
+            carry = text + held
+        if carry:
+            yield carry
+
+# Function to read a raw issue as one or more text windows (a single window unless the file is very large)
+def read_issue_windows(file_path):
+    encoding = detect_encoding(file_path)
+    print(f"[INFO] Detected encoding for {file_path}: {encoding}")
+    if os.path.getsize(file_path) > STREAM_THRESHOLD:
+        return iter_text_windows(file_path, encoding)
+    with open(file_path, 'r', encoding=encoding, errors='replace') as file:
+        return [file.read()]
+
+# Function to run a stream of raw text windows through the cleaner, yielding (raw, cleaned) pairs.
+# Text the cleaner holds back at the end of one window is emitted with the next one.
+def clean_windows(windows, cleaner=None):
+    previous = None
+    for text in windows:
+        if previous is not None:
+            yield previous, cleaner.feed(previous) if cleaner else previous
+        previous = text
+    if previous is not None:
+        yield previous, cleaner.feed(previous) + cleaner.flush() if cleaner else previous
+
+# Function to format one article block in the stage 1 / stage 2 layout
+def format_block(label, title, body):
+    return f"{SEPARATOR}\n{label}: {title}\nBody:\n{body}\n{SEPARATOR}\n\n"
+
+# Stage 1: tag articles, poetry and advertisements in the raw issue text
+def divide_articles(newspaper_text):
+    # One linear scan per block type (see block_classifier.py) instead of backtracking regexes
+    blocks = classify_blocks(newspaper_text)
+
+    output = []
+    last_pos = 0  # This variable tracks the position of the last processed article
+
+    # Process articles, keeping the uncategorized text between them
+    for start, end, title, body in blocks['article']:
+        output.append(newspaper_text[last_pos:start])
+        output.append(format_block("Title", title, body))
+        last_pos = end
+
+    # Process poetry
+    for start, end, title, body in blocks['poetry']:
+        output.append(format_block("Poetry Title", title, body))
+        last_pos = end
+
+    # Process advertisements
+    for start, end, title, body in blocks['advertisement']:
+        output.append(format_block("Advertisement Title", title, body))
+        last_pos = end
+
+    # Any remaining uncategorized text
+    output.append(newspaper_text[last_pos:])
+    return ''.join(output)
+
+# Stage 2: split the stage 1 text into all-caps titles and bodies
+def refine_articles(segmented_text):
+    # Capture the first line separately before applying the regex pattern
+    first_line = segmented_text.split('\n', 1)[0]
+
+    output = [f"First Line: {first_line}\n\n"]
+    for match in title_body_pattern.finditer(segmented_text):
+        output.append(format_block("Title", match.group(1), match.group(2)))
+    return ''.join(output)
+
+# Stage 3: collect the stage 2 blocks into final (title, body) articles
+def finalize_articles(refined_text):
+    # Split on newlines only, the same way readlines() does on the stage 2 file
+    lines = io.StringIO(refined_text).readlines()
+
+    # Capture the first line separately to ensure it's preserved
+    first_line = lines[0].strip() if len(lines) > 0 else ""
+
+    articles = []
+    current_title = None
+    current_body = []
+    processing_article = False  # Flag to check if we're inside an article section
+
+    # Function to handle adding an article to the output
+    def write_article():
+        nonlocal current_title, current_body
+        current_title = current_title if current_title is not None else ""
+
+        # If the title is blank, use the first five words of the body
+        if current_title.strip() == "" and current_body:
+            first_line_of_body = current_body[0].strip()
+            first_five_words = ' '.join(first_line_of_body.split()[:5])
+
+            if first_five_words:
+                current_title = first_five_words.strip()
+                current_body[0] = current_body[0].replace(current_title, "").strip()
+
+        # Skip this article if both the title and body are empty
+        if current_title.strip() == "" and len(current_body) == 1 and current_body[0].strip() == "Body:":
+            return
+
+        if current_title.strip() == "" and ''.join(current_body).strip() == "":
+            return
+
+        articles.append((current_title.strip(), ''.join(current_body).strip()))
+
+    # Start from the second line to avoid reprocessing the first line
+    for line in lines[1:]:
+        if SEPARATOR in line:
+            if processing_article:
+                write_article()
+            processing_article = True
+            current_title = None
+            current_body = []
+        elif line.startswith("Title:"):
+            current_title = line.replace("Title:", "").strip()
+        elif line.startswith("Body:"):
+            current_body = []
+        else:
+            current_body.append(line)
+
+    # Write the last article if it's present
+    write_article()
+
+    return articles, first_line
+
+# Function to render final articles in the format read by 4_segmented_to_db.py
+def render_articles(articles):
+    return ''.join(f"{SEPARATOR}\nTitle: {title}\nBody: {body}\n{SEPARATOR}\n\n" for title, body in articles)
+
+# Function to render the issue line that closes every final file
+def render_issue_line(first_line):
+    return f"NEWSPAPER ISSUE AND DATE: {first_line}\n"
+
+# Function to render a complete final file for one issue
+def render_final(articles, first_line):
+    return render_articles(articles) + render_issue_line(first_line)
+
+# Publication date in an issue file name, e.g. "Trinity Journal 12 March 1859.txt"
+issue_date_pattern = re.compile(r'(\d{1,2})\s+([A-Za-z]+)\s+(\d{4})')
+
+# Table of contents (between "Masthead" and "Persistent Link") and persistent link of an issue
+toc_pattern = re.compile(r'Masthead(.*?)Persistent Link', re.DOTALL)
+hyperlink_pattern = re.compile(r'(https?://\S+)')
+
+# Function to read the publication date from an issue file name as an ISO date (None if there is none)
+def issue_date_from_name(file_name):
+    date_match = issue_date_pattern.search(file_name)
+    if not date_match:
+        return None
+    try:
+        return datetime.strptime(' '.join(date_match.groups()), '%d %B %Y').date().isoformat()
+    except ValueError:
+        return None
+
+# Function to extract the table of contents and hyperlink from an issue's text. The TOC's runs of
+# whitespace are collapsed to one space, as TOC_HYPERLINK_GET.py always did; collapse_whitespace=False
+# keeps them, as 0.5_TOC_Hyperlink_Get does.
+def extract_toc_and_hyperlink(text, collapse_whitespace=True):
+    toc_match = toc_pattern.search(text)
+    hyperlink_match = hyperlink_pattern.search(text)
+
+    # Extract TOC and Hyperlink
+    toc = toc_match.group(1).strip() if toc_match else None
+    hyperlink = hyperlink_match.group(0).strip() if hyperlink_match else None
+
+    # Replace multiple spaces/newlines for better formatting
+    if toc and collapse_whitespace:
+        toc = re.sub(r'\s+', ' ', toc)
+
+    return toc, hyperlink
+
+# Function to render the issue record that opens a .jsonl file: what the Newspapers row needs
+def render_issue_record(source, issue, date, toc, hyperlink):
+    record = {"type": "issue", "source": source, "issue": issue, "date": date, "toc": toc, "hyperlink": hyperlink}
+    return json.dumps(record, ensure_ascii=False) + "\n"
+
+# Function to render final articles as JSON lines, one self-contained record per article. The
+# records carry no character offsets into the raw file: the body is cleaned and reassembled, so it
+# is not a span of the raw text (source and index identify the article instead).
+def render_records(articles, source, issue, date, first_index=0):
+    lines = []
+    for index, (title, body) in enumerate(articles, first_index):
+        record = {"type": "article", "source": source, "issue": issue, "date": date, "index": index,
+                  "title": title, "body": body}
+        lines.append(json.dumps(record, ensure_ascii=False) + "\n")
+    return ''.join(lines)
+
+# Function to run all three stages over one issue's text
+def segment_issue(newspaper_text, debug_outputs=None):
+    segmented_text = divide_articles(newspaper_text)
+    refined_text = refine_articles(segmented_text)
+    if debug_outputs is not None:
+        debug_outputs.append(segmented_text)
+        debug_outputs.append(refined_text)
+    return finalize_articles(refined_text)
+
+# Function to map a raw issue file name to its output name for a given stage (1, 2 or 3)
+def stage_file_name(filename, stage):
+    name = filename.replace(".txt", "_seg1.txt")
+    for previous in range(1, stage):
+        name = name.replace(f"seg{previous}", f"seg{previous + 1}")
+    return name
+
+# Function to process a single raw issue into its final segmented file.
+# An output path ending in .jsonl gets an issue record (date, TOC, hyperlink) followed by one
+# JSON record per article; any other path gets the Title:/Body: layout of 3_article_divider.py.
+# Very large inputs are segmented window by window, so peak memory depends on the window
+# size rather than the file size; the issue line is taken from the first window.
+def process_file(file_path, output_path, debug_directory=None, clean=True):
+    filename = os.path.basename(file_path)
+    records = output_path.lower().endswith(".jsonl")
+    date = issue_date_from_name(filename)
+    cleaner = TextCleaner() if clean else None
+
+    # Optionally keep the stage 1 and stage 2 intermediates for inspection
+    debug_files = []
+    if debug_directory:
+        for stage in (1, 2):
+            stage_directory = os.path.join(debug_directory, f"Segmented {stage}")
+            os.makedirs(stage_directory, exist_ok=True)
+            debug_files.append(open(os.path.join(stage_directory, stage_file_name(filename, stage)), 'w', encoding='utf-8'))
+
+    article_count = 0
+    issue_line = None
+    try:
+        with open(output_path, 'w', encoding='utf-8') as output_file:
+            for raw_text, newspaper_text in clean_windows(read_issue_windows(file_path), cleaner):
+                debug_outputs = [] if debug_files else None
+                articles, first_line = segment_issue(newspaper_text, debug_outputs)
+                first_window = issue_line is None
+                if first_window:
+                    issue_line = first_line
+
+                if records:
+                    issue = issue_line.replace("First Line:", "", 1).strip()
+                    # The issue record comes from the same read as the articles (from the first
+                    # window of a streamed file, where the masthead and persistent link are);
+                    # the raw text is used because cleaning drops the '/' of the link
+                    if first_window:
+                        output_file.write(render_issue_record(filename, issue, date, *extract_toc_and_hyperlink(raw_text)))
+                    output_file.write(render_records(articles, filename, issue, date, article_count))
+                else:
+                    output_file.write(render_articles(articles))
+                for debug_file, text in zip(debug_files, debug_outputs or []):
+                    debug_file.write(text)
+                article_count += len(articles)
+
+            if not records:
+                output_file.write(render_issue_line(issue_line or ""))
+    finally:
+        for debug_file in debug_files:
+            debug_file.close()
+
+    print(f"[INFO] Segmented {article_count} articles from {file_path} into {output_path}")
+    return {"articles": article_count, "cleaning": cleaner.counts if cleaner else {}}
+
+# Function to run one file through a stage, recording the outcome for the run manifest
+# (along with any statistics the stage returns, such as the cleaning counters)
+def run_task(process, input_path, output_path):
+    start = time.time()
+    entry = {"input": input_path, "output": output_path}
+    try:
+        # Each file is one batch for --profile
+        with profiling.batch():
+            stats = process(input_path, output_path)
+        entry["status"] = "ok"
+        if isinstance(stats, dict):
+            entry.update(stats)
+    except Exception as e:
+        print(f"[ERROR] Failed to process {input_path}: {e}")
+        entry["status"] = "failed"
+        entry["error"] = f"{type(e).__name__}: {e}"
+    entry["seconds"] = round(time.time() - start, 3)
+    return entry
+
+# Function to fingerprint an input file; the content hash is reused when size and mtime are
+# unchanged, and is otherwise the streamed hash of the encoding cache (see encoding_detector.py),
+# which the file's encoding detection then reuses
+def file_fingerprint(path, previous=None):
+    stat = os.stat(path)
+    if previous and previous.get("size") == stat.st_size and previous.get("mtime_ns") == stat.st_mtime_ns:
+        content_hash = previous["sha1"]
+    else:
+        content_hash = file_sha1(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha1": content_hash}
+
+# Function to name a stage's process function or option value in a stable way (functions by name,
+# not by their address)
+def describe_setting(value):
+    if callable(value):
+        return f"{getattr(value, '__module__', '')}.{getattr(value, '__qualname__', type(value).__name__)}"
+    return repr(value)
+
+# Function to fingerprint how a stage processes its files: SEGMENTER_VERSION, the process function
+# and the options bound to it with functools.partial (--no-clean, --debug-dir, ...). The output
+# format shows in the output path, which is compared as well.
+def settings_fingerprint(process):
+    arguments = []
+    options = {}
+    while isinstance(process, functools.partial):
+        arguments = [describe_setting(argument) for argument in process.args] + arguments
+        options = {**{name: describe_setting(value) for name, value in process.keywords.items()}, **options}
+        process = process.func
+    settings = {"version": SEGMENTER_VERSION, "process": describe_setting(process), "arguments": arguments, "options": options}
+    return hashlib.sha1(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()
+
+# Function to load the persistent state of a stage (files already processed, keyed by input path)
+def load_state(state_path):
+    if state_path and os.path.exists(state_path):
+        with open(state_path, 'r', encoding='utf-8') as state_file:
+            return json.load(state_file)
+    return {}
+
+# Function to save the persistent state of a stage
+def save_state(state_path, state):
+    temporary_path = state_path + ".tmp"
+    with open(temporary_path, 'w', encoding='utf-8') as state_file:
+        json.dump(state, state_file, indent=2)
+    os.replace(temporary_path, state_path)
+
+# Function to check whether a file's content (and, if given, the settings it is processed with)
+# matches what a stage last processed
+def is_unchanged(state, path, fingerprint, output_path=None, settings=None):
+    entry = state.get(os.path.abspath(path))
+    if not entry or entry.get("sha1") != fingerprint["sha1"]:
+        return False
+    if settings is not None and entry.get("settings") != settings:
+        return False
+    if output_path is not None:
+        return entry.get("output") == os.path.abspath(output_path) and os.path.exists(output_path)
+    return True
+
+# Function to run a stage over (input, output) pairs, serially or across a process pool.
+# Every file is handled independently, so the outputs are identical in both modes.
+# With a state file, inputs whose content hash and processing settings are unchanged since the
+# last successful run (and whose output still exists) are skipped unless force is set.
+def run_stage(process, tasks, workers=1, manifest_path=None, state_path=None, force=False):
+    started_at = datetime.now()
+
+    state = load_state(state_path)
+    settings = settings_fingerprint(process)
+    pending = []
+    skipped = []
+    fingerprints = {}
+    for input_path, output_path in tasks:
+        if state_path:
+            fingerprint = file_fingerprint(input_path, state.get(os.path.abspath(input_path)))
+            fingerprints[input_path] = fingerprint
+            if not force and is_unchanged(state, input_path, fingerprint, output_path, settings):
+                skipped.append({"input": input_path, "output": output_path, "status": "skipped"})
+                continue
+        pending.append((input_path, output_path))
+
+    input_paths = [input_path for input_path, _ in pending]
+    output_paths = [output_path for _, output_path in pending]
+
+    if workers > 1 and profiling.is_active():
+        print("[WARNING] --profile only samples this process; the files go to worker processes, so use --workers 1 to profile them.")
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            entries = list(executor.map(run_task, [process] * len(pending), input_paths, output_paths))
+    else:
+        entries = [run_task(process, input_path, output_path) for input_path, output_path in pending]
+
+    failed = [entry for entry in entries if entry["status"] != "ok"]
+    print(f"[INFO] Processed {len(entries) - len(failed)} files, {len(failed)} failed, {len(skipped)} unchanged, using {workers} worker(s).")
+
+    # Total the per-rule cleaning counters of the stages that clean their input
+    cleaning = {}
+    for entry in entries:
+        for name, count in entry.get("cleaning", {}).items():
+            cleaning[name] = cleaning.get(name, 0) + count
+    if cleaning:
+        print("[INFO] Cleaning: " + ", ".join(f"{name} {count}" for name, count in cleaning.items()))
+
+    # Record successful files so the next run can skip them; failed files are retried next time
+    if state_path:
+        for entry in entries:
+            key = os.path.abspath(entry["input"])
+            if entry["status"] == "ok":
+                state[key] = dict(fingerprints[entry["input"]], output=os.path.abspath(entry["output"]), settings=settings)
+            else:
+                state.pop(key, None)
+        save_state(state_path, state)
+
+    # Write the per-run manifest of outputs and failures
+    if manifest_path:
+        manifest = {
+            "started_at": started_at.isoformat(timespec='seconds'),
+            "finished_at": datetime.now().isoformat(timespec='seconds'),
+            "workers": workers,
+            "settings": settings,
+            "processed": len(entries) - len(failed),
+            "failed": len(failed),
+            "skipped": len(skipped),
+            "cleaning": cleaning,
+            "files": entries + skipped,
+        }
+        with open(manifest_path, 'w', encoding='utf-8') as manifest_file:
+            json.dump(manifest, manifest_file, indent=2)
+        print(f"[INFO] Run manifest saved to {manifest_path}")
+
+    return entries
+
+# Function to build the default manifest path for a run in the given output directory
+def default_manifest_path(output_dir, stage_name):
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    return os.path.join(output_dir, f"{stage_name}_manifest_{timestamp}.json")
+
+# Function to build the path of a stage's persistent state file in its output directory
+def default_state_path(output_dir, stage_name):
+    return os.path.join(output_dir, f"{stage_name}_state.json")
+
+# Function to add the shared parallel-run options to a stage's argument parser
+def add_run_arguments(parser):
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes (1 runs serially)")
+    parser.add_argument("--manifest", default=None, help="Path of the run manifest (defaults to the output directory)")
+    parser.add_argument("--force", action="store_true", help="Reprocess every file, even if unchanged since the last run")
+    profiling.add_profile_arguments(parser)
+
+# Function to map a raw issue file name to its final output name for the given format
+def final_file_name(filename, output_format="jsonl"):
+    name = stage_file_name(filename, 3)
+    return os.path.splitext(name)[0] + ".jsonl" if output_format == "jsonl" else name
+
+# Iterate over all raw issue files in the input directory
+def process_all_files(input_dir=input_directory, output_dir=output_directory, debug_directory=None, workers=1, manifest_path=None, force=False, output_format="jsonl", clean=True):
+    os.makedirs(output_dir, exist_ok=True)
+
+    tasks = []
+    for filename in os.listdir(input_dir):
+        if filename.lower().endswith(".txt"):
+            input_file_path = os.path.join(input_dir, filename)
+            output_file_path = os.path.join(output_dir, final_file_name(filename, output_format))
+            tasks.append((input_file_path, output_file_path))
+
+    process = functools.partial(process_file, debug_directory=debug_directory, clean=clean)
+    return run_stage(process, tasks, workers, manifest_path or default_manifest_path(output_dir, "segmenter"),
+                     default_state_path(output_dir, "segmenter"), force)
+
+# Main function
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Segment raw newspaper issues into final articles in a single pass.")
+    parser.add_argument("--input-dir", default=input_directory, help="Directory of raw issue .txt files")
+    parser.add_argument("--output-dir", default=output_directory, help="Directory for the final segmented files")
+    parser.add_argument("--debug-dir", default=None, help="Also write the stage 1 and stage 2 intermediates under this directory")
+    parser.add_argument("--format", choices=("jsonl", "text"), default="jsonl",
+                        help="jsonl: one JSON record per article (default); text: the Title:/Body: layout of 3_article_divider.py")
+    parser.add_argument("--no-clean", action="store_true", help="Segment the raw text without the OCR cleaning rules of text_cleaner.py")
+    add_run_arguments(parser)
+    args = parser.parse_args()
+
+    with profiling.session("segmenter", args.profile, args.profile_batches):
+        process_all_files(args.input_dir, args.output_dir, args.debug_dir, args.workers, args.manifest, args.force, args.format, not args.no_clean)
@@ -0,0 +1,402 @@
+import re
+import json
+import math
+import struct
+import time
+import array
+import decimal
+import sqlite3
+import logging
+import datetime
+import functools
+import configparser
+import psycopg2
+import psycopg2.extras
+import psycopg2.extensions
+
+# Local single-file database for running the stages without a PostgreSQL server.
+# With backend = sqlite under [database] in settings.ini, database.connect_db hands out
+# connections to an SQLite file with the schema of DB_SCHEMA2.0.sql (and the columns the stages
+# added since). The connections behave like psycopg2's where the stages rely on it: %s
+# parameters, transactions that start with the first statement and end with commit() or
+# rollback(), psycopg2 exception types, and the statement timeout. The few PostgreSQL spellings
+# the stages use are rewritten on the way in (= ANY(%s), NOW(), ::casts, TRUNCATE), arrays and
+# JSON are stored as JSON text and read back as lists and dicts, and cube_distance is provided
+# as a function. Not supported: the job queue (--queue), which needs FOR UPDATE SKIP LOCKED.
+
+# Load settings from the ini file
+config = configparser.ConfigParser()
+config.read('settings.ini')
+
+# Database file of the sqlite backend
+database_path = config.get('database', 'sqlite_path', fallback='trinity.sqlite3')
+
+# Seconds a connection waits for another process's write lock before giving up
+busy_timeout = config.getfloat('database', 'sqlite_busy_timeout', fallback=30.0)
+
+# Rows per statement are limited by SQLite's maximum number of parameters
+MAX_PARAMETERS = 32766
+
+# Tables of DB_SCHEMA2.0.sql and the passages table (see passages.py), with SQLite types, and the unique indexes the stages' ON CONFLICT
+# clauses expect. Arrays and JSON columns get their own type names so they are read back as
+# Python objects; INTEGER PRIMARY KEY is SQLite's SERIAL.
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS newspapers (
+        newspaper_id INTEGER PRIMARY KEY,
+        title VARCHAR(255) NOT NULL,
+        publication_date DATE NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        toc TEXT,
+        hyperlink TEXT
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS articles (
+        article_id INTEGER PRIMARY KEY,
+        newspaper_id INTEGER REFERENCES newspapers(newspaper_id),
+        title VARCHAR(255),
+        content TEXT,
+        embedding_vector BLOB,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        embedding_vector_binary BLOB,
+        embedding_vector_array REAL_ARRAY,
+        named_entities JSONB,
+        lda_topics JSONB,
+        summary TEXT,
+        summary_ner_entities JSONB,
+        summary_topics TEXT
+    );
+    """,
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_articles_newspaper_title ON articles (newspaper_id, title);",
+    """
+    CREATE TABLE IF NOT EXISTS entities (
+        entity_id INTEGER PRIMARY KEY,
+        article_id INTEGER REFERENCES articles(article_id),
+        entity_type VARCHAR(255),
+        entity_value VARCHAR(255),
+        start_pos INTEGER,
+        end_pos INTEGER,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    """,
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_entities_unique ON entities (article_id, entity_type, entity_value, start_pos, end_pos);",
+    """
+    CREATE TABLE IF NOT EXISTS entity_sentiments (
+        id INTEGER PRIMARY KEY,
+        entity_id INTEGER REFERENCES entities(entity_id),
+        sentiment_pos DOUBLE PRECISION,
+        sentiment_neg DOUBLE PRECISION,
+        sentiment_neu DOUBLE PRECISION,
+        sentiment_compound DOUBLE PRECISION
+    );
+    """,
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_entity_sentiments_entity ON entity_sentiments (entity_id);",
+    """
+    CREATE TABLE IF NOT EXISTS topics (
+        topic_id INTEGER PRIMARY KEY,
+        topic_name VARCHAR(100) NOT NULL,
+        description TEXT,
+        article_id INTEGER,
+        topic_weight TEXT
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS article_topics (
+        article_id INTEGER NOT NULL REFERENCES articles(article_id),
+        topic_id INTEGER NOT NULL REFERENCES topics(topic_id),
+        topic_weight REAL,
+        PRIMARY KEY (article_id, topic_id)
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS faiss_index (
+        index_id INTEGER PRIMARY KEY,
+        article_id INTEGER REFERENCES articles(article_id),
+        faiss_vector BLOB
+    );
+    """,
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_faiss_index_article ON faiss_index (article_id);",
+    """
+    CREATE TABLE IF NOT EXISTS passages (
+        passage_id INTEGER PRIMARY KEY,
+        article_id INTEGER NOT NULL REFERENCES articles(article_id),
+        passage_index INTEGER NOT NULL,
+        start_pos INTEGER NOT NULL,
+        end_pos INTEGER NOT NULL,
+        token_count INTEGER,
+        model_version VARCHAR(255),
+        embedding_vector BLOB,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE (article_id, passage_index)
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS geocoded_locations (
+        entity_id INTEGER PRIMARY KEY REFERENCES entities(entity_id),
+        latitude NUMERIC(9, 6),
+        longitude NUMERIC(9, 6),
+        geocoding_source VARCHAR(255),
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    """,
+]
+
+# PostgreSQL spellings used by the stages and their SQLite equivalents, applied in order
+TRANSLATIONS = [
+    (re.compile(r"=\s*ANY\s*\(\s*%s\s*\)", re.IGNORECASE), "IN (SELECT value FROM json_each(%s))"),
+    (re.compile(r"\bNOW\(\)", re.IGNORECASE), "CURRENT_TIMESTAMP"),
+    (re.compile(r"::\s*[A-Za-z_]+(\[\])?"), ""),
+    (re.compile(r"\bTRUNCATE\s+(TABLE\s+)?", re.IGNORECASE), "DELETE FROM "),
+    (re.compile(r"%(s|%)"), lambda match: "?" if match.group(1) == "s" else "%"),
+]
+
+# "FROM (VALUES %s) AS batch (a, b)": SQLite names the columns of a VALUES list column1, column2, ...
+VALUES_ALIAS = re.compile(r"\(\s*VALUES\s+%s\s*\)\s+AS\s+(\w+)\s*\(([^)]*)\)", re.IGNORECASE)
+
+# Databases whose schema this process has already created
+_schema_ready = set()
+
+
+# Function to rewrite a query written for PostgreSQL into SQLite's dialect
+@functools.lru_cache(maxsize=512)
+def translate(query):
+    for pattern, replacement in TRANSLATIONS:
+        query = pattern.sub(replacement, query)
+    return query
+
+# Function to convert a parameter to a value SQLite can store, as psycopg2 would adapt it
+def adapt(value):
+    if type(value).__module__ == 'numpy':
+        value = value.tolist()
+    if isinstance(value, psycopg2.extensions.Binary):
+        return bytes(value.adapted)
+    if isinstance(value, psycopg2.extras.Json):
+        return value.dumps(value.adapted)
+    if isinstance(value, (list, tuple, dict)):
+        return json.dumps(value)
+    if isinstance(value, memoryview):
+        return bytes(value)
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if isinstance(value, datetime.datetime):
+        return value.isoformat(sep=' ')
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    return value
+
+# Function to read a stored date or timestamp back as a Python object (other text stays text)
+def convert_datetime(parse):
+    def converter(value):
+        text = value.decode('utf-8')
+        try:
+            return parse(text)
+        except ValueError:
+            return text
+    return converter
+
+# Function to read a JSON column back as a Python object
+def convert_json(value):
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value.decode('utf-8')
+
+sqlite3.register_converter("TIMESTAMP", convert_datetime(datetime.datetime.fromisoformat))
+sqlite3.register_converter("DATE", convert_datetime(datetime.date.fromisoformat))
+sqlite3.register_converter("JSONB", convert_json)
+sqlite3.register_converter("REAL_ARRAY", convert_json)
+
+# Function to raise the psycopg2 exception matching an SQLite error, so the stages' except
+# clauses (and the retries of transient errors) work the same on both backends
+def raise_as_psycopg2(error):
+    message = str(error)
+    if isinstance(error, sqlite3.IntegrityError):
+        raise psycopg2.IntegrityError(message) from error
+    if isinstance(error, sqlite3.OperationalError):
+        if message == "interrupted":
+            raise psycopg2.extensions.QueryCanceledError("canceling statement due to statement timeout") from error
+        if "locked" in message or "busy" in message:
+            raise psycopg2.OperationalError(message) from error
+        raise psycopg2.ProgrammingError(message) from error
+    if isinstance(error, sqlite3.DataError):
+        raise psycopg2.DataError(message) from error
+    raise psycopg2.DatabaseError(message) from error
+
+# Function to parse a stored vector: a float32 blob (5_), a float16 blob of the given dimension
+# (see vectors.py), or a cube/array literal "{0.1, 0.2}"
+def parse_vector(value, dimension=None):
+    if isinstance(value, bytes):
+        if dimension is not None and len(value) == 2 * dimension:
+            return struct.unpack(f'<{dimension}e', value)
+        return array.array('f', value)
+    return [float(item) for item in str(value).strip('{}()[]').split(',') if item.strip()]
+
+# SQL function cube_distance(a, b): the Euclidean distance of the cube extension (a blob is read
+# with the dimension of the other vector, which tells float16 from float32)
+def cube_distance(a, b):
+    if a is None or b is None:
+        return None
+    if isinstance(a, bytes):
+        a, b = b, a
+    a = parse_vector(a)
+    return math.dist(a, parse_vector(b, len(a)))
+
+
+class SQLiteCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.cursor = connection.raw.cursor()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
+
+    @property
+    def description(self):
+        return self.cursor.description
+
+    # Function to run a statement, opening the transaction first as psycopg2 does
+    def execute(self, query, params=None):
+        self.run(self.cursor.execute, translate(query), [adapt(value) for value in params or ()])
+
+    def executemany(self, query, params_seq):
+        self.run(self.cursor.executemany, translate(query), ([adapt(value) for value in params] for params in params_seq))
+
+    def run(self, method, query, params):
+        connection = self.connection
+        try:
+            # The timeout covers fetching the rows too, since SQLite runs a query as it is read
+            connection.start_statement()
+            if not connection.autocommit and not connection.raw.in_transaction:
+                connection.raw.execute("BEGIN")
+            method(query, params)
+        except sqlite3.Error as e:
+            raise_as_psycopg2(e)
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchmany(self, size=None):
+        return self.cursor.fetchmany(size or self.cursor.arraysize)
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def close(self):
+        self.cursor.close()
+
+
+class SQLiteConnection:
+    def __init__(self, raw, statement_timeout=0, autocommit=False):
+        self.raw = raw
+        self.statement_timeout = statement_timeout
+        self.autocommit = autocommit
+        self.deadline = None
+        self.closed = 0
+        if statement_timeout:
+            # SQLite has no statement timeout; the progress handler interrupts long statements
+            raw.set_progress_handler(self.past_deadline, 10000)
+
+    def start_statement(self):
+        self.deadline = time.monotonic() + self.statement_timeout / 1000 if self.statement_timeout else None
+
+    def past_deadline(self):
+        return self.deadline is not None and time.monotonic() > self.deadline
+
+    def cursor(self):
+        return SQLiteCursor(self)
+
+    def commit(self):
+        self.deadline = None
+        if self.raw.in_transaction:
+            self.raw.execute("COMMIT")
+
+    def rollback(self):
+        self.deadline = None
+        if self.raw.in_transaction:
+            self.raw.execute("ROLLBACK")
+
+    # close() rolls back unfinished work, as closing a psycopg2 connection does
+    def close(self):
+        if self.closed:
+            return
+        self.rollback()
+        self.raw.close()
+        self.closed = 1
+
+    discard = close
+
+
+# Columns added to the tables since the schema above, added to databases created before them
+ADDED_COLUMNS = [
+    ("articles", "embedding_dtype", "VARCHAR(16)"),
+    ("passages", "embedding_dtype", "VARCHAR(16)"),
+]
+
+# Function to create the tables of a new database (and the added columns of an older one)
+def create_schema(raw):
+    for command in SCHEMA:
+        raw.execute(command)
+    for table, column, column_type in ADDED_COLUMNS:
+        if column not in {row[1] for row in raw.execute(f"PRAGMA table_info({table})")}:
+            raw.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+
+# Function to open a connection to the local database, creating its schema the first time
+def connect(statement_timeout=0, autocommit=False, path=None):
+    path = path or database_path
+    raw = sqlite3.connect(path, timeout=busy_timeout, isolation_level=None,
+                          detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+    # WAL lets the stages read while another process writes
+    raw.execute("PRAGMA journal_mode = WAL;")
+    raw.execute("PRAGMA synchronous = NORMAL;")
+    raw.execute("PRAGMA foreign_keys = ON;")
+    raw.create_function("cube_distance", 2, cube_distance, deterministic=True)
+    # One writer at a time is all SQLite allows, so the advisory locks taken around table
+    # creation (checkpoints.py, job_queue.py) have nothing left to do
+    raw.create_function("hashtext", 1, lambda text: 0, deterministic=True)
+    raw.create_function("pg_advisory_xact_lock", 1, lambda key: None)
+
+    if path not in _schema_ready:
+        create_schema(raw)
+        _schema_ready.add(path)
+        logging.info(f"[INFO] Using the local SQLite database {path}.")
+    return SQLiteConnection(raw, statement_timeout, autocommit)
+
+# Function to write many rows with multi-row statements; query has a single VALUES %s placeholder
+def write_values(cursor, query, rows, template=None, page_size=1000):
+    if not rows:
+        return
+    width = template.count('%s') if template else len(rows[0])
+    query = VALUES_ALIAS.sub(lambda match: "(SELECT " + ", ".join(
+        f"column{number} AS {name.strip()}" for number, name in enumerate(match.group(2).split(','), 1)
+    ) + f" FROM (VALUES %s)) AS {match.group(1)}", query)
+    row_placeholders = "(" + ", ".join(["%s"] * width) + ")"
+    page_size = max(1, min(page_size, MAX_PARAMETERS // width))
+    for start in range(0, len(rows), page_size):
+        page = rows[start:start + page_size]
+        cursor.execute(query.replace("VALUES %s", "VALUES " + ", ".join([row_placeholders] * len(page)), 1),
+                       [value for row in page for value in row])
+
+# Function to read back a field of the COPY text format
+def copy_field(value):
+    if value == '\\N':
+        return None
+    return re.sub(r"\\(.)", lambda match: {'t': '\t', 'n': '\n', 'r': '\r'}.get(match.group(1), match.group(1)), value)
+
+# Function to insert rows formatted for COPY (see database.copy_row) from a buffer into a table
+def copy_buffer(cursor, table, columns, buffer):
+    buffer.seek(0)
+    rows = (tuple(copy_field(value) for value in line.rstrip('\n').split('\t')) for line in buffer)
+    cursor.executemany(f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join(['%s'] * len(columns))})", rows)
@@ -0,0 +1,19 @@
+import os
+import sys
+import pytest
+
+# The tests import the modules from the repository root, where they also read settings.ini
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+os.chdir(ROOT)
+
+
+# Fixture switching database.py to a fresh local SQLite database (see sqlite_backend.py)
+@pytest.fixture
+def sqlite_database(tmp_path, monkeypatch):
+    import database
+    import sqlite_backend
+    monkeypatch.setattr(database, "backend", "sqlite")
+    monkeypatch.setattr(sqlite_backend, "database_path", str(tmp_path / "trinity.sqlite3"))
+    return sqlite_backend.database_path
@@ -0,0 +1,51 @@
+import re
+import random
+import pytest
+import ocr_corpus
+from block_classifier import classify_blocks
+
+# The stage 1 patterns the classifier replaced; it must find exactly what finditer() found
+ORIGINAL_PATTERNS = {
+    "article": re.compile(r'(?<=\n\n)([^\n]{1,80})\n+([^\n]+\n(.+\n)*)'),
+    "poetry": re.compile(r'(Selected Poetry|BY [A-Z\s]+)\n+([^\n]+\n(.+\n)*)'),
+    "advertisement": re.compile(r'([A-Z\s]+(?:CO|CO\.|INC|LTD|ADVERTISEMENT|SALE|NOTICE|WHOLESALE))\n+([^\n]+\n(.+\n)*)'),
+}
+
+# Pieces the random texts are built from: the headers, keywords and line breaks the patterns
+# react to, and the whitespace \s matches besides spaces and newlines
+FRAGMENTS = ('\n', '\n', '\n\n', 'A', 'B', ' ', 'CO', 'CO.', '.', 'BY ', 'Selected Poetry', 'INC', 'SALE',
+             'x', '\t', '\r', '\x0c', '\x1c', '\x85', 'NOTICE', 'LTD', 'WHOLESALE', 'a b', 'X' * 50, 'Y' * 90)
+
+
+# Function to list the blocks the original patterns find, in the classifier's format
+def original_blocks(text):
+    return {kind: [(match.start(), match.end(), match.group(1), match.group(2)) for match in pattern.finditer(text)]
+            for kind, pattern in ORIGINAL_PATTERNS.items()}
+
+
+@pytest.mark.parametrize("text", [
+    "",
+    "\n\nTITLE\nbody line\n",
+    "THE TRINITY JOURNAL.\n\nLOCAL MATTERS\n\nThe stage arrived.\nIt was late.\n\nnext\n",
+    "Selected Poetry\n\nThe hills are green\nand the river runs\n",
+    "BY JOHN G. WHITTIER\nA verse\nanother verse\n",
+    "HOOPER & CO.\nDealers in Groceries.\nMain Street.\n",
+    "GREAT CLEARANCE SALE\n\n\nEverything must go\n",
+    "NOTICE\nno body newline",
+    "ALL CAPS\nPAGE OF\nCAPITALS WITHOUT\nANY KEYWORD\n" * 20,
+])
+def test_examples_match_original_patterns(text):
+    assert classify_blocks(text) == original_blocks(text)
+
+
+@pytest.mark.parametrize("number", range(5))
+def test_synthetic_issues_match_original_patterns(number):
+    text = ocr_corpus.build_issue(random.Random(number), 16 * 1024, number)
+    assert classify_blocks(text) == original_blocks(text)
+
+
+def test_random_texts_match_original_patterns():
+    rng = random.Random(1856)
+    for _ in range(2000):
+        text = ''.join(rng.choice(FRAGMENTS) for _ in range(rng.randint(0, 60)))
+        assert classify_blocks(text) == original_blocks(text), repr(text)
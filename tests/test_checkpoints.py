@@ -0,0 +1,62 @@
+import checkpoints
+from database import connect_db, iter_keyset
+
+
+# Function to add an issue with articles 1..count, without summaries
+def add_articles(conn, count):
+    with conn.cursor() as cursor:
+        cursor.execute("INSERT INTO newspapers (title, publication_date) VALUES ('issue.txt', '1856-01-05')")
+        for article_id in range(1, count + 1):
+            cursor.execute("INSERT INTO articles (article_id, newspaper_id, title, content) VALUES (%s, 1, %s, 'text')",
+                           (article_id, f"title {article_id}"))
+    conn.commit()
+
+# Function to give articles a summary, as the summary stage would
+def summarize(conn, article_ids):
+    with conn.cursor() as cursor:
+        for article_id in article_ids:
+            cursor.execute("UPDATE articles SET summary = %s WHERE article_id = %s", (f"summary {article_id}", article_id))
+    conn.commit()
+
+# Function to run a summary stage like 11_ once; returns the article_ids it processed
+def run_summary_stage(conn, fail=(), restart=False):
+    processed = []
+
+    def batches(cursor, after):
+        where, params = checkpoints.resume_filter("summary_ner", "summary IS NOT NULL", "summary_ner_entities IS NULL", after)
+        return iter_keyset(cursor, "SELECT article_id, summary FROM articles", "article_id",
+                           where=where, params=params, batch_size=2)
+
+    def process(cursor, rows):
+        for article_id, _ in rows:
+            if article_id in fail:
+                raise ValueError("bad summary")
+        for article_id, _ in rows:
+            cursor.execute("UPDATE articles SET summary_ner_entities = '[]' WHERE article_id = %s", (article_id,))
+            processed.append(article_id)
+
+    checkpoints.run_checkpointed(conn, "summary_ner", "model", batches, process, restart)
+    return processed
+
+
+def test_resumed_run_takes_summaries_written_below_the_checkpoint(sqlite_database):
+    conn = connect_db()
+    add_articles(conn, 6)
+    summarize(conn, [2, 4])
+    assert run_summary_stage(conn) == [2, 4]
+
+    # Articles 1 and 3 get their summaries after the run, below its checkpoint
+    summarize(conn, [1, 3, 6])
+    assert run_summary_stage(conn) == [1, 3, 6]
+    assert run_summary_stage(conn) == []
+    conn.close()
+
+
+def test_dead_letters_below_the_checkpoint_wait_for_restart(sqlite_database):
+    conn = connect_db()
+    add_articles(conn, 4)
+    summarize(conn, [1, 2, 3])
+    assert run_summary_stage(conn, fail={1}) == [2, 3]
+    assert run_summary_stage(conn) == []
+    assert run_summary_stage(conn, restart=True) == [1, 2, 3]
+    conn.close()
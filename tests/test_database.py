@@ -0,0 +1,62 @@
+import psycopg2
+import psycopg2.extensions
+import pytest
+import database
+
+
+@pytest.fixture
+def attempts(sqlite_database, monkeypatch):
+    monkeypatch.setattr(database, "retry_delay", 0)
+    return []
+
+
+# Function to make a unit of work that raises `error` on its first `failures` attempts
+def failing_work(attempts, error, failures):
+    def work(cursor, value):
+        attempts.append(value)
+        if len(attempts) <= failures:
+            raise error
+        cursor.execute("INSERT INTO newspapers (title, publication_date) VALUES (%s, '1856-01-05')", (value,))
+        return len(attempts)
+    return work
+
+
+def stored_titles():
+    conn = database.connect_db()
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT title FROM newspapers")
+        titles = [row[0] for row in cursor.fetchall()]
+    conn.close()
+    return titles
+
+
+def test_transaction_is_committed(attempts):
+    assert database.run_transaction(failing_work(attempts, None, 0), "issue.txt") == 1
+    assert stored_titles() == ["issue.txt"]
+
+
+def test_transient_errors_are_retried(attempts):
+    work = failing_work(attempts, psycopg2.OperationalError("server closed the connection"), database.max_retries - 1)
+    assert database.run_transaction(work, "issue.txt") == database.max_retries
+    assert stored_titles() == ["issue.txt"]
+
+
+def test_transient_errors_give_up_after_max_retries(attempts):
+    work = failing_work(attempts, psycopg2.extensions.TransactionRollbackError("deadlock detected"), database.max_retries)
+    with pytest.raises(psycopg2.extensions.TransactionRollbackError):
+        database.run_transaction(work, "issue.txt")
+    assert len(attempts) == database.max_retries
+
+
+def test_statement_timeouts_are_not_retried(attempts):
+    work = failing_work(attempts, psycopg2.extensions.QueryCanceledError("canceling statement due to statement timeout"), 1)
+    with pytest.raises(psycopg2.extensions.QueryCanceledError):
+        database.run_transaction(work, "issue.txt")
+    assert len(attempts) == 1
+    assert stored_titles() == []
+
+
+def test_other_errors_are_not_retried(attempts):
+    with pytest.raises(psycopg2.IntegrityError):
+        database.run_transaction(failing_work(attempts, psycopg2.IntegrityError("duplicate key"), 1), "issue.txt")
+    assert len(attempts) == 1
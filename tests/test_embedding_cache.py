@@ -0,0 +1,93 @@
+import zlib
+import numpy as np
+import pytest
+import embedding_cache
+
+
+@pytest.fixture(autouse=True)
+def cache_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(embedding_cache, "cache_path", str(tmp_path / "embedding_cache.db"))
+    monkeypatch.setattr(embedding_cache, "_connection", None)
+    monkeypatch.setattr(embedding_cache, "_connection_key", None)
+    yield
+    if embedding_cache._connection is not None:
+        embedding_cache._connection.close()
+
+
+# Encoder stand-in: a vector seeded by the text, recording the texts it was asked for
+class Encoder:
+    def __init__(self, texts, dimension=8):
+        self.texts = texts
+        self.dimension = dimension
+        self.encoded = []
+
+    def __call__(self, indexes):
+        self.encoded.extend(self.texts[index] for index in indexes)
+        return [np.random.default_rng(zlib.crc32(self.texts[index].encode())).random(self.dimension, dtype=np.float32)
+                for index in indexes]
+
+
+def test_normalized_copies_share_a_hash():
+    assert embedding_cache.content_hash("gold  in\nthe hills ") == embedding_cache.content_hash("gold in the hills")
+    assert embedding_cache.content_hash("Cafe\u0301") == embedding_cache.content_hash("Caf\u00e9")
+    assert embedding_cache.content_hash("gold") != embedding_cache.content_hash("Gold")
+    assert embedding_cache.content_hash(None) == embedding_cache.content_hash("")
+
+
+def test_only_missing_texts_are_encoded():
+    texts = ["gold in the hills", "a stage robbery", "gold  in the\nhills", "a stage robbery"]
+    first = Encoder(texts)
+    vectors = embedding_cache.encode_cached("model", texts, first, use_cache=True)
+    assert first.encoded == ["gold in the hills", "a stage robbery"]
+    assert vectors.shape == (4, 8)
+    np.testing.assert_array_equal(vectors[0], vectors[2])
+    np.testing.assert_array_equal(vectors[1], vectors[3])
+
+    texts = texts + ["a new article"]
+    second = Encoder(texts)
+    again = embedding_cache.encode_cached("model", texts, second, use_cache=True)
+    assert second.encoded == ["a new article"]
+    np.testing.assert_array_equal(again[:4], vectors)
+
+
+def test_models_do_not_share_entries():
+    texts = ["gold in the hills"]
+    embedding_cache.encode_cached("model-a", texts, Encoder(texts), use_cache=True)
+    other = Encoder(texts)
+    embedding_cache.encode_cached("model-b", texts, other, use_cache=True)
+    assert other.encoded == texts
+
+
+def test_disabled_cache_encodes_everything_and_stores_nothing():
+    texts = ["gold in the hills", "gold in the hills"]
+    encoder = Encoder(texts)
+    embedding_cache.encode_cached("model", texts, encoder, use_cache=False)
+    assert encoder.encoded == ["gold in the hills"]
+    assert embedding_cache.lookup("model", [embedding_cache.content_hash(texts[0])]) == {}
+
+
+def test_vectors_keep_their_type():
+    texts = ["half precision"]
+    encode = lambda indexes: [np.ones(4, dtype=np.float16) for _ in indexes]
+    embedding_cache.encode_cached("model", texts, encode, use_cache=True)
+    cached = embedding_cache.lookup("model", [embedding_cache.content_hash(texts[0])])
+    assert list(cached.values())[0].dtype == np.float16
+
+
+def test_eviction_keeps_the_recently_used_entries(monkeypatch):
+    texts = [f"article number {number}" for number in range(400)]
+    monkeypatch.setattr(embedding_cache, "max_mb", 1024)
+    embedding_cache.encode_cached("model", texts, Encoder(texts, dimension=256), use_cache=True)
+    connection = embedding_cache.get_cache()
+    assert connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0] == 400
+
+    # The first texts are used again, so the oldest entries are now the others
+    embedding_cache.lookup("model", [embedding_cache.content_hash(text) for text in texts[:50]])
+    monkeypatch.setattr(embedding_cache, "max_mb", 0.2)
+    evicted = embedding_cache.evict()
+    remaining = {row[0] for row in connection.execute("SELECT content_hash FROM embeddings")}
+    assert 0 < evicted < 400
+    assert len(remaining) == 400 - evicted
+    assert {embedding_cache.content_hash(text) for text in texts[:50]} <= remaining
+    # Trimmed below the limit, so the next check evicts nothing
+    assert embedding_cache.evict() == 0
@@ -0,0 +1,40 @@
+import random
+import pytest
+import ocr_corpus
+import encoding_detector
+
+
+# Function to build the raw bytes of a synthetic issue in an encoding
+def issue_bytes(encoding, seed=7, size=200 * 1024):
+    text = ocr_corpus.build_issue(random.Random(seed), size, seed) + "Café on Main Street, naïve £ prices\n"
+    return text.encode(encoding, errors='replace'), text
+
+
+def test_sample_holds_every_non_ascii_line_once():
+    raw_data, _ = issue_bytes('utf-8')
+    sample, complete = encoding_detector.build_sample(raw_data)
+    assert complete and len(sample) <= encoding_detector.SAMPLE_SIZE
+    lines = [line for line in raw_data.split(b'\n') if encoding_detector.NON_ASCII_PATTERN.search(line)]
+    sample_lines = sample.split(b'\n')
+    assert all(line in sample_lines for line in lines)
+    assert len([line for line in sample_lines if encoding_detector.NON_ASCII_PATTERN.search(line)]) == len(set(lines))
+
+    # A sample too small for the non-ASCII lines says so
+    assert encoding_detector.build_sample(raw_data, sample_size=encoding_detector.HEAD_SIZE + 64)[1] is False
+
+
+@pytest.mark.parametrize("encoding", ['utf-8', 'windows-1252'])
+def test_complete_sample_decides_without_reading_the_whole_file(encoding, monkeypatch):
+    raw_data, text = issue_bytes(encoding)
+    decoded = []
+    original = encoding_detector.decodes_cleanly
+
+    def recording(data, guess, chunk_size=encoding_detector.CHUNK_SIZE):
+        decoded.append(len(data))
+        return original(data, guess, chunk_size)
+    monkeypatch.setattr(encoding_detector, "decodes_cleanly", recording)
+
+    guess, _, method = encoding_detector.detect_bytes(raw_data)
+    assert method == 'sample'
+    assert raw_data.decode(guess) == text
+    assert decoded and max(decoded) <= encoding_detector.SAMPLE_SIZE
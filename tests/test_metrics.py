@@ -0,0 +1,55 @@
+import metrics
+
+
+# Tokenizer stand-in: one token per character, counting its calls
+class CharacterTokenizer:
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, texts, add_special_tokens=False):
+        self.calls += 1
+        return {"input_ids": [list(text) for text in texts]}
+
+
+# Tokenizer stand-in that fails
+class BrokenTokenizer:
+    def __call__(self, texts, **options):
+        raise ValueError("no tokenizer")
+
+
+# Function to count the tokens of texts in a fresh stage; returns the count
+def counted(texts, tokenizer=None):
+    @metrics.instrumented("test", per_process=True)
+    def run():
+        metrics.count_tokens(texts, tokenizer)
+        return metrics.current().counters.get("tokens", 0)
+    return run()
+
+
+def test_words_are_counted_without_tokenizing(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, "metrics_directory", str(tmp_path))
+    tokenizer = CharacterTokenizer()
+    assert counted(["gold in the hills", None, "stage"], tokenizer) == 5
+    assert tokenizer.calls == 0
+
+
+def test_exact_tokens_use_the_tokenizer(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, "metrics_directory", str(tmp_path))
+    monkeypatch.setattr(metrics, "exact_tokens", True)
+    tokenizer = CharacterTokenizer()
+    assert counted(["gold", "stage"], tokenizer) == 9
+    assert tokenizer.calls == 1
+    assert counted(["gold in the hills"], BrokenTokenizer()) == 4
+    assert counted(["gold in the hills"]) == 4
+
+
+def test_worker_textfiles_do_not_share_series(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, "metrics_directory", str(tmp_path))
+    worker = metrics.StageMetrics("test", per_process=True)
+    worker.count("articles", 3)
+    worker.observe("model_batch_seconds", 0.2)
+    series = [line for line in worker.prometheus_text().splitlines() if not line.startswith("#")]
+    assert series and all(f'pid="{metrics.os.getpid()}"' in line and 'host="' in line for line in series)
+    single = metrics.StageMetrics("test")
+    single.count("articles", 3)
+    assert 'trinity_articles_total{stage="test"} 3' in single.prometheus_text()
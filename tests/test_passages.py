@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+from passages import split_passages, pool_passages
+
+
+# Tokenizer stand-in that reports one token per character pair, with offsets
+class PairTokenizer:
+    def __call__(self, text, add_special_tokens=False, return_offsets_mapping=False):
+        return {"offset_mapping": [(start, min(start + 2, len(text))) for start in range(0, len(text), 2)]}
+
+
+# Tokenizer stand-in that cannot report offsets
+class BrokenTokenizer:
+    def __call__(self, text, **options):
+        raise NotImplementedError("offsets need a fast tokenizer")
+
+
+def test_words_split_into_overlapping_passages():
+    text = "one two three four five six seven"
+    passages = split_passages(text, size=3, overlap=1)
+    assert [text[start:end] for start, end, _ in passages] == ["one two three", "three four five", "five six seven"]
+    assert [count for _, _, count in passages] == [3, 3, 3]
+
+
+def test_last_passage_may_be_short():
+    text = "a b c d e"
+    assert [(text[start:end], count) for start, end, count in split_passages(text, size=4, overlap=2)] == [("a b c d", 4), ("c d e", 3)]
+
+
+def test_short_text_is_one_passage():
+    assert split_passages("just a few words", size=256, overlap=64) == [(0, 16, 4)]
+
+
+def test_empty_text_is_one_empty_passage():
+    assert split_passages("", size=4, overlap=1) == [(0, 0, 0)]
+    assert split_passages("   ", size=4, overlap=1) == [(0, 3, 0)]
+
+
+def test_overlap_not_below_size_still_advances():
+    text = "a b c"
+    assert [text[start:end] for start, end, _ in split_passages(text, size=2, overlap=2)] == ["a b", "b c"]
+
+
+def test_tokenizer_offsets():
+    assert split_passages("abcdefgh", PairTokenizer(), size=2, overlap=0) == [(0, 4, 2), (4, 8, 2)]
+
+
+def test_tokenizer_without_offsets_falls_back_to_words():
+    assert split_passages("a b c", BrokenTokenizer(), size=2, overlap=0) == [(0, 3, 2), (4, 5, 1)]
+
+
+def test_pooling_one_passage_returns_it():
+    vector = np.array([[0.6, 0.8]], dtype=np.float32)
+    np.testing.assert_allclose(pool_passages(vector, [5]), vector[0], rtol=1e-6)
+
+
+def test_pooling_weights_by_token_count():
+    vectors = np.array([[1.0, 0.0], [0.0, 1.0]], dtype=np.float32)
+    pooled = pool_passages(vectors, [3, 1])
+    assert pooled[0] == pytest.approx(3 * pooled[1], rel=1e-5)
+
+
+def test_pooling_unit_vectors_gives_a_unit_vector():
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(6, 16)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    pooled = pool_passages(vectors, [256, 256, 256, 256, 256, 17])
+    assert pooled.dtype == np.float32
+    assert np.linalg.norm(pooled) == pytest.approx(1.0, rel=1e-5)
+
+
+def test_pooling_empty_passages_still_counts_them():
+    vectors = np.array([[1.0, 0.0], [0.0, 1.0]], dtype=np.float32)
+    pooled = pool_passages(vectors, [0, 1])
+    assert pooled[0] == pytest.approx(pooled[1], rel=1e-5)
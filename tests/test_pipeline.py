@@ -0,0 +1,59 @@
+import sys
+import types
+import pytest
+import pipeline
+
+
+# Function to register a stand-in module for a stage whose entry function returns `result`
+# (or raises it, if it is an exception), counting its runs
+def stand_in(monkeypatch, stage, result, runs):
+    module_name, entry, *_ = pipeline.STAGES[stage]
+
+    def run(**options):
+        runs.append(stage)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    module = types.ModuleType(module_name)
+    setattr(module, entry, run)
+    monkeypatch.setitem(sys.modules, module_name, module)
+    return module
+
+
+@pytest.fixture
+def state_path(tmp_path, sqlite_database, monkeypatch):
+    path = str(tmp_path / "pipeline_state.json")
+    monkeypatch.setattr(pipeline, "state_path", path)
+    monkeypatch.setattr(pipeline.tuning, "apply_saved", False)
+    return path
+
+
+@pytest.mark.parametrize("result", [True, False, None, RuntimeError("model missing")])
+def test_only_completed_stages_are_recorded(state_path, tmp_path, monkeypatch, result):
+    runs = []
+    stand_in(monkeypatch, "load", True, runs).input_directory = str(tmp_path)
+    stand_in(monkeypatch, "embeddings", result, runs)
+    stand_in(monkeypatch, "faiss", True, runs)
+
+    timings = pipeline.run_pipeline(["load", "embeddings", "faiss"])
+    stages = pipeline.load_state(state_path)["stages"]
+    if result is True:
+        assert {stage: timing["status"] for stage, timing in timings.items()} == {"load": "ran", "embeddings": "ran", "faiss": "ran"}
+        assert set(stages) == {"load", "embeddings", "faiss"}
+    else:
+        # A stage that did not return True failed: it is not recorded and its dependents do not run
+        assert {stage: timing["status"] for stage, timing in timings.items()} == {"load": "ran", "embeddings": "failed", "faiss": "blocked"}
+        assert set(stages) == {"load"}
+    assert runs == ["load", "embeddings", "faiss"] if result is True else ["load", "embeddings"]
+
+
+def test_failed_stage_runs_again(state_path, tmp_path, monkeypatch):
+    runs = []
+    stand_in(monkeypatch, "load", False, runs).input_directory = str(tmp_path)
+    pipeline.run_pipeline(["load"])
+    stand_in(monkeypatch, "load", True, runs).input_directory = str(tmp_path)
+    assert pipeline.run_pipeline(["load"])["load"]["status"] == "ran"
+    # Once it completed, an unchanged input is skipped
+    assert pipeline.run_pipeline(["load"])["load"]["status"] == "unchanged"
+    assert runs == ["load", "load"]
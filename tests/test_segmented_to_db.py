@@ -0,0 +1,94 @@
+import os
+import json
+import importlib
+import pytest
+import metrics
+from database import connect_db
+
+loader = importlib.import_module("4_segmented_to_db")
+
+# A long title, longer than the 255-character column
+LONG_TITLE = "A VERY LONG HEADLINE " * 20
+
+# Segmented issues as segmenter.py writes them: issue record, then one record per article
+ISSUES = {
+    "Trinity Journal 5 January 1856 No 000000_seg3.jsonl": (
+        {"date": "1856-01-05", "toc": "Local Matters", "hyperlink": "https://example.org/1"},
+        [("LOCAL MATTERS", "The stage arrived late.\nTwo passengers."),
+         ("MINING INTELLIGENCE", "Gold at Weaverville."),
+         ("LOCAL MATTERS", "A second article under the same title."),
+         ("", "An article without a title."),
+         (LONG_TITLE, "Under a long headline.")],
+    ),
+    "Trinity Journal 12 January 1856 No 000001_seg3.jsonl": (
+        {"date": "1856-01-12", "toc": None, "hyperlink": None},
+        [("LOCAL MATTERS", "Snow on the Trinity Mountains.\tCold.\\ Backslash."),
+         ("TELEGRAPHIC NEWS", "News from the East.")],
+    ),
+}
+
+
+@pytest.fixture
+def segmented_directory(tmp_path, sqlite_database, monkeypatch):
+    directory = tmp_path / "segmented"
+    directory.mkdir()
+    for name, (issue, articles) in ISSUES.items():
+        lines = [dict(issue, type="issue", source=name, issue="THE TRINITY JOURNAL.")]
+        lines += [{"type": "article", "index": index, "title": title, "body": body} for index, (title, body) in enumerate(articles)]
+        (directory / name).write_text(''.join(json.dumps(line) + "\n" for line in lines), encoding="utf-8")
+    # A legacy text file of an issue that also has a .jsonl file is skipped
+    (directory / "Trinity Journal 5 January 1856 No 000000_seg3.txt").write_text(
+        "Title: STALE\nBody: Not loaded.\n", encoding="utf-8")
+    monkeypatch.setattr(loader, "input_directory", str(directory))
+    monkeypatch.setattr(metrics, "metrics_directory", str(tmp_path / "metrics"))
+    return directory
+
+
+# Function to read back the loaded articles as {(issue, title): content}, and the issues
+def loaded():
+    conn = connect_db()
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            SELECT n.title, a.title, a.content FROM articles a JOIN newspapers n ON n.newspaper_id = a.newspaper_id
+        """)
+        articles = {(issue, title): content for issue, title, content in cursor.fetchall()}
+        cursor.execute("SELECT title, publication_date, toc, hyperlink FROM newspapers")
+        issues = {row[0]: tuple(str(value) if value is not None else None for value in row[1:]) for row in cursor.fetchall()}
+    conn.commit()
+    conn.close()
+    return articles, issues
+
+
+def test_bulk_load_round_trip(segmented_directory):
+    assert loader.process_all_files(bulk=True, batch_files=1) is True
+    articles, issues = loaded()
+
+    first = "Trinity Journal 5 January 1856 No 000000_seg3.txt"
+    second = "Trinity Journal 12 January 1856 No 000001_seg3.txt"
+    assert issues == {first: ("1856-01-05", "Local Matters", "https://example.org/1"), second: ("1856-01-12", None, None)}
+    assert articles == {
+        # The first article with a title in an issue wins
+        (first, "LOCAL MATTERS"): "The stage arrived late.\nTwo passengers.",
+        (first, "MINING INTELLIGENCE"): "Gold at Weaverville.",
+        (first, "Untitled"): "An article without a title.",
+        (first, LONG_TITLE.strip()[:255]): "Under a long headline.",
+        (second, "LOCAL MATTERS"): "Snow on the Trinity Mountains.\tCold.\\ Backslash.",
+        (second, "TELEGRAPHIC NEWS"): "News from the East.",
+    }
+
+    # Loading again adds nothing
+    assert loader.process_all_files(bulk=True, batch_files=50) is True
+    assert loaded() == (articles, issues)
+
+
+def test_bulk_and_row_by_row_loads_agree(segmented_directory, sqlite_database, tmp_path, monkeypatch):
+    assert loader.process_all_files(bulk=True) is True
+    bulk = loaded()
+
+    monkeypatch.setattr("sqlite_backend.database_path", str(tmp_path / "row_by_row.sqlite3"))
+    assert loader.process_all_files(bulk=False) is True
+    row_by_row = loaded()
+
+    # Row by row, the long title is stored whole (SQLite does not enforce VARCHAR lengths)
+    shorten = lambda articles: {(issue, title[:255]): content for (issue, title), content in articles.items()}
+    assert (shorten(bulk[0]), bulk[1]) == (shorten(row_by_row[0]), row_by_row[1])
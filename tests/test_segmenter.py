@@ -0,0 +1,136 @@
+import os
+import json
+import random
+import hashlib
+import functools
+import pytest
+import ocr_corpus
+import segmenter
+import encoding_detector
+
+# Files the stand-in process was called for
+calls = []
+
+
+@pytest.fixture(autouse=True)
+def reset_calls():
+    calls.clear()
+
+
+# Every test gets its own encoding cache
+@pytest.fixture(autouse=True)
+def encoding_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(encoding_detector, "cache_path", str(tmp_path / "encoding_cache.db"))
+
+
+# Stage process stand-in: copies the input, recording the files it was called for
+def copy_file(input_path, output_path, upper=False):
+    calls.append(os.path.basename(input_path))
+    with open(input_path, encoding='utf-8') as source, open(output_path, 'w', encoding='utf-8') as output:
+        text = source.read()
+        output.write(text.upper() if upper else text)
+
+
+def make_tasks(tmp_path, names=("a.txt", "b.txt")):
+    tasks = []
+    for name in names:
+        (tmp_path / name).write_text(f"issue {name}\n", encoding='utf-8')
+        tasks.append((str(tmp_path / name), str(tmp_path / f"out_{name}")))
+    return tasks
+
+
+def test_unchanged_files_are_skipped(tmp_path):
+    tasks = make_tasks(tmp_path)
+    state_path = str(tmp_path / "state.json")
+    process = functools.partial(copy_file, upper=False)
+    segmenter.run_stage(process, tasks, state_path=state_path)
+    segmenter.run_stage(process, tasks, state_path=state_path)
+    assert calls == ["a.txt", "b.txt"]
+
+    (tmp_path / "b.txt").write_text("edited\n", encoding='utf-8')
+    segmenter.run_stage(process, tasks, state_path=state_path)
+    assert calls == ["a.txt", "b.txt", "b.txt"]
+
+
+def test_file_with_unchanged_size_and_mtime_is_not_read(tmp_path, monkeypatch):
+    tasks = make_tasks(tmp_path)
+    state_path = str(tmp_path / "state.json")
+    process = functools.partial(copy_file, upper=False)
+    segmenter.run_stage(process, tasks, state_path=state_path)
+
+    # The second run must fingerprint the inputs from the state file alone
+    def no_reading(*args, **kwargs):
+        raise AssertionError("an unchanged input was read")
+    monkeypatch.setattr(segmenter, "file_sha1", no_reading)
+    monkeypatch.setattr(encoding_detector, "open_mapped", no_reading)
+    segmenter.run_stage(process, tasks, state_path=state_path)
+    assert calls == ["a.txt", "b.txt"]
+
+
+def test_fingerprint_hash_is_reused_by_encoding_detection(tmp_path, monkeypatch):
+    path = tmp_path / "issue.txt"
+    path.write_bytes("The Trinity Journal, caf\u00e9\n".encode('utf-8') * 100)
+    fingerprint = segmenter.file_fingerprint(str(path))
+    assert fingerprint["sha1"] == hashlib.sha1(path.read_bytes()).hexdigest()
+
+    # Detection reads the file, but does not hash it a second time
+    def no_hashing(*args, **kwargs):
+        raise AssertionError("the file was hashed twice")
+    monkeypatch.setattr(encoding_detector, "content_sha1", no_hashing)
+    assert encoding_detector.detect_encoding(str(path)).lower() == "utf-8"
+    assert segmenter.file_fingerprint(str(path)) == fingerprint
+
+
+def test_changed_options_reprocess_every_file(tmp_path):
+    tasks = make_tasks(tmp_path)
+    state_path = str(tmp_path / "state.json")
+    segmenter.run_stage(functools.partial(copy_file, upper=False), tasks, state_path=state_path)
+    segmenter.run_stage(functools.partial(copy_file, upper=True), tasks, state_path=state_path)
+    assert calls == ["a.txt", "b.txt", "a.txt", "b.txt"]
+    assert (tmp_path / "out_a.txt").read_text(encoding='utf-8') == "ISSUE A.TXT\n"
+
+
+def test_new_version_reprocesses_every_file(tmp_path, monkeypatch):
+    tasks = make_tasks(tmp_path)
+    state_path = str(tmp_path / "state.json")
+    process = functools.partial(copy_file, upper=False)
+    segmenter.run_stage(process, tasks, state_path=state_path)
+    monkeypatch.setattr(segmenter, "SEGMENTER_VERSION", segmenter.SEGMENTER_VERSION + 1)
+    segmenter.run_stage(process, tasks, state_path=state_path)
+    assert calls == ["a.txt", "b.txt", "a.txt", "b.txt"]
+
+
+def test_settings_fingerprint_is_stable():
+    # Functions are named, not identified by their address, so a new process gets the same fingerprint
+    first = segmenter.settings_fingerprint(functools.partial(segmenter.process_file, clean=True))
+    second = segmenter.settings_fingerprint(functools.partial(segmenter.process_file, clean=True))
+    assert first == second
+    assert first != segmenter.settings_fingerprint(functools.partial(segmenter.process_file, clean=False))
+    assert first != segmenter.settings_fingerprint(segmenter.process_file)
+
+
+def test_jsonl_records_hold_the_articles_of_the_text_format(tmp_path):
+    raw = tmp_path / ocr_corpus.issue_file_name(3)
+    raw.write_text(ocr_corpus.build_issue(random.Random(3), 16 * 1024, 3), encoding='utf-8')
+    segmenter.process_file(str(raw), str(tmp_path / "issue.jsonl"))
+    segmenter.process_file(str(raw), str(tmp_path / "issue.txt"))
+
+    with open(tmp_path / "issue.jsonl", encoding='utf-8') as file:
+        issue, *records = [json.loads(line) for line in file]
+    assert issue["type"] == "issue"
+    assert issue["date"] == ocr_corpus.issue_date(3).isoformat()
+    assert records
+    assert all(set(record) == {"type", "source", "issue", "date", "index", "title", "body"} for record in records)
+    assert [record["index"] for record in records] == list(range(len(records)))
+
+    text = (tmp_path / "issue.txt").read_text(encoding='utf-8')
+    articles = [(record["title"], record["body"]) for record in records]
+    assert text.startswith(segmenter.render_articles(articles))
+
+
+def test_toc_whitespace_is_collapsed_except_for_the_old_copy():
+    text = "THE TRINITY JOURNAL.\nMasthead\n  Local News\n\n  Mining   Intelligence \nPersistent Link: https://example.org/issue/1\n"
+    assert segmenter.extract_toc_and_hyperlink(text) == ("Local News Mining Intelligence", "https://example.org/issue/1")
+    # 0.5_TOC_Hyperlink_Get stores the TOC as the original extraction did
+    assert segmenter.extract_toc_and_hyperlink(text, collapse_whitespace=False) == (
+        "Local News\n\n  Mining   Intelligence", "https://example.org/issue/1")
@@ -0,0 +1,49 @@
+import random
+import pytest
+import ocr_corpus
+from text_cleaner import TextCleaner, clean_text
+
+
+# Function to clean a text fed to a streaming cleaner in chunks cut at the given positions
+def clean_in_chunks(text, cuts):
+    cleaner = TextCleaner()
+    bounds = [0] + sorted(cuts) + [len(text)]
+    cleaned = ''.join(cleaner.feed(text[start:end]) for start, end in zip(bounds, bounds[1:]))
+    return cleaned + cleaner.flush(), cleaner.counts
+
+
+def test_rules():
+    assert clean_text("the min-\ning camp") == "the mining camp"
+    assert clean_text("“Gold”—at last") == '"Gold"--at last'
+    assert clean_text("  two   spaces\t and ~ junk|  \n") == "two spaces and junk\n"
+
+
+def test_counts():
+    counts = {}
+    clean_text("min-\ning and min-\ning", counts)
+    assert counts["hyphen_joins"] == 2
+
+
+@pytest.mark.parametrize("text", [
+    "min-\ning",
+    "min-   \n   ing",
+    "a line-\n\nnot joined",
+    "ends with a hyphen-",
+    "“quoted”   words  —  and debris ~|^\n" * 3,
+])
+def test_every_cut_gives_the_same_text(text):
+    whole = TextCleaner()
+    expected = whole.clean(text)
+    for cut in range(len(text) + 1):
+        assert clean_in_chunks(text, [cut]) == (expected, whole.counts), cut
+
+
+@pytest.mark.parametrize("number", range(3))
+def test_random_chunks_give_the_same_text(number):
+    rng = random.Random(number)
+    text = ocr_corpus.build_issue(rng, 16 * 1024, number, noise=0.02, hyphen_rate=0.5, non_ascii_rate=0.05)
+    whole = TextCleaner()
+    expected = whole.clean(text)
+    for _ in range(20):
+        cuts = rng.sample(range(len(text)), rng.randint(1, 40))
+        assert clean_in_chunks(text, cuts) == (expected, whole.counts)
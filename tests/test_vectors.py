@@ -0,0 +1,90 @@
+import numpy as np
+import pytest
+import vectors
+from database import connect_db
+from sqlite_backend import cube_distance
+
+
+# Function to pack vectors and return their (bytes, dtype) pairs as a database returns them
+def stored(values, dtype=None):
+    return [(bytes(data.adapted), stored_dtype) for data, stored_dtype in vectors.pack_vectors(values, dtype)]
+
+
+@pytest.fixture
+def unit_vectors():
+    values = np.random.default_rng(0).normal(size=(5, 768)).astype(np.float32)
+    return values / np.linalg.norm(values, axis=1, keepdims=True)
+
+
+def test_float32_round_trip_is_exact(unit_vectors):
+    rows = stored(unit_vectors, "float32")
+    assert {dtype for _, dtype in rows} == {"float32"}
+    assert all(len(data) == 768 * 4 for data, _ in rows)
+    for (data, dtype), vector in zip(rows, unit_vectors):
+        np.testing.assert_array_equal(vectors.decode_vector(data, dtype), vector)
+
+
+def test_float16_halves_the_bytes(unit_vectors):
+    rows = stored(unit_vectors, "float16")
+    assert all(len(data) == 768 * 2 for data, _ in rows)
+    decoded = vectors.decode_vectors(rows)
+    assert decoded.dtype == np.float32
+    assert np.abs(decoded - unit_vectors).max() < 1e-3
+
+
+def test_default_type_is_the_setting(unit_vectors, monkeypatch):
+    monkeypatch.setattr(vectors, "vector_dtype", "float16")
+    assert {dtype for _, dtype in stored(unit_vectors)} == {"float16"}
+
+
+def test_missing_type_is_float32(unit_vectors):
+    data = unit_vectors[0].tobytes()
+    np.testing.assert_array_equal(vectors.decode_vector(data, None), unit_vectors[0])
+    np.testing.assert_array_equal(vectors.decode_vectors([(data, None)])[0], unit_vectors[0])
+
+
+def test_decode_vectors_of_mixed_types(unit_vectors):
+    rows = stored(unit_vectors[:2], "float32") + stored(unit_vectors[2:], "float16")
+    decoded = vectors.decode_vectors(rows)
+    assert decoded.shape == (5, 768)
+    np.testing.assert_array_equal(decoded[:2], unit_vectors[:2])
+    assert np.abs(decoded[2:] - unit_vectors[2:]).max() < 1e-3
+
+
+def test_decode_no_vectors():
+    assert vectors.decode_vectors([]).shape == (0, 0)
+    assert vectors.decode_vectors([], dimension=768).shape == (0, 768)
+
+
+def test_sqlite_distance_reads_both_types(unit_vectors):
+    literal = '{' + ','.join(str(value) for value in unit_vectors[1]) + '}'
+    expected = float(np.linalg.norm(unit_vectors[0] - unit_vectors[1]))
+    for dtype in vectors.VECTOR_DTYPES:
+        data, _ = stored(unit_vectors[:1], dtype)[0]
+        assert cube_distance(data, literal) == pytest.approx(expected, abs=1e-3)
+
+
+def test_migration_moves_arrays_and_converts_types(sqlite_database, unit_vectors):
+    conn = connect_db()
+    with conn.cursor() as cursor:
+        cursor.execute("INSERT INTO newspapers (title, publication_date) VALUES ('issue.txt', '1856-01-05')")
+        for article_id in range(1, 4):
+            cursor.execute("INSERT INTO articles (article_id, newspaper_id, title, content) VALUES (%s, 1, %s, 'text')",
+                           (article_id, f"title {article_id}"))
+        # An article with only the old array, one with float32 bytes, and one without a vector
+        cursor.execute("UPDATE articles SET embedding_vector_array = %s WHERE article_id = 1", (unit_vectors[0].tolist(),))
+        cursor.execute("UPDATE articles SET embedding_vector = %s WHERE article_id = 2", (unit_vectors[1].tobytes(),))
+    conn.commit()
+
+    assert vectors.migrate_table(conn, "articles", "float16", batch_size=1) == 2
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT embedding_vector, embedding_dtype, embedding_vector_array FROM articles ORDER BY article_id")
+        rows = cursor.fetchall()
+    conn.commit()
+    assert [dtype for _, dtype, _ in rows] == ["float16", "float16", None]
+    assert [array for _, _, array in rows] == [None, None, None]
+    assert np.abs(vectors.decode_vectors([row[:2] for row in rows[:2]]) - unit_vectors[:2]).max() < 1e-3
+
+    # Migrated rows no longer match, so a second run has nothing to do
+    assert vectors.migrate_table(conn, "articles", "float16") == 0
+    conn.close()
@@ -0,0 +1,80 @@
+import re
+
+# Streaming OCR text cleaner, applied to the raw issue text before segmentation.
+# The rules are compiled once and run in order; every replacement is counted per rule so the
+# run manifests show how much each rule changed. Text can be fed in chunks of any size: a
+# chunk is only cleaned up to its last newline that no rule can reach across, and the rest
+# is held back for the next chunk, so a word hyphenated across two chunks is still rejoined.
+# Bump segmenter.SEGMENTER_VERSION when the rules change, so cleaned files are rebuilt.
+
+# Typographic quotes and dashes, mapped to the ASCII characters the other rules keep
+TYPOGRAPHIC_CHARACTERS = {'‘': "'", '’': "'", '“': '"', '”': '"', '—': '--', '–': '-'}
+
+# Ordered cleaning rules: (name, compiled pattern, replacement)
+CLEANING_RULES = (
+    # Curly quotes and long dashes become ASCII (an em dash becomes "--", so it never rejoins words)
+    ("typographic_punctuation", re.compile('[' + ''.join(TYPOGRAPHIC_CHARACTERS) + ']'),
+     lambda match: TYPOGRAPHIC_CHARACTERS[match.group(0)]),
+    # OCR debris: anything but letters, digits, whitespace and the punctuation real text uses
+    ("junk_characters", re.compile(r'''[^\w\s.,;:!?'"()&$%-]'''), ''),
+    # Leading and trailing whitespace on each line (newlines are kept)
+    ("stripped_lines", re.compile(r'^[^\S\n]+|[^\S\n]+$', re.MULTILINE), ''),
+    # Runs of spaces and tabs inside a line
+    ("collapsed_spaces", re.compile(r'[ \t]{2,}|\t'), ' '),
+    # Words hyphenated across a line break ("min-\ning" becomes "mining")
+    ("hyphen_joins", re.compile(r'(\w)-\n(\w)'), r'\1\2'),
+)
+
+# The first two rules replace single characters, so they can run on a chunk before it is cut
+CHARACTER_RULES = CLEANING_RULES[:2]
+LINE_RULES = CLEANING_RULES[2:]
+
+
+class TextCleaner:
+    def __init__(self):
+        self.pending = ''
+        self.counts = {name: 0 for name, _, _ in CLEANING_RULES}
+
+    # Function to apply a list of rules to a piece of text, counting the replacements
+    def apply(self, rules, text):
+        for name, pattern, replacement in rules:
+            text, count = pattern.subn(replacement, text)
+            self.counts[name] += count
+        return text
+
+    # Function to clean a complete text in one go
+    def clean(self, text):
+        return self.apply(CLEANING_RULES, text)
+
+    # Function to clean the next chunk of a stream; returns the cleaned text that is final.
+    # The line rules only run up to the last newline that does not end a hyphenated line,
+    # since that newline may still be joined with the start of the next chunk.
+    def feed(self, text):
+        text = self.pending + self.apply(CHARACTER_RULES, text)
+
+        cut = text.rfind('\n')
+        while cut != -1:
+            end = cut
+            while end > 0 and text[end - 1] != '\n' and text[end - 1].isspace():
+                end -= 1
+            if end == 0 or text[end - 1] != '-':
+                break
+            cut = text.rfind('\n', 0, cut)
+
+        self.pending = text[cut + 1:]
+        return self.apply(LINE_RULES, text[:cut + 1])
+
+    # Function to clean whatever the stream is still holding back
+    def flush(self):
+        text, self.pending = self.pending, ''
+        return self.apply(LINE_RULES, text)
+
+
+# Function to clean a complete text in one go; counts are added to the given dict, if any
+def clean_text(text, counts=None):
+    cleaner = TextCleaner()
+    cleaned = cleaner.clean(text)
+    if counts is not None:
+        for name, count in cleaner.counts.items():
+            counts[name] = counts.get(name, 0) + count
+    return cleaned
@@ -0,0 +1,212 @@
+import os
+import json
+import time
+import socket
+import logging
+import argparse
+import importlib
+import configparser
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from database import connect_db
+
+# Per-host tuning of the model stages (5_, 6_, 8_, 11_).
+# python tuning.py benchmarks each stage's own batch function (model and database writes, in a
+# transaction that is rolled back) over a random sample of real articles, for every combination
+# of batch size and torch thread counts, and saves the fastest per stage for this host. The
+# stages load the settings of their host when they start: the torch intra-op and inter-op
+# threads, and the batch size as the default of --batch-size. Stages without tuned settings
+# keep torch's defaults and a batch size of 100.
+# Every thread setting is measured in a fresh process, since torch fixes its inter-op threads
+# once they are first used.
+
+# Load settings from the ini file
+config = configparser.ConfigParser()
+config.read('settings.ini')
+
+# File of the tuned settings of every host, keyed by host name
+tuning_path = config.get('tuning', 'file', fallback='host_tuning.json')
+
+# Batch size of the stages without tuned settings
+DEFAULT_BATCH_SIZE = 100
+
+# Tunable stages: name -> (module, text column, function building process(cursor, rows) from the module)
+STAGES = {
+    "embeddings": ("5_sentence_transformer", "content", lambda module: module.embed_batch),
+    "ner": ("6_NER_to_database", "content", lambda module: ner_process(module, module.tag_articles)),
+    "sentiment": ("8_sentiment_analysis_to_DB", "summary", lambda module: module.score_articles),
+    "summary_ner": ("11_NER_TO_SUMMARY", "summary", lambda module: ner_process(module, module.tag_summaries)),
+}
+
+# Set to False to start stages without applying the saved settings (the benchmark processes do)
+apply_saved = True
+
+# Whether this process has set its inter-op threads (torch allows it once)
+_inter_op_set = False
+
+# Function to bind an NER stage's model to its batch function
+def ner_process(module, tag):
+    ner_model = module.load_ner_model()
+    return lambda cursor, rows: tag(cursor, ner_model, rows)
+
+# Function to load the tuned settings of every host
+def load_tuning(path=None):
+    path = path or tuning_path
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r', encoding='utf-8') as file:
+            return json.load(file)
+    except (OSError, ValueError) as e:
+        logging.warning(f"[WARNING] Could not read the tuning file {path}: {e}")
+        return {}
+
+# Function to get this host's tuned settings of a stage ({} if it was never tuned here)
+def host_settings(stage, path=None):
+    return load_tuning(path).get(socket.gethostname(), {}).get(stage, {})
+
+# Function to get a stage's batch size on this host
+def batch_size(stage, default=DEFAULT_BATCH_SIZE):
+    return host_settings(stage).get("batch_size", default) if apply_saved else default
+
+# Function to set torch's thread counts to this host's tuned settings of a stage; call it before
+# the stage loads its model. When several stages share a process (pipeline.py), the intra-op
+# threads follow the running stage and the inter-op threads stay those of the first stage.
+def apply_threads(stage):
+    global _inter_op_set
+    if not apply_saved:
+        return
+    settings = host_settings(stage)
+    if "intra_op_threads" not in settings:
+        return
+    import torch
+    torch.set_num_threads(settings["intra_op_threads"])
+    if not _inter_op_set:
+        try:
+            torch.set_num_interop_threads(settings["inter_op_threads"])
+        except RuntimeError as e:
+            # Only possible once per process, before any inter-op work
+            logging.warning(f"[WARNING] Could not set the inter-op threads of stage {stage}: {e}")
+        _inter_op_set = True
+    logging.info(f"[INFO] Stage {stage}: using tuned settings for {socket.gethostname()}: "
+                 f"{settings['intra_op_threads']} intra-op / {settings['inter_op_threads']} inter-op threads, batch size {settings.get('batch_size')}.")
+
+# Function to fetch a random sample of a stage's input rows, in article_id order
+def fetch_sample(column, sample_size):
+    conn = connect_db()
+    if conn is None:
+        raise RuntimeError("could not connect to the database")
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(f"""
+                SELECT article_id, {column} FROM articles WHERE {column} IS NOT NULL
+                ORDER BY random() LIMIT %s;
+            """, (sample_size,))
+            return sorted(cursor.fetchall())
+    finally:
+        conn.close()
+
+# Function run in a fresh process: set the thread counts, load the stage, and time its batch
+# function over the sample at every batch size. Returns {batch size: articles per second}.
+def benchmark_threads(stage, intra_op_threads, inter_op_threads, batch_sizes, rows):
+    # The stages read the saved settings through the tuning module (this file may be running as
+    # __main__, which is another module object)
+    import tuning
+    tuning.apply_saved = False
+    # Cached texts would skip the model and inflate the throughput
+    import embedding_cache
+    embedding_cache.enabled = False
+    import torch
+    torch.set_num_threads(intra_op_threads)
+    torch.set_num_interop_threads(inter_op_threads)
+
+    module = importlib.import_module(STAGES[stage][0])
+    process = STAGES[stage][2](module)
+    conn = connect_db()
+    results = {}
+    try:
+        with conn.cursor() as cursor:
+            # Warm up the model (first-call allocations, lazy initialization)
+            process(cursor, rows[:min(batch_sizes)])
+            conn.rollback()
+            for size in batch_sizes:
+                start = time.perf_counter()
+                for offset in range(0, len(rows), size):
+                    process(cursor, rows[offset:offset + size])
+                results[size] = len(rows) / (time.perf_counter() - start)
+                # The benchmark's writes are never kept
+                conn.rollback()
+    finally:
+        conn.rollback()
+        conn.close()
+    return results
+
+# Function to benchmark a stage over every thread setting; returns a list of result dicts
+def tune_stage(stage, batch_sizes, thread_counts, inter_op_counts, sample_size):
+    rows = fetch_sample(STAGES[stage][1], sample_size)
+    if not rows:
+        logging.warning(f"[WARNING] Stage {stage}: no input rows to benchmark, skipped.")
+        return []
+    logging.info(f"[INFO] Stage {stage}: benchmarking {len(rows)} sampled articles.")
+
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for intra in thread_counts:
+        for inter in inter_op_counts:
+            try:
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                    rates = executor.submit(benchmark_threads, stage, intra, inter, batch_sizes, rows).result()
+            except Exception as e:
+                logging.error(f"[ERROR] Stage {stage}: benchmark with {intra} intra-op / {inter} inter-op threads failed: {e}")
+                continue
+            for size, rate in rates.items():
+                results.append({"batch_size": size, "intra_op_threads": intra, "inter_op_threads": inter, "articles_per_second": rate})
+                logging.info(f"[INFO] Stage {stage}: batch {size}, {intra} intra-op / {inter} inter-op threads: {rate:.2f} articles/s")
+    return results
+
+# Function to tune the given stages and save the fastest settings of each for this host
+def run_tuning(stages, batch_sizes, thread_counts, inter_op_counts, sample_size, path=None):
+    path = path or tuning_path
+    tuning = load_tuning(path)
+    host = tuning.setdefault(socket.gethostname(), {})
+
+    for stage in stages:
+        results = tune_stage(stage, batch_sizes, thread_counts, inter_op_counts, sample_size)
+        if not results:
+            continue
+        best = max(results, key=lambda result: result["articles_per_second"])
+        host[stage] = dict(best, sample=sample_size, tuned=datetime.now().isoformat(timespec='seconds'))
+        print(f"{stage}: batch size {best['batch_size']}, {best['intra_op_threads']} intra-op / "
+              f"{best['inter_op_threads']} inter-op threads ({best['articles_per_second']:.2f} articles/s)")
+
+        # Saved after every stage, so an interrupted run keeps the stages already tuned
+        with open(path + ".tmp", 'w', encoding='utf-8') as file:
+            json.dump(tuning, file, indent=2)
+        os.replace(path + ".tmp", path)
+    return host
+
+# Function to parse a comma-separated list of positive integers
+def int_list(value):
+    return [int(item) for item in value.split(',') if item.strip()]
+
+# Main function
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    cpus = os.cpu_count() or 1
+    default_threads = sorted({count for count in (1, 2, 4, 8, 16, 32, 64) if count < cpus} | {cpus})
+
+    parser = argparse.ArgumentParser(description="Benchmark the model stages on this host and save the fastest batch size and torch threads.")
+    parser.add_argument("--stages", default=",".join(STAGES), help=f"Comma-separated stages to tune (default all): {', '.join(STAGES)}")
+    parser.add_argument("--sample", type=int, default=128, help="Articles sampled for the benchmark")
+    parser.add_argument("--batch-sizes", type=int_list, default=[16, 32, 64, 100, 128], help="Comma-separated batch sizes to try")
+    parser.add_argument("--threads", type=int_list, default=default_threads, help="Comma-separated intra-op thread counts to try")
+    parser.add_argument("--inter-op-threads", type=int_list, default=[1, 2], help="Comma-separated inter-op thread counts to try")
+    args = parser.parse_args()
+
+    stages = [stage.strip() for stage in args.stages.split(',') if stage.strip()]
+    for stage in stages:
+        if stage not in STAGES:
+            parser.error(f"unknown stage {stage!r}")
+
+    run_tuning(stages, args.batch_sizes, args.threads, args.inter_op_threads, args.sample)
@@ -0,0 +1,146 @@
+import logging
+import argparse
+import configparser
+import numpy as np
+import psycopg2
+import database
+from database import connect_db, write_values, iter_keyset
+
+# Compact storage of the embeddings.
+# 5_ used to write every article vector twice: as float32 bytes in embedding_vector and as a
+# NUMERIC[] in embedding_vector_array, decimal numbers many times the size of the floats, which
+# 9_ read back through Python lists. Now embedding_vector is the only copy: the raw bytes of the
+# vector, float32 or (with vector_dtype = float16) half the size, with the type in
+# embedding_dtype. Readers decode the bytes with np.frombuffer straight into a preallocated
+# float32 array. A NULL embedding_dtype is float32 (vectors written before the type was stored).
+# python vectors.py migrates the stored vectors: it fills embedding_vector from the arrays where
+# it is missing, converts the vectors of articles and passages to vector_dtype, and clears the
+# arrays. Run VACUUM FULL articles afterwards to give the space back to the operating system.
+
+# Load settings from the ini file
+config = configparser.ConfigParser()
+config.read('settings.ini')
+
+# Types a vector can be stored as, and the type new vectors are written in
+VECTOR_DTYPES = ("float32", "float16")
+vector_dtype = config.get('embeddings', 'vector_dtype', fallback='float32')
+if vector_dtype not in VECTOR_DTYPES:
+    raise ValueError(f"[embeddings] vector_dtype must be one of {', '.join(VECTOR_DTYPES)}, not {vector_dtype!r}")
+
+# Function to add the embedding_dtype columns if they do not exist (the local SQLite database
+# adds them when it is opened, see sqlite_backend.py)
+def ensure_vector_columns(cursor):
+    if database.backend == "sqlite":
+        return
+    # ALTER TABLE locks the table even when the column exists, so only the tables missing the
+    # column are altered (a stage starting must not wait for every open reader of articles)
+    cursor.execute("""
+        SELECT table_name FROM information_schema.tables t
+        WHERE table_schema = current_schema() AND table_name IN ('articles', 'passages')
+        AND NOT EXISTS (SELECT 1 FROM information_schema.columns c
+                        WHERE c.table_schema = t.table_schema AND c.table_name = t.table_name AND c.column_name = 'embedding_dtype');
+    """)
+    missing = [row[0] for row in cursor.fetchall()]
+    if missing:
+        cursor.execute("SELECT pg_advisory_xact_lock(hashtext('vector_columns'));")
+        for table in missing:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS embedding_dtype VARCHAR(16);")
+
+# Function to pack vectors for storage; returns a (bytes, dtype) pair per vector. The embeddings
+# are unit length, well inside the range of float16.
+def pack_vectors(vectors, dtype=None):
+    dtype = dtype or vector_dtype
+    packed = np.asarray(vectors).astype(dtype, copy=False)
+    return [(psycopg2.Binary(vector.tobytes()), dtype) for vector in packed]
+
+# Function to read one stored vector (without copying the bytes)
+def decode_vector(data, dtype=None):
+    return np.frombuffer(data, dtype=dtype or 'float32')
+
+# Function to decode stored (bytes, dtype) pairs into one preallocated float32 array (of the
+# dimension of the first vector unless given)
+def decode_vectors(rows, dimension=None):
+    rows = list(rows)
+    if dimension is None:
+        dimension = len(decode_vector(*rows[0])) if rows else 0
+    vectors = np.empty((len(rows), dimension), dtype=np.float32)
+    for position, (data, dtype) in enumerate(rows):
+        vectors[position] = decode_vector(data, dtype)
+    return vectors
+
+# Tables whose vectors the migration rewrites: table -> (key, columns read besides the key and
+# the vector, assignment added to the update)
+MIGRATIONS = {
+    "articles": ("article_id", "embedding_vector_array", ", embedding_vector_array = NULL"),
+    "passages": ("passage_id", "NULL", ""),
+}
+
+# Function to rewrite a batch of (key, vector bytes, dtype, array) rows in the compact column
+def migrate_batch(cursor, table, rows, dtype):
+    key, _, clear = MIGRATIONS[table]
+    keys = []
+    vectors = []
+    for row_key, data, stored_dtype, array in rows:
+        if data is not None:
+            vectors.append(decode_vector(data, stored_dtype))
+        else:
+            vectors.append(np.asarray(array, dtype=np.float32))
+        keys.append(row_key)
+    write_values(cursor, f"""
+        UPDATE {table}
+        SET embedding_vector = batch.embedding_vector, embedding_dtype = batch.embedding_dtype{clear}
+        FROM (VALUES %s) AS batch ({key}, embedding_vector, embedding_dtype)
+        WHERE {table}.{key} = batch.{key};
+    """, [(row_key,) + packed for row_key, packed in zip(keys, pack_vectors(vectors, dtype))],
+        template="(%s::integer, %s::bytea, %s)")
+
+# Function to migrate the vectors of a table to the compact column in dtype, a committed batch at
+# a time (a migration that stops resumes where it was, since migrated rows no longer match)
+def migrate_table(conn, table, dtype, batch_size=1000):
+    key, array_column, _ = MIGRATIONS[table]
+    pending = f"embedding_vector IS NOT NULL AND (embedding_dtype IS NULL OR embedding_dtype <> '{dtype}')"
+    if table == "articles":
+        pending = f"embedding_vector_array IS NOT NULL OR {pending}"
+    migrated = 0
+    try:
+        with conn.cursor() as cursor:
+            for rows in iter_keyset(cursor, f"SELECT {key}, embedding_vector, embedding_dtype, {array_column} FROM {table}", key,
+                                    where=pending, batch_size=batch_size):
+                migrate_batch(cursor, table, rows, dtype)
+                conn.commit()
+                migrated += len(rows)
+    except psycopg2.ProgrammingError as e:
+        # The passages table only exists once 5_ has run with --passages
+        conn.rollback()
+        logging.warning(f"[WARNING] Skipped the {table} table: {e}")
+    return migrated
+
+# Function to migrate the stored vectors of articles and passages
+def migrate(dtype=None, batch_size=1000):
+    dtype = dtype or vector_dtype
+    conn = connect_db()
+    if conn is None:
+        return
+    try:
+        with conn.cursor() as cursor:
+            ensure_vector_columns(cursor)
+        conn.commit()
+        for table in MIGRATIONS:
+            migrated = migrate_table(conn, table, dtype, batch_size)
+            logging.info(f"[INFO] Migrated {migrated} {table} vectors to {dtype}.")
+        logging.info("[INFO] Run VACUUM FULL articles (or VACUUM on SQLite) to reclaim the space of the cleared arrays.")
+    except psycopg2.Error as e:
+        logging.error(f"[ERROR] Database error during the migration: {e}. The batches committed so far are kept; rerun to resume.")
+        conn.rollback()
+    finally:
+        conn.close()
+
+# Main function
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Migrate the stored embeddings to the compact vector column.")
+    parser.add_argument("--dtype", choices=VECTOR_DTYPES, default=vector_dtype, help="Type to store the vectors in (default: [embeddings] vector_dtype, or float32)")
+    parser.add_argument("--batch-size", type=int, default=1000, help="Rows rewritten and committed per batch")
+    args = parser.parse_args()
+
+    migrate(args.dtype, args.batch_size)